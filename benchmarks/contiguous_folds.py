@@ -0,0 +1,135 @@
+"""Compares peak memory and time of out-of-fold meta-feature generation with folds taken by
+fancy indexing against folds taken from the contiguous fold layout.
+
+The dataset is cached as memory-mapped .npy files first, as Xcessiv does. Every run then
+happens in a fresh process that reports
+
+* its peak resident set size, which includes the pages of the memory-mapped dataset it
+  touched. The kernel can drop these at any time.
+* its peak anonymous resident set size, which leaves them out. It is sampled from
+  ``/proc/self/status`` and only reported on Linux.
+* its peak traced memory, which only includes NumPy allocations such as fold copies.
+
+The first contiguous run also permutes the dataset into fold order. The second one reuses
+the saved layout.
+
+Usage::
+
+    python benchmarks/contiguous_folds.py --rows 200000 --columns 100 --folds 5
+"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+import argparse
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import KFold
+from xcessiv import functions
+
+
+def run(folder, mode, folds):
+    """Generates out-of-fold meta-features of the cached dataset in ``folder``
+
+    Returns:
+        seconds (float): Time taken
+
+        peak (int): Peak traced memory in bytes
+    """
+    tracemalloc.start()
+    start = time.time()
+    X, y = functions.load_dataset_from_cache(folder, 'train')
+    splits = list(KFold(folds, shuffle=True, random_state=8).split(y))
+    contiguous = mode == 'contiguous'
+    if contiguous:
+        order, splits = functions.contiguous_fold_layout(splits, len(y))
+        if functions.load_dataset_from_cache(folder, 'folds') is None:
+            functions.save_dataset_to_cache(folder, 'folds', X, y, order)
+        X, y = functions.load_dataset_from_cache(folder, 'folds')
+    functions.generate_out_of_fold_meta_features(
+        SGDClassifier(max_iter=5, tol=None, random_state=8), X, y, splits,
+        'decision_function', contiguous=contiguous
+    )
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+class AnonymousMemorySampler(threading.Thread):
+    """Keeps track of the largest anonymous resident set size of this process"""
+    def __init__(self):
+        super(AnonymousMemorySampler, self).__init__()
+        self.daemon = True
+        self.peak = 0
+
+    @staticmethod
+    def sample():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, self.sample())
+            time.sleep(0.001)
+
+
+def max_rss():
+    """Returns the peak resident set size of this process in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--columns', type=int, default=100)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--run', nargs=2, metavar=('MODE', 'FOLDER'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        try:
+            sampler = AnonymousMemorySampler()
+            sampler.sample()
+        except (IOError, OSError):  # No /proc
+            sampler = None
+        else:
+            sampler.start()
+        seconds, peak = run(args.run[1], args.run[0], args.folds)
+        print(seconds, peak, max_rss(), sampler.peak if sampler else float('nan'))
+        return
+
+    random_state = np.random.RandomState(8)
+    X = random_state.randn(args.rows, args.columns)
+    y = (X.dot(random_state.randn(args.columns)) > 0).astype(int)
+    folder = tempfile.mkdtemp()
+    try:
+        functions.save_dataset_to_cache(folder, 'train', X, y)
+        del X, y
+        print('{:,} x {:,} float64 features, {:.1f} MB'.format(
+            args.rows, args.columns, args.rows * args.columns * 8 / 1024 ** 2))
+        for name, mode in (('fancy indexing', 'fancy'),
+                           ('contiguous (first run)', 'contiguous'),
+                           ('contiguous', 'contiguous')):
+            output = subprocess.check_output([
+                sys.executable, __file__, '--folds', str(args.folds), '--run', mode, folder
+            ])
+            seconds, peak, rss, anonymous_rss = [float(value) for value in output.split()]
+            print('{:<22}  {:6.2f} s  {:8.1f} MB peak RSS  {:8.1f} MB anonymous  '
+                  '{:8.1f} MB traced'.format(name, seconds, rss / 1024 ** 2,
+                                             anonymous_rss / 1024 ** 2, peak / 1024 ** 2))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
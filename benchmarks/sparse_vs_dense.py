@@ -0,0 +1,67 @@
+"""Compares memory and time of the dataset cache and out-of-fold meta-feature generation
+for sparse features against the same features densified.
+
+Peak memory is measured with tracemalloc, which sees NumPy and SciPy allocations but not
+memory allocated inside compiled estimators.
+
+Usage::
+
+    python benchmarks/sparse_vs_dense.py --rows 4000 --columns 20000 --density 0.001
+"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from scipy import sparse
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import KFold
+from xcessiv import functions
+
+
+def run(X, y, folder):
+    """Caches the dataset, loads it back and generates out-of-fold meta-features
+
+    Returns:
+        seconds (float): Time taken
+
+        peak (int): Peak traced memory in bytes
+    """
+    tracemalloc.start()
+    start = time.time()
+    functions.save_dataset_to_cache(folder, 'train', X, y)
+    X_cached, y_cached = functions.load_dataset_from_cache(folder, 'train')
+    functions.generate_out_of_fold_meta_features(
+        SGDClassifier(random_state=8), X_cached, y_cached,
+        KFold(5, shuffle=True, random_state=8).split(y_cached), 'decision_function'
+    )
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=4000)
+    parser.add_argument('--columns', type=int, default=20000)
+    parser.add_argument('--density', type=float, default=0.001)
+    args = parser.parse_args()
+
+    X = sparse.random(args.rows, args.columns, density=args.density, format='csr',
+                      random_state=8)
+    y = (X.dot(np.random.RandomState(8).randn(args.columns)) > 0).astype(int)
+
+    for name, features in (('sparse', X), ('dense', X.toarray())):
+        folder = tempfile.mkdtemp()
+        try:
+            seconds, peak = run(features, y, folder)
+        finally:
+            shutil.rmtree(folder)
+        print('{:<6}  {:8.2f} s  {:10.1f} MB peak'.format(name, seconds, peak / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main()
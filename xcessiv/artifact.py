@@ -0,0 +1,129 @@
+"""This module contains functions for saving and loading fitted stacked ensembles"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+import hashlib
+import imp
+import io
+import json
+import os
+import shutil
+import sys
+from six import exec_
+try:
+    import joblib
+except ImportError:  # Older scikit-learn versions vendor joblib
+    from sklearn.externals import joblib
+from xcessiv import exceptions
+
+
+ARTIFACT_FORMAT_VERSION = 1
+
+
+def _import_source(source):
+    """Executes the exported source of an ensemble as a module registered in `sys.modules`
+    under the SHA256 hash of the source, so fitted estimators whose classes are defined in
+    the source can be pickled and unpickled"""
+    sha256 = hashlib.sha256(source.encode('UTF-8')).hexdigest()
+    module = sys.modules.get(sha256)
+    if module is None:
+        module = imp.new_module(sha256)
+        exec_(source, module.__dict__)
+        sys.modules[sha256] = module
+    return module
+
+
+def save_artifact(artifact_path, source, ensemble):
+    """Saves a fitted stacked ensemble as an artifact folder
+
+    The folder contains the exported source of the ensemble, one uncompressed joblib file
+    per base learner and one for the secondary learner, and a ``manifest.json`` describing
+    them. Uncompressed joblib files let :func:`load_artifact` memory-map the NumPy arrays
+    of the fitted estimators instead of reading them.
+
+    Args:
+        artifact_path (str, unicode): Folder to save the artifact in. Must not exist.
+
+        source (str, unicode): Source code returned by
+            :meth:`xcessiv.models.StackedEnsemble.export_as_code`
+
+        ensemble (XcessivStackedEnsemble): Ensemble built from ``source`` and fitted
+
+    Raises:
+        exceptions.UserError: If ``artifact_path`` already exists
+    """
+    if os.path.exists(artifact_path):
+        raise exceptions.UserError('{} already exists'.format(artifact_path))
+
+    temp_path = '{}.tmp-{}'.format(artifact_path.rstrip(os.sep), os.getpid())
+    os.makedirs(temp_path)
+    try:
+        with io.open(os.path.join(temp_path, 'ensemble.py'), 'w', encoding='utf8') as f:
+            f.write(source)
+
+        base_learner_files = []
+        for idx, base_learner in enumerate(ensemble.base_learners):
+            filename = 'baselearner{}.joblib'.format(idx)
+            joblib.dump(base_learner, os.path.join(temp_path, filename))
+            base_learner_files.append(filename)
+        joblib.dump(ensemble.secondary_learner,
+                    os.path.join(temp_path, 'secondarylearner.joblib'))
+
+        manifest = dict(
+            format_version=ARTIFACT_FORMAT_VERSION,
+            source='ensemble.py',
+            source_sha256=hashlib.sha256(source.encode('UTF-8')).hexdigest(),
+            base_learners=base_learner_files,
+            meta_feature_generators=list(ensemble.meta_feature_generators),
+            secondary_learner='secondarylearner.joblib'
+        )
+        with open(os.path.join(temp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+        # The artifact only appears once it is complete
+        os.rename(temp_path, artifact_path)
+    except:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+
+def load_artifact(artifact_path, mmap_mode='r'):
+    """Loads a fitted stacked ensemble saved by :func:`save_artifact`
+
+    No estimator is fitted. The exported source is executed to define the ensemble class
+    and any custom estimator classes, and the fitted estimators are unpickled with their
+    arrays memory-mapped, so the ensemble is ready to predict right away.
+
+    Args:
+        artifact_path (str, unicode): Artifact folder
+
+        mmap_mode (str, unicode, optional): Passed to :func:`joblib.load`. Use None to read
+            the arrays into memory instead.
+
+    Returns:
+        ensemble (XcessivStackedEnsemble): Fitted ensemble exposing the meta-feature
+            generator method of its secondary learner
+    """
+    with open(os.path.join(artifact_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] > ARTIFACT_FORMAT_VERSION:
+        raise exceptions.UserError('Artifact format {} is newer than the supported '
+                                   'format {}'.format(manifest['format_version'],
+                                                      ARTIFACT_FORMAT_VERSION))
+
+    with io.open(os.path.join(artifact_path, manifest['source']), encoding='utf8') as f:
+        source = f.read()
+    if hashlib.sha256(source.encode('UTF-8')).hexdigest() != manifest['source_sha256']:
+        raise exceptions.UserError('Source of artifact {} was modified'.format(artifact_path))
+    module = _import_source(source)
+
+    base_learners = [joblib.load(os.path.join(artifact_path, filename), mmap_mode=mmap_mode)
+                     for filename in manifest['base_learners']]
+    secondary_learner = joblib.load(os.path.join(artifact_path,
+                                                 manifest['secondary_learner']),
+                                    mmap_mode=mmap_mode)
+
+    return module.XcessivStackedEnsemble(
+        base_learners=base_learners,
+        meta_feature_generators=manifest['meta_feature_generators'],
+        secondary_learner=secondary_learner,
+        cv_function=module.return_splits_iterable
+    )
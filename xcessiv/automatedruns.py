@@ -1,16 +1,23 @@
 """This module contains functions for the automated runs"""
 from __future__ import absolute_import, print_function, division, unicode_literals
-from rq import get_current_job
+from rq import get_current_job, Queue, Worker
 from xcessiv import functions
 from xcessiv import models
 from xcessiv import constants
+from xcessiv import evaluators
+from xcessiv import exceptions
+from xcessiv.metafeaturestore import MetaFeatureStore
 import numpy as np
 import os
 import sys
 import traceback
 from six import iteritems
 import numbers
+import time
 from bayes_opt import BayesianOptimization
+from scipy.stats import norm
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, Matern
 
 
 def return_func_to_optimize(path, session, base_learner_origin, default_params,
@@ -51,7 +58,7 @@ def return_func_to_optimize(path, session, base_learner_origin, default_params,
         # Look if base learner already exists
         base_learner = session.query(models.BaseLearner).\
             filter_by(base_learner_origin_id=base_learner_origin.id,
-                      hyperparameters=hyperparameters).first()
+                      hyperparameters_hash=models.hash_json(hyperparameters)).first()
 
         calculate_only = False
 
@@ -78,25 +85,22 @@ def return_func_to_optimize(path, session, base_learner_origin, default_params,
         try:
             est = base_learner.return_estimator()
             extraction = session.query(models.Extraction).first()
-            X, y = extraction.return_train_dataset()
-            return_splits_iterable = functions.import_object_from_string_code(
-                extraction.meta_feature_generation['source'],
-                'return_splits_iterable'
-            )
+            X, y = extraction.return_train_dataset(path)
 
-            meta_features_list = []
-            trues_list = []
-            for train_index, test_index in return_splits_iterable(X, y):
-                X_train, X_test = X[train_index], X[test_index]
-                y_train, y_test = y[train_index], y[test_index]
-                est = est.fit(X_train, y_train)
-                meta_features_list.append(
-                    getattr(est, base_learner.base_learner_origin.
-                            meta_feature_generator)(X_test)
+            checkpoint_path = None
+            if not calculate_only:
+                checkpoint_path = base_learner.checkpoint_path(path)
+                functions.prepare_checkpoint_folder(
+                    checkpoint_path,
+                    base_learner.checkpoint_fingerprint(extraction)
                 )
-                trues_list.append(y_test)
-            meta_features = np.concatenate(meta_features_list, axis=0)
-            y_true = np.concatenate(trues_list)
+
+            meta_features, y_true = functions.generate_out_of_fold_meta_features(
+                est, X, y, extraction.return_base_learner_splits(path),
+                base_learner.base_learner_origin.meta_feature_generator,
+                n_jobs=extraction.meta_feature_generation.get('n_jobs', 1),
+                checkpoint_path=checkpoint_path
+            )
 
             for key in base_learner.base_learner_origin.metric_generators:
                 metric_generator = functions.import_object_from_string_code(
@@ -107,16 +111,12 @@ def return_func_to_optimize(path, session, base_learner_origin, default_params,
 
             # Only do this if you want to save things
             if not calculate_only:
-                meta_features_path = base_learner.meta_features_path(path)
-
-                if not os.path.exists(os.path.dirname(meta_features_path)):
-                    os.makedirs(os.path.dirname(meta_features_path))
-
-                np.save(meta_features_path, meta_features, allow_pickle=False)
+                base_learner.save_meta_features(path, meta_features)
                 base_learner.job_status = 'finished'
                 base_learner.meta_features_exists = True
                 session.add(base_learner)
                 session.commit()
+                base_learner.delete_checkpoints(path)
 
             if invert_metric:
                 return -base_learner.individual_score[metric_to_optimize]
@@ -191,6 +191,15 @@ def start_naive_bayes(automated_run, session, path):
     print('{} existing in initialization dictionary'.
           format(len(initialization_dict['target'])))
 
+    if getattr(module, 'batch_size', 1) > 1:
+        optimizer = ConstantLiarOptimizer(module.pbounds, random_state=random_state,
+                                          **module.maximize_config)
+        for idx, target in enumerate(initialization_dict['target']):
+            optimizer.register(dict((key, initialization_dict[key][idx])
+                                    for key in module.pbounds), target)
+        start_asynchronous_bayes(automated_run, session, path, module, optimizer)
+        return
+
     # Create function to be optimized
     func_to_optimize = return_func_to_optimize(
         path, session, automated_run.base_learner_origin, module.default_params,
@@ -207,6 +216,241 @@ def start_naive_bayes(automated_run, session, path):
     bo.maximize(**module.maximize_config)
 
 
+class ConstantLiarOptimizer(object):
+    """Proposes hyperparameters for asynchronous Bayesian optimization
+
+    Points whose evaluation is still pending are added to the Gaussian process surrogate with
+    a constant "lie" equal to the worst target observed so far. This pushes the acquisition
+    function away from pending points, so several diverse points can be evaluated at the
+    same time. This is the "constant liar" strategy of Ginsbourger et al. Points whose
+    evaluation failed keep the worst target for good, so they are not proposed again.
+
+    Args:
+        pbounds (dict): Mapping from hyperparameter name to (min, max) bounds
+
+        random_state (int, optional): Seed of the random number generator
+
+        init_points (int, optional): Number of random points to propose before the
+            surrogate is used
+
+        n_iter (int, optional): Number of points to propose using the surrogate
+
+        acq (str, unicode, optional): Acquisition function. One of "ucb", "ei" and "poi"
+
+        kappa (float, optional): Exploration parameter of "ucb"
+
+        xi (float, optional): Exploration parameter of "ei" and "poi"
+
+        n_candidates (int, optional): Number of random points on which the acquisition
+            function is evaluated
+
+        **gp_params: Parameters of the underlying
+            :class:`sklearn.gaussian_process.GaussianProcessRegressor`
+    """
+    def __init__(self, pbounds, random_state=None, init_points=5, n_iter=25, acq='ucb',
+                 kappa=2.576, xi=0.0, n_candidates=10000, **gp_params):
+        self.keys = sorted(pbounds)
+        self.bounds = np.array([pbounds[key] for key in self.keys], dtype=float)
+        self.random_state = np.random.RandomState(random_state)
+        self.init_points = init_points
+        self.n_iter = n_iter
+        self.acq = acq
+        self.kappa = kappa
+        self.xi = xi
+        self.n_candidates = n_candidates
+        # Without a variance term and bounds on the length scale, the length scale
+        # collapses on smooth targets and the surrogate ignores pending points
+        kernel = ConstantKernel(1.0, (1e-3, 1e3)) * Matern(length_scale=0.5,
+                                                           length_scale_bounds=(1e-2, 1e2),
+                                                           nu=2.5)
+        self.gp = GaussianProcessRegressor(kernel=kernel, alpha=1e-6,
+                                           normalize_y=True, n_restarts_optimizer=5,
+                                           random_state=self.random_state)
+        self.gp.set_params(**gp_params)
+        self.points = []
+        self.targets = []
+        self.pending = dict()
+        self.failed = []
+        self.num_proposed = 0
+
+    def _to_array(self, params):
+        point = np.array([params[key] for key in self.keys], dtype=float)
+        return (point - self.bounds[:, 0]) / (self.bounds[:, 1] - self.bounds[:, 0])
+
+    def _random_points(self, n):
+        return self.random_state.uniform(size=(n, len(self.keys)))
+
+    def register(self, params, target):
+        """Adds an evaluated point to the surrogate
+
+        Args:
+            params (dict): Hyperparameters of the point
+
+            target (float): Value of the function to maximize at the point
+        """
+        self.points.append(self._to_array(params))
+        self.targets.append(target)
+
+    def register_failure(self, params):
+        """Adds a point whose evaluation failed to the surrogate. It is given the worst
+        target observed so far.
+
+        Args:
+            params (dict): Hyperparameters of the point
+        """
+        self.failed.append(self._to_array(params))
+
+    def add_pending(self, key, params):
+        """Marks a point as being evaluated
+
+        Args:
+            key: Hashable identifier of the evaluation
+
+            params (dict): Hyperparameters of the point
+        """
+        self.pending[key] = self._to_array(params)
+
+    def remove_pending(self, key):
+        """Removes a point from the pending points once its evaluation is done"""
+        self.pending.pop(key, None)
+
+    @property
+    def finished_proposing(self):
+        return self.num_proposed >= self.init_points + self.n_iter
+
+    def suggest(self):
+        """Returns the next point to evaluate
+
+        Returns:
+            params (dict): Mapping from hyperparameter name to proposed value
+        """
+        self.num_proposed += 1
+        if self.num_proposed <= self.init_points or len(self.targets) < 2:
+            point = self._random_points(1)[0]
+        else:
+            liar = min(self.targets)
+            X = np.array(self.points + self.failed + list(self.pending.values()))
+            y = np.array(self.targets + [liar] * (len(self.failed) + len(self.pending)))
+            self.gp.fit(X, y)
+
+            candidates = self._random_points(self.n_candidates)
+            mean, std = self.gp.predict(candidates, return_std=True)
+            std = np.maximum(std, 1e-9)
+            if self.acq == 'ucb':
+                utility = mean + self.kappa * std
+            elif self.acq == 'ei':
+                z = (mean - max(self.targets) - self.xi) / std
+                utility = (mean - max(self.targets) - self.xi) * norm.cdf(z) + std * norm.pdf(z)
+            elif self.acq == 'poi':
+                utility = norm.cdf((mean - max(self.targets) - self.xi) / std)
+            else:
+                raise exceptions.UserError('Unknown acquisition function {}'.format(self.acq))
+            point = candidates[np.argmax(utility)]
+
+        point = self.bounds[:, 0] + point * (self.bounds[:, 1] - self.bounds[:, 0])
+        return dict(zip(self.keys, point.tolist()))
+
+
+def start_asynchronous_bayes(automated_run, session, path, module, optimizer):
+    """Runs Bayesian optimization with up to ``module.batch_size`` base learners being
+    evaluated at the same time
+
+    Every proposed point becomes its own ``generate_meta_features`` job, so the search scales
+    with the number of workers. As soon as any job finishes, its result is fed to the
+    surrogate and a new point is proposed to take its place. Points whose job errored are
+    fed to the surrogate with the worst score seen so far. This includes jobs that failed,
+    were stopped or disappeared from the queue without updating their base learner, e.g.
+    because the work-horse was killed or timed out. Such base learners are marked errored.
+
+    The automated run itself occupies one worker while it waits, so the jobs it queues can
+    only run on other workers. If no other worker listens on the queue, the run fails
+    instead of waiting for jobs that never start.
+
+    Args:
+        automated_run (xcessiv.models.AutomatedRun): Automated run object
+
+        session: Valid SQLAlchemy session
+
+        path (str, unicode): Path to project folder
+
+        module: Module of the automated run's source
+
+        optimizer (ConstantLiarOptimizer): Optimizer already holding known results
+    """
+    current_job = get_current_job()
+    queue = Queue(current_job.origin, connection=current_job.connection)
+    base_learner_origin = automated_run.base_learner_origin
+    integers = set(module.integers)
+    poll_interval = getattr(module, 'poll_interval', 1)
+
+    def check_workers():
+        if Worker.count(connection=current_job.connection, queue=queue) < 2:
+            raise exceptions.UserError('Parallel Bayesian search needs at least one worker '
+                                       'besides the one running the automated run. Start '
+                                       'more workers or set batch_size to 1.')
+
+    check_workers()
+    pending = dict()  # base learner ID -> proposed params
+    jobs = dict()  # base learner ID -> job queued by this run that is still watched
+    while pending or not optimizer.finished_proposing:
+        while len(pending) < module.batch_size and not optimizer.finished_proposing:
+            params = optimizer.suggest()
+            est = base_learner_origin.return_estimator()
+            est.set_params(**module.default_params)
+            est.set_params(**dict((key, int(val)) if key in integers else (key, val)
+                                  for key, val in iteritems(params)))
+            hyperparameters = functions.make_serializable(est.get_params())
+
+            base_learner = session.query(models.BaseLearner).\
+                filter_by(base_learner_origin_id=base_learner_origin.id,
+                          hyperparameters_hash=models.hash_json(hyperparameters)).first()
+            if base_learner is None:
+                base_learner = models.BaseLearner(hyperparameters, 'queued',
+                                                  base_learner_origin)
+                session.add(base_learner)
+                session.commit()
+                jobs[base_learner.id] = queue.enqueue_call(
+                    'xcessiv.rqtasks.generate_meta_features',
+                    args=(path, base_learner.id), timeout=86400
+                )
+            pending[base_learner.id] = params
+            optimizer.add_pending(base_learner.id, params)
+
+        time.sleep(poll_interval)
+        check_workers()
+        session.expire_all()
+        for base_learner_id in list(pending):
+            base_learner = session.query(models.BaseLearner).\
+                filter_by(id=base_learner_id).first()
+            if base_learner is None:  # Deleted by the user
+                optimizer.remove_pending(base_learner_id)
+                pending.pop(base_learner_id)
+            elif base_learner.job_status == 'errored':
+                optimizer.remove_pending(base_learner_id)
+                optimizer.register_failure(pending.pop(base_learner_id))
+            elif base_learner.job_status == 'finished':
+                score = base_learner.individual_score[module.metric_to_optimize]
+                optimizer.remove_pending(base_learner_id)
+                optimizer.register(pending.pop(base_learner_id),
+                                   -score if module.invert_metric else score)
+            elif jobs.get(base_learner_id) is not None:
+                job = jobs[base_learner_id]
+                status = job.get_status()
+                if status == 'finished':
+                    # With fold fan-out, the base learner finishes in jobs queued by this one
+                    jobs.pop(base_learner_id)
+                elif status in (None, 'failed', 'stopped', 'canceled'):
+                    # The work-horse died without updating the base learner
+                    base_learner.job_status = 'errored'
+                    base_learner.description['error_value'] = \
+                        'Job {} is {}'.format(job.id, status or 'missing')
+                    session.add(base_learner)
+                    session.commit()
+                    jobs.pop(base_learner_id)
+                    optimizer.remove_pending(base_learner_id)
+                    optimizer.register_failure(pending.pop(base_learner_id))
+
+
 def start_tpot(automated_run, session, path):
     """Starts a TPOT automated run that exports directly to base learner setup
 
@@ -219,7 +463,7 @@ def start_tpot(automated_run, session, path):
     """
     module = functions.import_string_code_as_module(automated_run.source)
     extraction = session.query(models.Extraction).first()
-    X, y = extraction.return_train_dataset()
+    X, y = extraction.return_train_dataset(path)
 
     tpot_learner =  module.tpot_learner
 
@@ -262,54 +506,14 @@ def eval_stacked_ensemble(stacked_ensemble, session, path):
         stacked_ensemble (xcessiv.models.StackedEnsemble)
     """
     try:
-        meta_features_list = []
-        for base_learner in stacked_ensemble.base_learners:
-            mf = np.load(base_learner.meta_features_path(path))
-            if len(mf.shape) == 1:
-                mf = mf.reshape(-1, 1)
-            meta_features_list.append(mf)
-
-        secondary_features = np.concatenate(meta_features_list, axis=1)
-
-        # Get data
-        extraction = session.query(models.Extraction).first()
-        return_splits_iterable = functions.import_object_from_string_code(
-            extraction.meta_feature_generation['source'],
-            'return_splits_iterable'
-        )
-        X, y = extraction.return_train_dataset()
-
-        #  We need to retrieve original order of meta-features
-        indices_list = [test_index for train_index, test_index in return_splits_iterable(X, y)]
-        indices = np.concatenate(indices_list)
-        X, y = X[indices], y[indices]
-
-        est = stacked_ensemble.return_secondary_learner()
-
-        return_splits_iterable_stacked_ensemble = functions.import_object_from_string_code(
-            extraction.stacked_ensemble_cv['source'],
-            'return_splits_iterable'
+        evaluator = evaluators.StackedEnsembleEvaluator.from_notebook(
+            path, session, stacked_ensemble.base_learners,
+            stacked_ensemble.base_learner_origin
         )
-        preds = []
-        trues_list = []
-        for train_index, test_index in return_splits_iterable_stacked_ensemble(secondary_features, y):
-            X_train, X_test = secondary_features[train_index], secondary_features[test_index]
-            y_train, y_test = y[train_index], y[test_index]
-            est = est.fit(X_train, y_train)
-            preds.append(
-                getattr(est, stacked_ensemble.base_learner_origin.
-                        meta_feature_generator)(X_test)
-            )
-            trues_list.append(y_test)
-        preds = np.concatenate(preds, axis=0)
-        y_true = np.concatenate(trues_list)
-
-        for key in stacked_ensemble.base_learner_origin.metric_generators:
-            metric_generator = functions.import_object_from_string_code(
-                stacked_ensemble.base_learner_origin.metric_generators[key],
-                'metric_generator'
-            )
-            stacked_ensemble.individual_score[key] = metric_generator(y_true, preds)
+        scores = evaluator.evaluate([bl.id for bl in stacked_ensemble.base_learners],
+                                    stacked_ensemble.return_secondary_learner())
+        for key in scores:
+            stacked_ensemble.individual_score[key] = scores[key]
 
         stacked_ensemble.job_status = 'finished'
         session.add(stacked_ensemble)
@@ -341,6 +545,11 @@ def start_greedy_ensemble_search(automated_run, session, path):
 
     3. Repeat step 2 for a fixed number of iterations or until all models have been used.
 
+    The labels, the meta-features of all finished base learners and the stacked ensemble
+    cross-validation splits are loaded once, and every candidate ensemble is evaluated in
+    memory. Only the best ensemble of each round (or the best ``persist_top_k`` ensembles,
+    if set in the run's source) is saved as a stacked ensemble.
+
     Args:
         automated_run (xcessiv.models.AutomatedRun): Automated run object
 
@@ -350,49 +559,168 @@ def start_greedy_ensemble_search(automated_run, session, path):
     """
     module = functions.import_string_code_as_module(automated_run.source)
     assert module.metric_to_optimize in automated_run.base_learner_origin.metric_generators
-
-    best_ensemble = []  # List containing IDs of best performing ensemble for the last round
+    persist_top_k = getattr(module, 'persist_top_k', 1)
 
     secondary_learner = automated_run.base_learner_origin.return_estimator()
     secondary_learner.set_params(**module.secondary_learner_hyperparameters)
+    hyperparameters = functions.make_serializable(secondary_learner.get_params())
+
+    library = session.query(models.BaseLearner).filter_by(job_status='finished').all()
+    evaluator = evaluators.LinearStackedEnsembleEvaluator.from_notebook(
+        path, session, library, automated_run.base_learner_origin
+    )
+
+    best_ensemble = []  # List containing best performing ensemble for the last round
 
     for i in range(module.max_num_base_learners):
-        best_score = -float('inf')  # Best metric for this round (not in total!)
-        current_ensemble = best_ensemble[:]  # Shallow copy of best ensemble
-        for base_learner in session.query(models.BaseLearner).filter_by(job_status='finished').all():
-            if base_learner in current_ensemble:  # Don't append when learner is already in
+        candidates = []
+        for base_learner in library:
+            if base_learner in best_ensemble:  # Don't append when learner is already in
                 continue
-            current_ensemble.append(base_learner)
+            current_ensemble = best_ensemble + [base_learner]
 
-            # Check if our "best ensemble" already exists
-            existing_ensemble = session.query(models.StackedEnsemble).\
+            # Ensembles that already exist are never saved again. Their scores are reused
+            # if they finished.
+            existing = session.query(models.StackedEnsemble).\
                 filter_by(base_learner_origin_id=automated_run.base_learner_origin.id,
-                          secondary_learner_hyperparameters=secondary_learner.get_params(),
-                          base_learner_ids=sorted([bl.id for bl in current_ensemble])).first()
+                          ensemble_hash=models.StackedEnsemble.hash_ensemble(
+                              hyperparameters, [bl.id for bl in current_ensemble])).all()
+            is_new = not existing
+            finished = [stacked_ensemble for stacked_ensemble in existing
+                        if stacked_ensemble.job_status == 'finished']
+            if finished:
+                scores = finished[0].individual_score
+            else:
+                scores = evaluator.evaluate([bl.id for bl in current_ensemble],
+                                            secondary_learner)
 
-            if existing_ensemble and existing_ensemble.job_status == 'finished':
-                score = existing_ensemble.individual_score[module.metric_to_optimize]
+            score = scores[module.metric_to_optimize]
+            score = -score if module.invert_metric else score
+            candidates.append((score, current_ensemble, scores, is_new))
 
-            elif existing_ensemble and existing_ensemble.job_status != 'finished':
-                eval_stacked_ensemble(existing_ensemble, session, path)
-                score = existing_ensemble.individual_score[module.metric_to_optimize]
+        if not candidates:
+            break
 
-            else:
-                stacked_ensemble = models.StackedEnsemble(
-                    secondary_learner_hyperparameters=secondary_learner.get_params(),
-                    base_learners=current_ensemble,
-                    base_learner_origin=automated_run.base_learner_origin,
-                    job_status='started'
-                )
-                session.add(stacked_ensemble)
-                session.commit()
-                eval_stacked_ensemble(stacked_ensemble, session, path)
-                score = stacked_ensemble.individual_score[module.metric_to_optimize]
+        # Stable sort keeps the earliest candidate on ties
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
 
-            score = -score if module.invert_metric else score
+        for score, current_ensemble, scores, is_new in candidates[:persist_top_k]:
+            if not is_new:
+                continue
+            stacked_ensemble = models.StackedEnsemble(
+                secondary_learner_hyperparameters=hyperparameters,
+                base_learners=current_ensemble,
+                base_learner_origin=automated_run.base_learner_origin,
+                job_status='finished'
+            )
+            stacked_ensemble.individual_score = scores
+            session.add(stacked_ensemble)
+        session.commit()
+
+        best_ensemble = candidates[0][1]
+
+
+def start_ensemble_selection(automated_run, session, path):
+    """Starts an automated ensemble selection run that builds a weighted average of base
+    learner meta-features.
 
-            if best_score < score:
-                best_score = score
-                best_ensemble = current_ensemble[:]
+    This is ensemble selection with replacement as described in "Ensemble Selection from
+    Libraries of Models" by Caruana. No secondary learner is fitted. Instead, each round adds
+    the base learner whose meta-features, averaged with those of the current ensemble, give
+    the best score. Base learners may be added several times, which raises their weight.
+
+    Besides the gathered meta-features of the library, which take
+    ``n_rows * n_base_learners * n_columns * 8`` bytes, only the running sum of the
+    ensemble's meta-features and a single candidate average of ``n_rows * n_columns``
+    values each are kept in memory. The metric is called once per candidate.
+
+    The library consists of all finished base learners whose base learner setup uses the same
+    meta-feature generator as the run's base learner setup, which provides the metrics. Base
+    learners whose meta-features have a different number of columns than most of the library
+    cannot be averaged with it and are listed in the run's description under
+    ``skipped_base_learners``. The weights of the best ensemble found are stored in the run's
+    description.
+
+    Args:
+        automated_run (xcessiv.models.AutomatedRun): Automated run object
 
-            current_ensemble.pop()
+        session: Valid SQLAlchemy session
+
+        path (str, unicode): Path to project folder
+    """
+    module = functions.import_string_code_as_module(automated_run.source)
+    base_learner_origin = automated_run.base_learner_origin
+    assert module.metric_to_optimize in base_learner_origin.metric_generators
+
+    library = [
+        base_learner for base_learner
+        in session.query(models.BaseLearner).filter_by(job_status='finished').all()
+        if base_learner.base_learner_origin.meta_feature_generator ==
+        base_learner_origin.meta_feature_generator
+    ]
+    if not library:
+        raise exceptions.UserError('No finished base learners to select from')
+
+    store = MetaFeatureStore.from_notebook(path)
+    for base_learner in library:
+        base_learner.migrate_meta_features(path, store)
+    widths = store.widths([base_learner.id for base_learner in library])
+    width = max(set(widths), key=widths.count)
+    automated_run.description['skipped_base_learners'] = [
+        base_learner.id for base_learner, w in zip(library, widths) if w != width
+    ]
+    library = [base_learner for base_learner, w in zip(library, widths) if w == width]
+    squeeze = width == 1 and store.get(library[0].id).ndim == 1
+
+    # Shape (n_rows, n_learners, width) without copying the gathered matrix
+    meta_features = store.gather([base_learner.id for base_learner in library])
+    meta_features = meta_features.reshape(meta_features.shape[0], len(library), width)
+
+    y = session.query(models.Extraction).first().return_out_of_fold_targets(path)
+    metric_generators = dict(
+        (key, functions.import_object_from_string_code(source, 'metric_generator'))
+        for key, source in iteritems(base_learner_origin.metric_generators)
+    )
+    metric_to_optimize = metric_generators[module.metric_to_optimize]
+
+    def score(averaged):
+        value = metric_to_optimize(y, averaged.ravel() if squeeze else averaged)
+        return -value if module.invert_metric else value
+
+    counts = np.zeros(len(library), dtype=int)
+    ensemble_sum = np.zeros((meta_features.shape[0], width))
+    candidate = np.empty_like(ensemble_sum)  # Reused for the average of every candidate
+    best_score = -float('inf')
+    best_counts = counts.copy()
+
+    for i in range(module.max_num_iterations):
+        size = i + 1
+        round_scores = np.empty(len(library))
+        for j in range(len(library)):
+            np.add(ensemble_sum, meta_features[:, j, :], out=candidate)
+            candidate /= size
+            round_scores[j] = score(candidate)
+
+        chosen = int(np.argmax(round_scores))
+        counts[chosen] += 1
+        ensemble_sum += meta_features[:, chosen, :]
+
+        if round_scores[chosen] > best_score:
+            best_score = round_scores[chosen]
+            best_counts = counts.copy()
+
+    weights = best_counts / best_counts.sum()
+    averaged = np.tensordot(meta_features, weights, axes=([1], [0]))
+    if squeeze:
+        averaged = averaged.ravel()
+
+    automated_run.description['weights'] = dict(
+        (str(base_learner.id), float(weight))
+        for base_learner, weight in zip(library, weights) if weight > 0
+    )
+    automated_run.description['scores'] = dict(
+        (key, metric_generator(y, averaged))
+        for key, metric_generator in iteritems(metric_generators)
+    )
+    session.add(automated_run)
+    session.commit()
@@ -8,3 +8,9 @@ NUM_WORKERS = 1
 
 XCESSIV_META_FEATURES_FOLDER = 'meta-features'
 XCESSIV_NOTEBOOK_NAME = 'xcnb.db'
+XCESSIV_DATASET_CACHE_FOLDER = 'dataset-cache'
+XCESSIV_MODULE_CACHE_SIZE = 256
+XCESSIV_DB_BUSY_TIMEOUT = 30
+XCESSIV_DB_COMMIT_RETRIES = 5
+XCESSIV_FOLD_MODELS_MAX_BYTES = 1024 ** 3
+XCESSIV_WORKER_CACHE_MAX_BYTES = 1024 ** 3
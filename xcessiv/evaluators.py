@@ -0,0 +1,283 @@
+"""This module contains classes for evaluating stacked ensembles in memory"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+from collections import OrderedDict
+import numbers
+import numpy as np
+from scipy import linalg
+from sklearn.base import clone
+from sklearn.linear_model import LinearRegression, Ridge
+from six import iteritems
+from xcessiv import functions
+from xcessiv import models
+from xcessiv.metafeaturestore import MetaFeatureStore
+
+
+class StackedEnsembleEvaluator(object):
+    """Scores stacked ensembles built from a fixed library of base learners
+
+    The out-of-fold labels, the meta-features of every base learner in the library and the
+    stacked ensemble cross-validation splits are loaded once. Any subset of the library can
+    then be evaluated without touching the dataset, the database or the disk.
+
+    Args:
+        meta_features (numpy.ndarray): Meta-features of all base learners in the library,
+            side by side
+
+        column_ranges (dict): Mapping from base learner ID to the (start, stop) column range
+            of its meta-features in ``meta_features``
+
+        y (numpy.ndarray): Labels in the same order as the rows of ``meta_features``
+
+        splits (list): List of (train_index, test_index) pairs of the stacked ensemble
+            cross-validation
+
+        metric_generators (dict): Mapping from metric name to metric generator source code
+
+        meta_feature_generator (str, unicode): Method of the secondary learner used to
+            generate predictions
+    """
+    def __init__(self, meta_features, column_ranges, y, splits, metric_generators,
+                 meta_feature_generator):
+        self.meta_features = meta_features
+        self.column_ranges = column_ranges
+        self.y = y
+        self.splits = splits
+        self.meta_feature_generator = meta_feature_generator
+        self.metric_generators = dict(
+            (key, functions.import_object_from_string_code(source, 'metric_generator'))
+            for key, source in iteritems(metric_generators)
+        )
+
+    @classmethod
+    def from_notebook(cls, path, session, base_learners, base_learner_origin):
+        """Loads everything needed to evaluate ensembles of ``base_learners`` whose
+        secondary learner comes from ``base_learner_origin``
+
+        Args:
+            path (str, unicode): Path to Xcessiv notebook
+
+            session: Valid SQLAlchemy session
+
+            base_learners (list): Library of :class:`xcessiv.models.BaseLearner` objects
+
+            base_learner_origin (xcessiv.models.BaseLearnerOrigin): Origin of the secondary
+                learner
+        """
+        extraction = session.query(models.Extraction).first()
+
+        store = MetaFeatureStore.from_notebook(path)
+        for base_learner in base_learners:
+            base_learner.migrate_meta_features(path, store)
+        learner_ids = [base_learner.id for base_learner in base_learners]
+        meta_features = store.gather(learner_ids)
+
+        column_ranges = dict()
+        position = 0
+        for learner_id, width in zip(learner_ids, store.widths(learner_ids)):
+            column_ranges[learner_id] = (position, position + width)
+            position += width
+
+        y = extraction.return_out_of_fold_targets(path)
+
+        return_splits_iterable = functions.import_object_from_string_code(
+            extraction.stacked_ensemble_cv['source'],
+            'return_splits_iterable'
+        )
+        splits = list(return_splits_iterable(meta_features, y))
+
+        return cls(meta_features, column_ranges, y, splits,
+                   base_learner_origin.metric_generators,
+                   base_learner_origin.meta_feature_generator)
+
+    def secondary_features(self, learner_ids):
+        """Returns the secondary features of an ensemble of the given base learners"""
+        columns = np.concatenate([np.arange(*self.column_ranges[learner_id])
+                                  for learner_id in learner_ids])
+        return self.meta_features[:, columns]
+
+    def evaluate(self, learner_ids, secondary_learner):
+        """Scores a stacked ensemble
+
+        Args:
+            learner_ids (list): IDs of the base learners in the ensemble
+
+            secondary_learner: Unfitted secondary learner. It is cloned, not modified.
+
+        Returns:
+            scores (dict): Mapping from metric name to metric value
+        """
+        preds, y_true = functions.generate_out_of_fold_meta_features(
+            clone(secondary_learner),
+            self.secondary_features(learner_ids),
+            self.y,
+            self.splits,
+            self.meta_feature_generator
+        )
+        return dict((key, metric_generator(y_true, preds))
+                    for key, metric_generator in iteritems(self.metric_generators))
+
+    def evaluate_on_holdout(self, learner_ids, secondary_learner, test_meta_features, y_test):
+        """Scores a stacked ensemble on the test dataset
+
+        Like in an exported ensemble, the secondary learner is fitted on the out-of-fold
+        meta-features of all rows. It then only has to predict on the test set
+        meta-features of the base learners, so no base learner is fitted again.
+
+        Args:
+            learner_ids (list): IDs of the base learners in the ensemble
+
+            secondary_learner: Unfitted secondary learner. It is cloned, not modified.
+
+            test_meta_features (numpy.ndarray): Test set meta-features of the base learners,
+                side by side in the order of ``learner_ids``
+
+            y_test (numpy.ndarray): Labels of the test dataset
+
+        Returns:
+            scores (dict): Mapping from metric name to metric value
+        """
+        est = clone(secondary_learner).fit(self.secondary_features(learner_ids), self.y)
+        preds = getattr(est, self.meta_feature_generator)(test_meta_features)
+        return dict((key, metric_generator(y_test, preds))
+                    for key, metric_generator in iteritems(self.metric_generators))
+
+
+class LinearStackedEnsembleEvaluator(StackedEnsembleEvaluator):
+    """Scores stacked ensembles whose secondary learner is a
+    :class:`sklearn.linear_model.Ridge` or :class:`sklearn.linear_model.LinearRegression`
+    by solving the normal equations directly
+
+    For every fold, the dot products between meta-feature columns over the training rows
+    are computed the first time a pair of columns is needed and kept afterwards. Fitting
+    the secondary learner on any subset of columns is then a solve on a
+    (n_columns, n_columns) matrix built from these cached products. The Cholesky factors of
+    evaluated ensembles are kept as well, so scoring an ensemble that extends an already
+    evaluated one by a single base learner, as the greedy search does, only needs a border
+    update of that factor.
+
+    Any other secondary learner is evaluated the regular way.
+    """
+    max_cached_factors = 1024
+
+    def __init__(self, *args, **kwargs):
+        super(LinearStackedEnsembleEvaluator, self).__init__(*args, **kwargs)
+        self._dots = [dict() for _ in self.splits]
+        self._xty = [dict() for _ in self.splits]
+        self._sums = [dict() for _ in self.splits]
+        self._factors = OrderedDict()
+
+    def supports(self, secondary_learner):
+        """Returns True if the closed form solution applies to ``secondary_learner``"""
+        if self.meta_feature_generator != 'predict' or self.y.ndim != 1 or \
+                not np.issubdtype(self.y.dtype, np.number):
+            return False
+        if getattr(secondary_learner, 'positive', False) or \
+                getattr(secondary_learner, 'normalize', False) is True:
+            return False
+        if type(secondary_learner) is Ridge:
+            return isinstance(secondary_learner.alpha, numbers.Number)
+        return type(secondary_learner) is LinearRegression
+
+    def _columns(self, learner_ids):
+        return tuple(np.concatenate([np.arange(*self.column_ranges[learner_id])
+                                     for learner_id in learner_ids]).tolist())
+
+    def _normal_equations(self, fold, columns):
+        """Returns X^T X, X^T y and the column sums over the training rows of ``fold``,
+        computing only the products that are not cached yet"""
+        train_index = self.splits[fold][0]
+        dots, xty, sums = self._dots[fold], self._xty[fold], self._sums[fold]
+
+        for position, column in enumerate(columns):
+            missing = [other for other in columns[:position + 1]
+                       if (other, column) not in dots]
+            if not missing:
+                continue
+            values = self.meta_features[train_index, column]
+            products = values.dot(self.meta_features[np.ix_(train_index, missing)])
+            for other, product in zip(missing, products):
+                dots[(other, column)] = dots[(column, other)] = product
+            if column not in xty:
+                xty[column] = values.dot(self.y[train_index])
+                sums[column] = values.sum()
+
+        gram = np.array([[dots[(i, j)] for j in columns] for i in columns])
+        return (gram, np.array([xty[column] for column in columns]),
+                np.array([sums[column] for column in columns]))
+
+    def _factor(self, key, columns, matrix):
+        """Returns the lower Cholesky factor of ``matrix``, extending the cached factor of
+        the longest evaluated prefix of ``columns`` if there is one. ``key`` identifies the
+        fold and the secondary learner settings the matrix was built with."""
+        factor = None
+        for length in range(len(columns) - 1, 0, -1):
+            prefix = self._factors.get((key, columns[:length]))
+            if prefix is not None:
+                # Border update: [[L, 0], [C^T, M]] with L C = B and M M^T = D - C^T C
+                border = linalg.solve_triangular(prefix, matrix[:length, length:],
+                                                 lower=True)
+                corner = np.linalg.cholesky(matrix[length:, length:] - border.T.dot(border))
+                factor = np.zeros_like(matrix)
+                factor[:length, :length] = prefix
+                factor[length:, :length] = border.T
+                factor[length:, length:] = corner
+                break
+        if factor is None:
+            factor = np.linalg.cholesky(matrix)
+
+        self._factors[(key, columns)] = factor
+        while len(self._factors) > self.max_cached_factors:
+            self._factors.popitem(last=False)
+        return factor
+
+    def _fit_fold(self, fold, columns, secondary_learner):
+        """Returns coefficients and intercept of the secondary learner on ``fold``"""
+        train_index = self.splits[fold][0]
+        n = len(train_index)
+        gram, xty, sums = self._normal_equations(fold, columns)
+        y_sum = self.y[train_index].sum()
+
+        if secondary_learner.fit_intercept:
+            means = sums / n
+            gram = gram - n * np.outer(means, means)
+            xty = xty - means * y_sum
+        alpha = secondary_learner.alpha if type(secondary_learner) is Ridge else 0.
+        gram[np.diag_indices_from(gram)] += alpha
+
+        try:
+            factor = self._factor((fold, alpha, secondary_learner.fit_intercept), columns, gram)
+            coef = linalg.cho_solve((factor, True), xty)
+        except (np.linalg.LinAlgError, linalg.LinAlgError):
+            # Singular least squares problem. Use the minimum norm solution like
+            # LinearRegression does.
+            coef = np.linalg.lstsq(gram, xty, rcond=None)[0]
+
+        intercept = (y_sum - sums.dot(coef)) / n if secondary_learner.fit_intercept else 0.
+        return coef, intercept
+
+    def evaluate(self, learner_ids, secondary_learner):
+        """Scores a stacked ensemble, using the closed form solution if the secondary
+        learner supports it
+
+        Args:
+            learner_ids (list): IDs of the base learners in the ensemble
+
+            secondary_learner: Unfitted secondary learner. It is not modified.
+
+        Returns:
+            scores (dict): Mapping from metric name to metric value
+        """
+        if not self.supports(secondary_learner):
+            return super(LinearStackedEnsembleEvaluator, self).evaluate(learner_ids,
+                                                                        secondary_learner)
+
+        columns = self._columns(learner_ids)
+        preds = []
+        for fold, (train_index, test_index) in enumerate(self.splits):
+            coef, intercept = self._fit_fold(fold, columns, secondary_learner)
+            preds.append(self.meta_features[np.ix_(test_index, columns)].dot(coef) + intercept)
+        preds = np.concatenate(preds)
+        y_true = self.y[np.concatenate([test_index for train_index, test_index
+                                        in self.splits])]
+        return dict((key, metric_generator(y_true, preds))
+                    for key, metric_generator in iteritems(self.metric_generators))
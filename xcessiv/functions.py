@@ -4,13 +4,26 @@ import sys
 import os
 import hashlib
 import json
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
-from sqlalchemy import create_engine
+from scipy import sparse
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import Session
 from six import exec_, iteritems
 from sklearn import datasets
 from sklearn import model_selection
+from sklearn.base import clone
+try:
+    import joblib
+except ImportError:  # Older scikit-learn versions vendor joblib
+    from sklearn.externals import joblib
 from xcessiv import app, exceptions
+from xcessiv.stacker import OutOfFoldCollector
 
 
 def hash_file(path, block_size=65536):
@@ -48,24 +61,60 @@ def import_object_from_path(path, object):
         return import_object_from_string_code(f.read(), object)
 
 
-def import_object_from_string_code(code, object):
-    """Used to import an object from arbitrary passed code.
+_module_cache = OrderedDict()
+_module_cache_lock = threading.Lock()
 
-    Passed in code is treated as a module and is imported and added
-    to `sys.modules` with its SHA256 hash as key.
 
-    Args:
-        code (string): Python code to import as module
+def _cache_module(sha256, module):
+    """Stores ``module`` as the most recently used entry of the module cache and in
+    `sys.modules`, evicting the least recently used modules beyond the cache size"""
+    with _module_cache_lock:
+        _module_cache.pop(sha256, None)
+        _module_cache[sha256] = module
+        sys.modules[sha256] = module
+        while len(_module_cache) > app.config['XCESSIV_MODULE_CACHE_SIZE']:
+            evicted_sha256, evicted_module = _module_cache.popitem(last=False)
+            if sys.modules.get(evicted_sha256) is evicted_module:
+                del sys.modules[evicted_sha256]
 
-        object (string): Name of object to extract from imported module
-    """
+
+def _load_module(code, fresh):
     sha256 = hashlib.sha256(code.encode('UTF-8')).hexdigest()
+    if not fresh:
+        with _module_cache_lock:
+            module = _module_cache.get(sha256)
+            if module is not None:
+                _module_cache.pop(sha256)
+                _module_cache[sha256] = module  # Mark as most recently used
+                return module
+
     module = imp.new_module(sha256)
     try:
         exec_(code, module.__dict__)
     except Exception as e:
         raise exceptions.UserError('User code exception', exception_message=str(e))
-    sys.modules[sha256] = module
+    _cache_module(sha256, module)
+    return module
+
+
+def import_object_from_string_code(code, object, fresh=False):
+    """Used to import an object from arbitrary passed code.
+
+    Passed in code is treated as a module and is imported and added
+    to `sys.modules` with its SHA256 hash as key. Executed modules are kept in a
+    bounded least recently used cache, so importing the same code again returns the
+    object from the already executed module. Modules evicted from the cache are
+    removed from `sys.modules` as well.
+
+    Args:
+        code (string): Python code to import as module
+
+        object (string): Name of object to extract from imported module
+
+        fresh (bool, optional): If True, the code is always executed again. Use this
+            when the caller modifies the returned object, e.g. an estimator.
+    """
+    module = _load_module(code, fresh)
     try:
         return getattr(module, object)
     except AttributeError:
@@ -73,7 +122,8 @@ def import_object_from_string_code(code, object):
 
 
 def import_string_code_as_module(code):
-    """Used to run arbitrary passed code as a module
+    """Used to run arbitrary passed code as a module. The code is always executed
+    again, but the resulting module still counts towards the module cache.
 
     Args:
         code (string): Python code to import as module
@@ -81,14 +131,26 @@ def import_string_code_as_module(code):
     Returns:
         module: Python module
     """
-    sha256 = hashlib.sha256(code.encode('UTF-8')).hexdigest()
-    module = imp.new_module(sha256)
-    try:
-        exec_(code, module.__dict__)
-    except Exception as e:
-        raise exceptions.UserError('User code exception', exception_message=str(e))
-    sys.modules[sha256] = module
-    return module
+    return _load_module(code, fresh=True)
+
+
+def as_feature_array(X):
+    """Returns features in a form whose rows can be selected with index arrays, without
+    copying if possible
+
+    NumPy arrays and memory maps are returned as they are. Sparse matrices stay sparse. CSR
+    and CSC matrices are returned as they are, other sparse formats e.g. COO are converted
+    to CSR. Anything else is converted with :func:`numpy.asarray`.
+
+    Args:
+        X (array-like or sparse matrix): Features
+
+    Returns:
+        X (numpy.ndarray or sparse matrix): Features
+    """
+    if sparse.issparse(X):
+        return X if X.format in ('csr', 'csc') else X.tocsr()
+    return np.asarray(X)
 
 
 def verify_dataset(X, y):
@@ -108,23 +170,175 @@ def verify_dataset(X, y):
 
         y_shape (1-tuple of int): Shape of y returned
 
+        X_format (str): "dense" or the format of a sparse ``X`` e.g. "csr". For sparse
+            ``X``, the number of stored values, the density and the memory used are
+            returned as well.
+
     Raises:
         AssertionError: `X_shape` must be of length 2 and `y_shape` must be of
             length 1. `X` must have the same number of elements as `y`
             i.e. X_shape[0] == y_shape[0]. If any of these conditions are not met,
             an AssertionError is raised.
     """
-    X_shape, y_shape = np.array(X).shape, np.array(y).shape
+    # np.shape reads the shape of arrays and memory maps without copying them
+    X_shape, y_shape = np.shape(X), np.shape(y)
     if len(X_shape) != 2:
         raise exceptions.UserError("X must be 2-dimensional array")
     if len(y_shape) != 1:
         raise exceptions.UserError("y must be 1-dimensional array")
     if X_shape[0] != y_shape[0]:
         raise exceptions.UserError("X must have same number of elements as y")
-    return dict(
+    stats = dict(
         features_shape=X_shape,
-        labels_shape=y_shape
+        labels_shape=y_shape,
+        features_format='dense'
     )
+    if sparse.issparse(X):
+        stats['features_format'] = X.format
+        stats['features_nnz'] = int(X.nnz)
+        stats['features_density'] = X.nnz / float(max(X_shape[0] * X_shape[1], 1))
+        stats['features_nbytes'] = int(sum(getattr(X, name).nbytes for name in
+                                           ('data', 'indices', 'indptr') if hasattr(X, name)))
+    return stats
+
+
+def _save_rows(file_path, array, indices, chunk_bytes=64 * 1024 ** 2):
+    """Writes ``array[indices]`` to a .npy file a chunk of rows at a time, so the selected
+    rows never have to be held in memory together"""
+    row_bytes = max(array.dtype.itemsize * int(np.prod(array.shape[1:])), 1)
+    rows_per_chunk = max(chunk_bytes // row_bytes, 1)
+    out = np.lib.format.open_memmap(file_path, mode='w+', dtype=array.dtype,
+                                    shape=(len(indices),) + array.shape[1:])
+    for start in range(0, len(indices), rows_per_chunk):
+        out[start:start + rows_per_chunk] = array[indices[start:start + rows_per_chunk]]
+    out.flush()
+    del out
+
+
+def save_dataset_to_cache(cache_path, name, X, y, indices=None):
+    """Saves a dataset into the dataset cache folder as memory-mappable .npy files
+
+    Files are first written under a temporary name and then renamed so that concurrent
+    workers never see a partially written dataset. ``y`` is renamed before ``X`` so the
+    existence of the ``X`` file implies the existence of the ``y`` file.
+
+    Arrays and memory maps are written as they are, without an intermediate copy.
+
+    Args:
+        cache_path (str, unicode): Path to the cache folder of the extraction setup
+
+        name (str, unicode): Name of the dataset e.g. "train", "test"
+
+        X (array-like): Features array
+
+        y (array-like): Labels array
+
+        indices (array-like, optional): If given, only these rows of ``X`` and ``y`` are
+            saved. The rows are copied in chunks, so this does not need memory for a copy
+            of the selected rows.
+
+    Returns:
+        cached (bool): False if the dataset cannot be stored without pickling
+            e.g. object arrays, in which case nothing is saved.
+    """
+    if not os.path.exists(cache_path):
+        try:
+            os.makedirs(cache_path)
+        except OSError:  # Another worker might have created it first
+            if not os.path.isdir(cache_path):
+                raise
+
+    if sparse.issparse(X):
+        return _save_sparse_dataset_to_cache(cache_path, name, X, y, indices)
+
+    for suffix, array in (('y', y), ('X', X)):
+        array = np.asarray(array)
+        if array.dtype.hasobject:
+            return False
+        final_path = os.path.join(cache_path, '{}_{}.npy'.format(name, suffix))
+        temp_path = '{}.tmp-{}.npy'.format(final_path, os.getpid())
+        try:
+            if indices is None:
+                with open(temp_path, 'wb') as f:
+                    np.save(f, array, allow_pickle=False)
+            else:
+                _save_rows(temp_path, array, indices)
+        except ValueError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        os.rename(temp_path, final_path)
+    return True
+
+
+def _save_sparse_dataset_to_cache(cache_path, name, X, y, indices):
+    """Saves a dataset with sparse features. The data, indices and indptr arrays of ``X``
+    are saved as separate .npy files, and a JSON header written last marks the dataset as
+    complete.
+
+    The matrix is saved in canonical format, with sorted indices and no duplicate entries.
+    The cached arrays are loaded read-only, and scikit-learn and SciPy sort the indices of
+    a matrix in place when they are not sorted."""
+    X = as_feature_array(X)
+    y = np.asarray(y)
+    if indices is not None:
+        X, y = X[indices], y[indices]
+    if y.dtype.hasobject:
+        return False
+    if not X.has_canonical_format:
+        X = X.copy()
+        X.sum_duplicates()
+
+    arrays = (('y', y), ('X_data', X.data), ('X_indices', X.indices), ('X_indptr', X.indptr))
+    for suffix, array in arrays:
+        final_path = os.path.join(cache_path, '{}_{}.npy'.format(name, suffix))
+        temp_path = '{}.tmp-{}.npy'.format(final_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+        os.rename(temp_path, final_path)
+
+    header_path = os.path.join(cache_path, '{}_X.json'.format(name))
+    temp_path = '{}.tmp-{}'.format(header_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(dict(format=X.format, shape=list(X.shape)), f)
+    os.rename(temp_path, header_path)
+    return True
+
+
+def load_dataset_from_cache(cache_path, name):
+    """Loads a dataset saved by :func:`save_dataset_to_cache` as read-only memory maps
+
+    Sparse features are returned as a sparse matrix of their original format, built on
+    memory-mapped data, indices and indptr arrays.
+
+    Args:
+        cache_path (str, unicode): Path to the cache folder of the extraction setup
+
+        name (str, unicode): Name of the dataset e.g. "train", "test"
+
+    Returns:
+        dataset (tuple or None): Tuple (X, y) of memory-mapped arrays or None if the dataset
+            is not in the cache.
+    """
+    X_path = os.path.join(cache_path, '{}_X.npy'.format(name))
+    header_path = os.path.join(cache_path, '{}_X.json'.format(name))
+    if os.path.exists(X_path):
+        X = np.load(X_path, mmap_mode='r')
+    elif os.path.exists(header_path):
+        with open(header_path) as f:
+            header = json.load(f)
+        components = [np.load(os.path.join(cache_path, '{}_X_{}.npy'.format(name, suffix)),
+                              mmap_mode='r')
+                      for suffix in ('data', 'indices', 'indptr')]
+        matrix_class = sparse.csr_matrix if header['format'] == 'csr' else sparse.csc_matrix
+        X = matrix_class(tuple(components), shape=tuple(header['shape']), copy=False)
+        if not X.has_canonical_format:  # Cached by an older version of Xcessiv
+            X = X.copy()
+            X.sum_duplicates()
+    else:
+        return None
+    y = np.load(os.path.join(cache_path, '{}_y.npy'.format(name)), mmap_mode='r')
+    return X, y
 
 
 def is_valid_json(x):
@@ -243,18 +457,16 @@ def verify_estimator_class(est, meta_feature_generator, metric_generators, datas
 
     performance_dict = dict()
 
-    true_labels = []
-    preds = []
-
     try:
-        for train_index, test_index in splits:
+        splits = list(splits)
+        collector = OutOfFoldCollector(splits)
+        for fold, (train_index, test_index) in enumerate(splits):
             X_train, X_test = X[train_index], X[test_index]
-            y_train, y_test = y[train_index], y[test_index]
+            y_train = y[train_index]
             est.fit(X_train, y_train)
-            true_labels.append(y_test)
-            preds.append(getattr(est, meta_feature_generator)(X_test))
-        true_labels = np.concatenate(true_labels)
-        preds = np.concatenate(preds, axis=0)
+            collector.add(fold, getattr(est, meta_feature_generator)(X_test))
+        true_labels = y[collector.test_index]
+        preds = collector.result()
     except Exception as e:
         raise exceptions.UserError(repr(e))
 
@@ -275,6 +487,429 @@ def verify_estimator_class(est, meta_feature_generator, metric_generators, datas
     return performance_dict, make_serializable(est.get_params())
 
 
+def take_rows(array, index):
+    """Returns ``array[index]`` for an array of ascending row indices without fancy
+    indexing where possible. A single run of consecutive rows is returned as a view, and
+    two runs are concatenated from two views. Other indices fall back to fancy indexing.
+
+    Args:
+        array (array-like): Array or sparse matrix
+
+        index (numpy.ndarray): Row indices
+
+    Returns:
+        rows (array-like): Selected rows. May be a view of ``array``.
+    """
+    index = np.asarray(index)
+    if not len(index) or index.dtype == bool or index[0] < 0:
+        return array[index]
+
+    breaks = np.flatnonzero(np.diff(index) != 1)
+    if not len(breaks):
+        return array[index[0]:index[-1] + 1]
+    if len(breaks) == 1 and index[breaks[0] + 1] > index[breaks[0]]:
+        first, second = (array[index[0]:index[breaks[0]] + 1],
+                         array[index[breaks[0] + 1]:index[-1] + 1])
+        if sparse.issparse(array):
+            return sparse.vstack([first, second], format=array.format)
+        return np.concatenate([first, second])
+    return array[index]
+
+
+def contiguous_fold_layout(splits, n_rows):
+    """Returns a row order that places the test folds of ``splits`` one after the other,
+    followed by the rows of all but the last test fold once more, and the splits mapped
+    onto that order. In the reordered dataset, the test rows and the training rows of
+    every fold are each a single run of rows, so :func:`take_rows` returns views of both.
+
+    This is only possible if the test folds partition the dataset and every training fold
+    holds all the other rows, as in k-fold cross-validation.
+
+    Args:
+        splits (list): List of (train_index, test_index) pairs
+
+        n_rows (int): Number of rows in the dataset
+
+    Returns:
+        layout (tuple or None): Tuple (order, contiguous_splits) where ``order`` holds the
+            rows of the reordered dataset and ``contiguous_splits`` the splits in that
+            order, or None if the splits cannot be laid out contiguously.
+    """
+    order = np.concatenate([test_index for train_index, test_index in splits])
+    if len(order) != n_rows:
+        return None
+    position = np.full(n_rows, -1, dtype=np.int64)
+    position[order] = np.arange(n_rows)
+    if (position < 0).any():
+        return None
+
+    boundaries = np.cumsum([0] + [len(test_index) for train_index, test_index in splits])
+    for (train_index, test_index), start, stop in zip(splits, boundaries, boundaries[1:]):
+        train_position = position[train_index]
+        if len(train_index) != n_rows - len(test_index) or \
+                ((train_position >= start) & (train_position < stop)).any() or \
+                len(np.unique(train_position)) != len(train_position):
+            return None
+
+    # The training rows of fold i are the test folds after it and, wrapping around, the
+    # test folds before it
+    contiguous_splits = [(np.arange(stop, n_rows + start), np.arange(start, stop))
+                         for start, stop in zip(boundaries, boundaries[1:])]
+    return np.concatenate([order, order[:boundaries[-2]]]), contiguous_splits
+
+
+def fit_and_predict_fold(est, X, y, train_index, test_index, meta_feature_generator,
+                         contiguous=False):
+    """Fits an estimator on a single training fold and generates the meta-features
+    of the corresponding test fold
+
+    Args:
+        est: Estimator object
+
+        X (array-like): Features array
+
+        y (array-like): Labels array
+
+        train_index (array-like): Indices of the training fold
+
+        test_index (array-like): Indices of the test fold
+
+        meta_feature_generator (str, unicode): Name of the method used by the estimator
+            to generate meta-features
+
+        contiguous (bool, optional): If True, the folds are taken with :func:`take_rows`,
+            so the estimator may get views of ``X`` and ``y`` and must not modify them
+
+    Returns:
+        meta_features (numpy.ndarray): Meta-features of the test fold
+    """
+    if contiguous:
+        est = est.fit(take_rows(X, train_index), take_rows(y, train_index))
+        return getattr(est, meta_feature_generator)(take_rows(X, test_index))
+    est = est.fit(X[train_index], y[train_index])
+    return getattr(est, meta_feature_generator)(X[test_index])
+
+
+def prepare_checkpoint_folder(checkpoint_path, fingerprint):
+    """Makes sure the fold checkpoint folder exists and belongs to ``fingerprint``
+
+    Checkpoints left behind by a run with a different fingerprint e.g. different data or
+    cross-validation settings are deleted.
+
+    Args:
+        checkpoint_path (str, unicode): Path to checkpoint folder
+
+        fingerprint (str, unicode): Hash identifying everything the out-of-fold
+            predictions depend on
+    """
+    fingerprint_path = os.path.join(checkpoint_path, 'fingerprint')
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as f:
+            if f.read() == fingerprint:
+                return
+    if os.path.exists(checkpoint_path):
+        shutil.rmtree(checkpoint_path)
+    os.makedirs(checkpoint_path)
+    with open(fingerprint_path, 'w') as f:
+        f.write(fingerprint)
+
+
+def save_fold_checkpoint(checkpoint_path, fold, meta_features, metadata):
+    """Saves the out-of-fold meta-features of a single completed fold
+
+    Args:
+        checkpoint_path (str, unicode): Path to checkpoint folder
+
+        fold (int): Index of the fold
+
+        meta_features (numpy.ndarray): Meta-features of the fold's test set
+
+        metadata (dict): JSON serializable information about the fold
+    """
+    fold_path = os.path.join(checkpoint_path, 'fold_{}'.format(fold))
+    temp_path = '{}.tmp-{}'.format(fold_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.save(f, meta_features, allow_pickle=False)
+    with open(fold_path + '.json', 'w') as f:
+        json.dump(metadata, f)
+    # The .npy file appears last so its existence marks a complete checkpoint
+    os.rename(temp_path, fold_path + '.npy')
+
+
+def load_fold_checkpoint(checkpoint_path, fold, n_rows):
+    """Loads the out-of-fold meta-features of a fold if it was checkpointed
+
+    Args:
+        checkpoint_path (str, unicode): Path to checkpoint folder
+
+        fold (int): Index of the fold
+
+        n_rows (int): Expected number of rows i.e. size of the fold's test set
+
+    Returns:
+        meta_features (numpy.ndarray or None): Saved meta-features, or None if the fold
+            has no valid checkpoint
+    """
+    fold_path = os.path.join(checkpoint_path, 'fold_{}.npy'.format(fold))
+    if not os.path.exists(fold_path):
+        return None
+    meta_features = np.load(fold_path, mmap_mode='r')
+    if meta_features.shape[0] != n_rows:
+        return None
+    return meta_features
+
+
+def save_splits(checkpoint_path, splits):
+    """Saves cross-validation splits next to the fold checkpoints, so jobs processing
+    single folds all use the same splits
+
+    Args:
+        checkpoint_path (str, unicode): Path to checkpoint folder
+
+        splits (list): List of (train_index, test_index) pairs
+    """
+    arrays = dict()
+    for fold, (train_index, test_index) in enumerate(splits):
+        arrays['train_{}'.format(fold)] = np.asarray(train_index)
+        arrays['test_{}'.format(fold)] = np.asarray(test_index)
+    splits_path = os.path.join(checkpoint_path, 'splits.npz')
+    temp_path = '{}.tmp-{}'.format(splits_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(temp_path, splits_path)
+
+
+def load_splits(checkpoint_path):
+    """Loads the splits saved with :func:`save_splits`
+
+    Returns:
+        splits (list or None): List of (train_index, test_index) pairs, or None if no
+            splits were saved
+    """
+    splits_path = os.path.join(checkpoint_path, 'splits.npz')
+    if not os.path.exists(splits_path):
+        return None
+    with np.load(splits_path) as arrays:
+        return [(arrays['train_{}'.format(fold)], arrays['test_{}'.format(fold)])
+                for fold in range(len(arrays.files) // 2)]
+
+
+def missing_fold_checkpoints(checkpoint_path, n_folds):
+    """Returns the indices of the folds that have no checkpoint yet"""
+    return [fold for fold in range(n_folds)
+            if not os.path.exists(os.path.join(checkpoint_path, 'fold_{}.npy'.format(fold)))]
+
+
+def claim_reduce(checkpoint_path):
+    """Atomically claims the right to reduce the fold checkpoints. Only the first caller
+    gets True, so exactly one of several concurrently finishing fold jobs schedules the
+    reduce step."""
+    try:
+        fd = os.open(os.path.join(checkpoint_path, 'reduce'), os.O_CREAT | os.O_EXCL)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def release_reduce(checkpoint_path):
+    """Releases the claim of :func:`claim_reduce` after the reduce step failed, so the
+    next fold job that completes the checkpoints can schedule it again"""
+    if os.path.exists(os.path.join(checkpoint_path, 'reduce')):
+        os.remove(os.path.join(checkpoint_path, 'reduce'))
+
+
+def fold_model_file(fold_models_path, fold):
+    """Returns the path of the saved estimator of a fold"""
+    return os.path.join(fold_models_path, 'fold_{}.joblib'.format(fold))
+
+
+def save_fold_model(fold_models_path, fold, est, max_bytes):
+    """Saves the estimator fitted on a fold as a compressed joblib file
+
+    The estimator is not kept if it would bring the fold models in ``fold_models_path`` over
+    ``max_bytes``, so the caller has to check that every fold model exists before using them.
+    The total is checked after the estimator is moved into place, so folds saved at the same
+    time by other jobs are counted too. A fold that finds the total too large removes its own
+    estimator again.
+
+    Args:
+        fold_models_path (str, unicode): Folder holding the fold models of a base learner
+
+        fold (int): Index of the fold
+
+        est: Fitted estimator
+
+        max_bytes (int): Maximum total size of the fold models in ``fold_models_path``
+
+    Returns:
+        saved (bool): True if the estimator was kept
+    """
+    if not os.path.exists(fold_models_path):
+        try:
+            os.makedirs(fold_models_path)
+        except OSError:  # Another fold might have created it first
+            if not os.path.isdir(fold_models_path):
+                raise
+    model_path = fold_model_file(fold_models_path, fold)
+    temp_path = '{}.tmp-{}'.format(model_path, os.getpid())
+    joblib.dump(est, temp_path, compress=3)
+    os.rename(temp_path, model_path)
+
+    used = 0
+    for filename in os.listdir(fold_models_path):
+        if filename.endswith('.joblib'):
+            try:
+                used += os.path.getsize(os.path.join(fold_models_path, filename))
+            except OSError:  # Removed by another fold in the meantime
+                pass
+    if used > max_bytes:
+        os.remove(model_path)
+        return False
+    return True
+
+
+def missing_fold_models(fold_models_path, n_folds):
+    """Returns the indices of the folds that have no saved estimator"""
+    return [fold for fold in range(n_folds)
+            if not os.path.exists(fold_model_file(fold_models_path, fold))]
+
+
+def load_fold_models(fold_models_path):
+    """Loads the estimators saved with :func:`save_fold_model`
+
+    Returns:
+        estimators (list): Fitted estimators in fold order
+    """
+    folds = sorted(int(filename[len('fold_'):-len('.joblib')])
+                   for filename in os.listdir(fold_models_path)
+                   if filename.startswith('fold_') and filename.endswith('.joblib'))
+    return [joblib.load(fold_model_file(fold_models_path, fold)) for fold in folds]
+
+
+def average_fold_predictions(predictions):
+    """Combines the predictions of the fold models of a base learner on the same rows
+
+    Floating point outputs e.g. probabilities or regression predictions are averaged.
+    Anything else, e.g. class labels from ``predict``, is combined by majority vote.
+
+    Args:
+        predictions (list): Outputs of the fold models, all of the same shape
+
+    Returns:
+        combined (numpy.ndarray): Combined predictions
+    """
+    predictions = np.stack([np.asarray(preds) for preds in predictions])
+    if np.issubdtype(predictions.dtype, np.floating):
+        return predictions.mean(axis=0)
+
+    flat = predictions.reshape(len(predictions), -1)
+    combined = np.empty(flat.shape[1], dtype=predictions.dtype)
+    for column in range(flat.shape[1]):
+        values, counts = np.unique(flat[:, column], return_counts=True)
+        combined[column] = values[np.argmax(counts)]
+    return combined.reshape(predictions.shape[1:])
+
+
+def fit_and_predict_checkpointed_fold(est, X, y, train_index, test_index,
+                                      meta_feature_generator, checkpoint_path, fold,
+                                      fold_models_path=None, contiguous=False):
+    """Runs :func:`fit_and_predict_fold` and checkpoints the result if needed. If
+    ``fold_models_path`` is given, the fitted estimator is saved there as well."""
+    start_time = time.time()
+    meta_features = fit_and_predict_fold(est, X, y, train_index, test_index,
+                                         meta_feature_generator, contiguous)
+    if fold_models_path is not None:
+        save_fold_model(fold_models_path, fold, est,
+                        app.config['XCESSIV_FOLD_MODELS_MAX_BYTES'])
+    if checkpoint_path is not None:
+        save_fold_checkpoint(checkpoint_path, fold, meta_features, dict(
+            fold=fold,
+            n_rows=len(test_index),
+            fit_time=time.time() - start_time
+        ))
+    return meta_features
+
+
+def generate_out_of_fold_meta_features(est, X, y, splits, meta_feature_generator, n_jobs=1,
+                                       checkpoint_path=None, fold_models_path=None,
+                                       contiguous=False):
+    """Generates out-of-fold meta-features of an estimator over cross-validation splits
+
+    If ``n_jobs`` is not 1, the folds are fitted concurrently in a process pool. Each fold
+    gets its own clone of ``est`` and large arrays are shared with the pool through memory
+    mapping instead of being pickled. Results are always reassembled in fold order, so the
+    output is identical to the serial path for deterministic estimators.
+
+    If ``checkpoint_path`` is given, the meta-features of every fold are saved there as soon
+    as the fold completes, and folds that already have a checkpoint are not fitted again.
+
+    Args:
+        est: Estimator object
+
+        X (array-like): Features array
+
+        y (array-like): Labels array
+
+        splits (iterable): Iterable yielding (train_index, test_index) pairs
+
+        meta_feature_generator (str, unicode): Name of the method used by the estimator
+            to generate meta-features
+
+        n_jobs (int, optional): Number of folds to process concurrently. -1 means
+            using all processors.
+
+        checkpoint_path (str, unicode, optional): Path to a folder prepared with
+            :func:`prepare_checkpoint_folder`
+
+        fold_models_path (str, unicode, optional): If given, the estimator fitted on each
+            fold is saved in this folder with :func:`save_fold_model`. Checkpointed folds
+            whose model was not saved are fitted again.
+
+        contiguous (bool, optional): Passed to :func:`fit_and_predict_fold`. Use with the
+            dataset and splits of a :func:`contiguous_fold_layout`.
+
+    Returns:
+        meta_features (numpy.ndarray): Concatenated out-of-fold meta-features
+
+        y_true (numpy.ndarray): Labels in the same order as ``meta_features``
+    """
+    splits = list(splits)
+    collector = OutOfFoldCollector(splits)
+
+    remaining_folds = []
+    for fold, (train_index, test_index) in enumerate(splits):
+        meta_features = None
+        if checkpoint_path is not None and (fold_models_path is None or os.path.exists(
+                fold_model_file(fold_models_path, fold))):
+            meta_features = load_fold_checkpoint(checkpoint_path, fold, len(test_index))
+        if meta_features is None:
+            remaining_folds.append(fold)
+        else:
+            collector.add(fold, meta_features)
+
+    if n_jobs == 1 or len(remaining_folds) < 2:
+        for fold in remaining_folds:
+            train_index, test_index = splits[fold]
+            collector.add(fold, fit_and_predict_checkpointed_fold(
+                est, X, y, train_index, test_index, meta_feature_generator,
+                checkpoint_path, fold, fold_models_path, contiguous
+            ))
+    else:
+        # Forked workers inherit the user code modules registered in sys.modules
+        results = joblib.Parallel(n_jobs=n_jobs, backend='multiprocessing')(
+            joblib.delayed(fit_and_predict_checkpointed_fold)(
+                clone(est), X, y, splits[fold][0], splits[fold][1],
+                meta_feature_generator, checkpoint_path, fold, fold_models_path, contiguous
+            )
+            for fold in remaining_folds
+        )
+        for fold in remaining_folds:
+            collector.add(fold, results.pop(0))
+
+    return collector.result(), y[collector.test_index]
+
+
 def get_path_from_query_string(req):
     """Gets path from query string
 
@@ -292,6 +927,66 @@ def get_path_from_query_string(req):
     return req.args.get('path')
 
 
+class _RetryingConnection(sqlite3.Connection):
+    """SQLite connection whose commits are retried with exponential backoff while the
+    database is locked. A failed COMMIT leaves the transaction open, so retrying it is safe.
+    """
+    def commit(self):
+        retries = app.config['XCESSIV_DB_COMMIT_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return super(_RetryingConnection, self).commit()
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == retries:
+                    raise
+                time.sleep(0.1 * 2 ** attempt)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+_engines = dict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(path):
+    """Returns the SQLAlchemy engine of a notebook database, creating it on first use.
+
+    Engines are cached per process, so the connection pool survives between sessions.
+    Connections use WAL journal mode, so readers do not block the writer, and wait for
+    locks to be released instead of failing right away. The notebook is migrated to the
+    current schema when its engine is created.
+
+    Args:
+        path (str, unicode): Path to notebook database file
+    """
+    key = (os.getpid(), path)  # Pooled connections must not be shared with forked workers
+    stat = os.stat(path)
+    file_id = (stat.st_dev, stat.st_ino)
+    with _engines_lock:
+        if key in _engines and _engines[key][1] != file_id:
+            # The notebook was deleted and created again. Drop connections to the old file.
+            _engines.pop(key)[0].dispose()
+        if key not in _engines:
+            engine = create_engine(
+                'sqlite:///{}'.format(path),
+                poolclass=QueuePool,
+                connect_args={'timeout': app.config['XCESSIV_DB_BUSY_TIMEOUT'],
+                              'factory': _RetryingConnection,
+                              'check_same_thread': False}
+            )
+            event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+            from xcessiv import models  # models imports this module
+            models.migrate_notebook(engine)
+            _engines[key] = (engine, file_id)
+        return _engines[key][0]
+
+
 class DBContextManager():
     """Use this context manager to automatically start and close a database session
 
@@ -310,10 +1005,7 @@ class DBContextManager():
     def __enter__(self):
         if not os.path.exists(self.path):
             raise exceptions.UserError('{} does not exist'.format(self.path))
-        sqlite_url = 'sqlite:///{}'.format(self.path)
-        engine = create_engine(sqlite_url)
-
-        self.session = Session(bind=engine)
+        self.session = Session(bind=get_engine(self.path))
 
         return self.session
 
@@ -0,0 +1,301 @@
+"""This module contains the built-in loaders for datasets stored in files
+
+A dataset file is described by a JSON specification instead of an extraction function::
+
+    {"path": "/data/train.csv", "format": "csv", "label_column": "target"}
+
+``format`` is one of ``csv``, ``npy`` or ``parquet``. ``label_column`` is the name or index
+of the column holding the labels. Every other column is a feature. For ``npy`` files, which
+must hold a 2-dimensional array, it is an index and defaults to the last column. CSV files
+are expected to start with a header row unless ``header`` is false.
+
+The first time a file is used, it is converted into memory-mappable .npy files. Later
+loads only check the size and modification time of the file and memory-map the converted
+arrays. If these changed, the file is hashed, and it is only converted again if its
+contents changed.
+"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+from contextlib import contextmanager
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from six import string_types
+from xcessiv import exceptions, functions
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, so conversions are not locked there
+    fcntl = None
+
+
+FILE_FORMATS = ('csv', 'npy', 'parquet')
+
+CHUNK_ROWS = 10000
+
+
+def validate_spec(spec):
+    """Raises :class:`xcessiv.exceptions.UserError` if a dataset file specification is
+    invalid"""
+    if not isinstance(spec, dict) or not spec.get('path'):
+        raise exceptions.UserError('Dataset file specification must contain a path')
+    if spec.get('format') not in FILE_FORMATS:
+        raise exceptions.UserError('Dataset file format must be one of {}'.format(
+            ', '.join(FILE_FORMATS)))
+    if spec['format'] != 'npy' and spec.get('label_column') is None:
+        raise exceptions.UserError('Dataset file specification must contain a label_column')
+
+
+def file_stat(file_path):
+    """Returns the size and modification time of a file, the cheap part of its
+    fingerprint"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        raise exceptions.UserError('Dataset file {} not found'.format(file_path))
+    return [stat.st_size, stat.st_mtime]
+
+
+def spec_key(spec):
+    """Returns the SHA256 hash identifying the converted layout of a dataset file"""
+    return functions.hash_string(json.dumps(
+        dict(spec, path=os.path.abspath(spec['path'])), sort_keys=True
+    ).encode('utf8'))
+
+
+def _labels_array(labels):
+    """Converts parsed labels to numbers if they all are, and to strings otherwise"""
+    try:
+        y = np.asarray(labels, dtype=float)
+    except ValueError:
+        return np.asarray(labels)
+    if np.all(np.mod(y, 1) == 0):
+        return y.astype(np.int64)
+    return y
+
+
+def _label_index(names, label_column):
+    if isinstance(label_column, string_types):
+        if label_column not in names:
+            raise exceptions.UserError('Label column {} not found'.format(label_column))
+        return names.index(label_column)
+    if not -len(names) <= label_column < len(names):
+        raise exceptions.UserError('Label column {} out of range'.format(label_column))
+    return label_column % len(names)
+
+
+def _convert_csv(spec, X_path, y_path):
+    header = spec.get('header', True)
+    with io.open(spec['path'], newline='') as f:
+        reader = csv.reader(f)
+        first_row = next(reader, None)
+        if first_row is None:
+            raise exceptions.UserError('Dataset file {} is empty'.format(spec['path']))
+        n_rows = sum(1 for row in reader if row) + (0 if header else 1)
+
+    names = first_row if header else list(range(len(first_row)))
+    label_index = _label_index(names, spec['label_column'])
+    feature_indices = [idx for idx in range(len(names)) if idx != label_index]
+
+    X = np.lib.format.open_memmap(X_path, mode='w+', dtype=np.float64,
+                                  shape=(n_rows, len(feature_indices)))
+    labels = []
+    with io.open(spec['path'], newline='') as f:
+        reader = csv.reader(f)
+        if header:
+            next(reader)
+        start = 0
+        chunk = []
+        for row in reader:
+            if row:
+                chunk.append(row)
+            if len(chunk) == CHUNK_ROWS:
+                start = _write_csv_chunk(X, labels, chunk, start, label_index, feature_indices)
+                chunk = []
+        if chunk:
+            _write_csv_chunk(X, labels, chunk, start, label_index, feature_indices)
+    X.flush()
+    del X
+    np.save(y_path, _labels_array(labels), allow_pickle=False)
+
+
+def _write_csv_chunk(X, labels, chunk, start, label_index, feature_indices):
+    try:
+        values = np.array(chunk)
+        X[start:start + len(chunk)] = values[:, feature_indices].astype(np.float64)
+    except (ValueError, IndexError) as e:
+        raise exceptions.UserError('Could not parse rows {} to {} of dataset file as '
+                                   'numbers'.format(start + 1, start + len(chunk)),
+                                   exception_message=str(e))
+    labels.extend(values[:, label_index].tolist())
+    return start + len(chunk)
+
+
+def _convert_npy(spec, X_path, y_path):
+    array = np.load(spec['path'], mmap_mode='r')
+    if array.ndim != 2:
+        raise exceptions.UserError('Dataset file must hold a 2-dimensional array')
+    label_index = _label_index(list(range(array.shape[1])), spec.get('label_column', -1))
+    feature_indices = [idx for idx in range(array.shape[1]) if idx != label_index]
+
+    X = np.lib.format.open_memmap(X_path, mode='w+', dtype=array.dtype,
+                                  shape=(array.shape[0], len(feature_indices)))
+    for start in range(0, array.shape[0], CHUNK_ROWS):
+        X[start:start + CHUNK_ROWS] = array[start:start + CHUNK_ROWS][:, feature_indices]
+    X.flush()
+    del X
+    np.save(y_path, np.array(array[:, label_index]), allow_pickle=False)
+
+
+def _convert_parquet(spec, X_path, y_path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise exceptions.UserError('Reading Parquet files requires pyarrow')
+    parquet_file = pq.ParquetFile(spec['path'])
+    names = list(parquet_file.schema.names)
+    label_name = names[_label_index(names, spec['label_column'])]
+    feature_names = [name for name in names if name != label_name]
+
+    X = np.lib.format.open_memmap(X_path, mode='w+', dtype=np.float64,
+                                  shape=(parquet_file.metadata.num_rows, len(feature_names)))
+    labels = []
+    start = 0
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(row_group)
+        for column, name in enumerate(feature_names):
+            X[start:start + table.num_rows, column] = table.column(name).to_numpy()
+        labels.append(table.column(label_name).to_numpy())
+        start += table.num_rows
+    X.flush()
+    del X
+    np.save(y_path, np.concatenate(labels) if labels else np.empty(0), allow_pickle=False)
+
+
+_CONVERTERS = {
+    'csv': _convert_csv,
+    'npy': _convert_npy,
+    'parquet': _convert_parquet
+}
+
+
+@contextmanager
+def _lock(lock_path):
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_dataset_file(spec):
+    """Reads a dataset file into memory without converting it
+
+    Args:
+        spec (dict): Dataset file specification
+
+    Returns:
+        X (numpy.ndarray): Features
+
+        y (numpy.ndarray): Labels
+    """
+    validate_spec(spec)
+    file_stat(spec['path'])
+    folder = tempfile.mkdtemp()
+    try:
+        X_path, y_path = os.path.join(folder, 'X.npy'), os.path.join(folder, 'y.npy')
+        _CONVERTERS[spec['format']](spec, X_path, y_path)
+        return np.load(X_path), np.load(y_path)
+    finally:
+        shutil.rmtree(folder)
+
+
+def load_dataset_file(spec, converted_folder):
+    """Returns the dataset stored in a file as memory-mapped arrays, converting the file
+    first if it was never converted or its contents changed
+
+    Args:
+        spec (dict): Dataset file specification
+
+        converted_folder (str, unicode): Folder holding the converted dataset files
+
+    Returns:
+        X (numpy.memmap): Features
+
+        y (numpy.memmap): Labels
+    """
+    validate_spec(spec)
+    stat = file_stat(spec['path'])
+    if not os.path.exists(converted_folder):
+        try:
+            os.makedirs(converted_folder)
+        except OSError:  # Another worker might have created it first
+            if not os.path.isdir(converted_folder):
+                raise
+
+    key = spec_key(spec)
+    folder = os.path.join(converted_folder, key)
+    stamp_path = os.path.join(folder, 'stamp.json')
+    with _lock(os.path.join(converted_folder, key + '.lock')):
+        stamp = None
+        if os.path.exists(stamp_path):
+            with open(stamp_path) as f:
+                stamp = json.load(f)
+
+        if stamp is None or [stamp['size'], stamp['mtime']] != stat:
+            sha256 = functions.hash_file(spec['path'])
+            if stamp is None or stamp['sha256'] != sha256:
+                temp_folder = '{}.tmp-{}'.format(folder, os.getpid())
+                if os.path.exists(temp_folder):
+                    shutil.rmtree(temp_folder)
+                os.makedirs(temp_folder)
+                try:
+                    _CONVERTERS[spec['format']](spec, os.path.join(temp_folder, 'X.npy'),
+                                                os.path.join(temp_folder, 'y.npy'))
+                except:
+                    shutil.rmtree(temp_folder)
+                    raise
+                if os.path.exists(folder):
+                    shutil.rmtree(folder)
+                os.rename(temp_folder, folder)
+
+            # Contents are unchanged or were just converted, so remember the new stat
+            temp_path = '{}.tmp-{}'.format(stamp_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(dict(size=stat[0], mtime=stat[1], sha256=sha256), f)
+            os.rename(temp_path, stamp_path)
+
+        return (np.load(os.path.join(folder, 'X.npy'), mmap_mode='r'),
+                np.load(os.path.join(folder, 'y.npy'), mmap_mode='r'))
+
+
+def load_converted_dataset_file(spec, converted_folder):
+    """Returns the converted arrays of a dataset file like :func:`load_dataset_file` if the
+    file did not change since it was last converted, and None otherwise. The file is never
+    converted or hashed.
+
+    Args:
+        spec (dict): Dataset file specification
+
+        converted_folder (str, unicode): Folder holding the converted dataset files
+
+    Returns:
+        dataset (tuple or None): Tuple (X, y) of memory-mapped arrays or None
+    """
+    validate_spec(spec)
+    folder = os.path.join(converted_folder, spec_key(spec))
+    try:
+        with open(os.path.join(folder, 'stamp.json')) as f:
+            stamp = json.load(f)
+        if [stamp['size'], stamp['mtime']] != file_stat(spec['path']):
+            return None
+        return (np.load(os.path.join(folder, 'X.npy'), mmap_mode='r'),
+                np.load(os.path.join(folder, 'y.npy'), mmap_mode='r'))
+    except (IOError, OSError, ValueError):  # Not converted, or being converted again
+        return None
@@ -0,0 +1,337 @@
+"""This module contains the columnar store for the meta-features of base learners"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+from contextlib import contextmanager
+import json
+import os
+import numpy as np
+from six import iteritems
+from xcessiv import app, exceptions
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, so the store is not locked there
+    fcntl = None
+
+
+def _fits_matrix(meta_features):
+    """Returns True if float64 represents every value of ``meta_features`` exactly"""
+    kind = meta_features.dtype.kind
+    if kind == 'b':
+        return True
+    if kind == 'f':
+        return meta_features.dtype.itemsize <= 8
+    if kind in 'iu':
+        return not meta_features.size or \
+            max(abs(int(meta_features.min())), abs(int(meta_features.max()))) <= 2 ** 53
+    return False
+
+
+def _entry_dtype(entry):
+    """Returns the data type of the meta-features of a column index entry. Entries written
+    by earlier versions of Xcessiv do not record one and are float64."""
+    return np.dtype(entry[3]) if len(entry) > 3 else np.dtype(np.float64)
+
+
+class MetaFeatureStore(object):
+    """Stores the meta-features of every base learner of a notebook in a single matrix
+
+    The matrix is a preallocated, memory-mapped .npy file in Fortran order, so the
+    meta-features of a base learner occupy a contiguous block of columns. A JSON index maps
+    each base learner ID to its column range and the data type of its meta-features.
+    Building the secondary features of a stacked ensemble is therefore a single column
+    gather on the memory map instead of one file load per base learner.
+
+    Meta-features float64 cannot represent exactly, such as string class labels, are kept
+    in a .npy file of their own instead.
+
+    Writers hold an exclusive file lock. Growing and compacting the matrix write a new file
+    and atomically rename it over the old one, so readers that still have the old file
+    mapped keep seeing consistent data.
+
+    Args:
+        folder (str, unicode): Folder in which to keep the store files
+
+        name (str, unicode, optional): Name of the store. Allows several independent stores
+            in the same folder.
+    """
+    initial_capacity = 64
+
+    def __init__(self, folder, name='store'):
+        self.folder = folder
+        self.name = name
+        self.matrix_path = os.path.join(folder, name + '.npy')
+        self.index_path = os.path.join(folder, name + '-index.json')
+        self.lock_path = os.path.join(folder, name + '.lock')
+
+    @classmethod
+    def from_notebook(cls, path, name='store'):
+        """Returns the meta-feature store of an Xcessiv notebook
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+
+            name (str, unicode, optional): Name of the store
+        """
+        return cls(os.path.join(path, app.config['XCESSIV_META_FEATURES_FOLDER']), name)
+
+    @contextmanager
+    def _lock(self, exclusive):
+        if not os.path.exists(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:  # Another worker might have created it first
+                if not os.path.isdir(self.folder):
+                    raise
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return dict(n_rows=None, capacity=0, used=0, columns=dict(), files=dict())
+        with open(self.index_path) as f:
+            index = json.load(f)
+        index.setdefault('files', dict())
+        return index
+
+    def _write_index(self, index):
+        temp_path = '{}.tmp-{}'.format(self.index_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.rename(temp_path, self.index_path)
+
+    def _open_matrix(self, mode='r+'):
+        return np.load(self.matrix_path, mmap_mode=mode)
+
+    def _file_path(self, learner_id):
+        return os.path.join(self.folder, '{}-{}.npy'.format(self.name, learner_id))
+
+    def _remove_file(self, learner_id):
+        if os.path.exists(self._file_path(learner_id)):
+            os.remove(self._file_path(learner_id))
+
+    def _rewrite_matrix(self, index, capacity, column_ranges):
+        """Writes a new matrix with ``capacity`` columns containing ``column_ranges`` of
+        the current matrix packed side by side, and swaps it in.
+
+        Returns:
+            new_ranges (list): Column ranges of the copied blocks in the new matrix
+        """
+        temp_path = '{}.tmp-{}'.format(self.matrix_path, os.getpid())
+        new_matrix = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float64,
+                                               shape=(index['n_rows'], capacity),
+                                               fortran_order=True)
+        new_ranges = []
+        position = 0
+        if column_ranges:
+            old_matrix = self._open_matrix('r')
+            for start, stop in column_ranges:
+                width = stop - start
+                new_matrix[:, position:position + width] = old_matrix[:, start:stop]
+                new_ranges.append((position, position + width))
+                position += width
+            del old_matrix
+        new_matrix.flush()
+        del new_matrix
+        os.rename(temp_path, self.matrix_path)
+        index['capacity'] = capacity
+        return new_ranges
+
+    def __contains__(self, learner_id):
+        with self._lock(exclusive=False):
+            index = self._read_index()
+        return str(learner_id) in index['columns'] or str(learner_id) in index['files']
+
+    def append(self, learner_id, meta_features):
+        """Stores the meta-features of a base learner, replacing any previous ones
+
+        Args:
+            learner_id (int): ID of base learner
+
+            meta_features (array-like): Array of shape (n_rows,) or (n_rows, n_columns)
+
+        Raises:
+            exceptions.UserError: If the number of rows differs from the meta-features
+                already in the store
+        """
+        meta_features = np.asarray(meta_features)
+        ndim = meta_features.ndim
+        if ndim == 1:
+            meta_features = meta_features.reshape(-1, 1)
+        width = meta_features.shape[1]
+
+        with self._lock(exclusive=True):
+            index = self._read_index()
+            index['columns'].pop(str(learner_id), None)
+            had_file = index['files'].pop(str(learner_id), None) is not None
+
+            if not index['columns'] and not index['files']:
+                # Empty store, start over with the new shape
+                index = dict(n_rows=meta_features.shape[0], capacity=0, used=0,
+                             columns=dict(), files=dict())
+            elif index['n_rows'] != meta_features.shape[0]:
+                raise exceptions.UserError('Meta-features have {} rows but the meta-feature '
+                                           'store has {} rows'.format(meta_features.shape[0],
+                                                                      index['n_rows']))
+
+            if not _fits_matrix(meta_features):
+                file_path = self._file_path(learner_id)
+                temp_path = '{}.tmp-{}.npy'.format(file_path[:-len('.npy')], os.getpid())
+                np.save(temp_path, meta_features.reshape(-1) if ndim == 1 else meta_features)
+                os.rename(temp_path, file_path)
+                index['files'][str(learner_id)] = [width, ndim]
+                self._write_index(index)
+                return
+
+            if index['used'] + width > index['capacity']:
+                capacity = max(self.initial_capacity, index['capacity'])
+                while index['used'] + width > capacity:
+                    capacity *= 2
+                self._rewrite_matrix(index, capacity, [(0, index['used'])]
+                                     if index['used'] else [])
+
+            matrix = self._open_matrix('r+')
+            matrix[:, index['used']:index['used'] + width] = meta_features
+            matrix.flush()
+            del matrix
+
+            index['columns'][str(learner_id)] = [index['used'], index['used'] + width, ndim,
+                                                 meta_features.dtype.str]
+            index['used'] += width
+            self._write_index(index)
+            if had_file:
+                self._remove_file(learner_id)
+
+    def delete(self, learner_id):
+        """Removes the meta-features of a base learner from the store. The matrix is
+        compacted once more than half of its used columns are unreferenced.
+
+        Args:
+            learner_id (int): ID of base learner
+        """
+        with self._lock(exclusive=True):
+            index = self._read_index()
+            if index['files'].pop(str(learner_id), None) is not None:
+                self._write_index(index)
+                self._remove_file(learner_id)
+                return
+            if index['columns'].pop(str(learner_id), None) is None:
+                return
+            live = sum(entry[1] - entry[0] for entry in index['columns'].values())
+            if index['used'] - live > live:
+                self._compact(index)
+            else:
+                self._write_index(index)
+
+    def compact(self):
+        """Rewrites the matrix without the columns of deleted base learners"""
+        with self._lock(exclusive=True):
+            self._compact(self._read_index())
+
+    def _compact(self, index):
+        if not index['columns']:
+            if os.path.exists(self.matrix_path):
+                os.remove(self.matrix_path)
+            self._write_index(dict(n_rows=index['n_rows'] if index['files'] else None,
+                                   capacity=0, used=0, columns=dict(), files=index['files']))
+            return
+
+        items = sorted(iteritems(index['columns']), key=lambda item: item[1][0])
+        live = sum(entry[1] - entry[0] for key, entry in items)
+        new_ranges = self._rewrite_matrix(
+            index,
+            max(self.initial_capacity, live),
+            [(entry[0], entry[1]) for key, entry in items]
+        )
+        for (key, entry), (new_start, new_stop) in zip(items, new_ranges):
+            index['columns'][key] = [new_start, new_stop] + entry[2:]
+        index['used'] = live
+        self._write_index(index)
+
+    def gather(self, learner_ids):
+        """Returns the meta-features of several base learners side by side
+
+        Args:
+            learner_ids (list): IDs of base learners in the order their columns should
+                appear in
+
+        Returns:
+            secondary_features (numpy.ndarray): Array of shape (n_rows, total_columns)
+
+        Raises:
+            exceptions.UserError: If a base learner has no meta-features in the store
+        """
+        with self._lock(exclusive=False):
+            index = self._read_index()
+            self._check_found(index, learner_ids)
+            if any(str(learner_id) in index['files'] for learner_id in learner_ids):
+                blocks = [self._get(index, learner_id) for learner_id in learner_ids]
+                return np.concatenate([block.reshape(len(block), -1) for block in blocks],
+                                      axis=1)
+            if learner_ids:
+                matrix = self._open_matrix('r')
+
+        if not learner_ids:
+            return np.empty((index['n_rows'] or 0, 0))
+        entries = [index['columns'][str(learner_id)] for learner_id in learner_ids]
+        secondary_features = matrix[:, np.concatenate([np.arange(entry[0], entry[1])
+                                                       for entry in entries])]
+        dtype = np.result_type(*[_entry_dtype(entry) for entry in entries])
+        if dtype != secondary_features.dtype:
+            secondary_features = secondary_features.astype(dtype)
+        return secondary_features
+
+    def widths(self, learner_ids):
+        """Returns the number of columns occupied by each of the given base learners
+
+        Args:
+            learner_ids (list): IDs of base learners
+        """
+        with self._lock(exclusive=False):
+            index = self._read_index()
+        self._check_found(index, learner_ids)
+        widths = []
+        for learner_id in learner_ids:
+            if str(learner_id) in index['files']:
+                widths.append(index['files'][str(learner_id)][0])
+            else:
+                start, stop = index['columns'][str(learner_id)][:2]
+                widths.append(stop - start)
+        return widths
+
+    def get(self, learner_id):
+        """Returns the meta-features of a single base learner with their original number
+        of dimensions and data type
+
+        Args:
+            learner_id (int): ID of base learner
+        """
+        with self._lock(exclusive=False):
+            index = self._read_index()
+            self._check_found(index, [learner_id])
+            return self._get(index, learner_id)
+
+    @staticmethod
+    def _check_found(index, learner_ids):
+        for learner_id in learner_ids:
+            if str(learner_id) not in index['columns'] and \
+                    str(learner_id) not in index['files']:
+                raise exceptions.UserError('Meta-features of base learner {} '
+                                           'not found'.format(learner_id))
+
+    def _get(self, index, learner_id):
+        """Reads the meta-features of a base learner. Must be called holding the lock."""
+        if str(learner_id) in index['files']:
+            return np.load(self._file_path(learner_id), allow_pickle=True)
+
+        start, stop, ndim = index['columns'][str(learner_id)][:3]
+        meta_features = np.array(self._open_matrix('r')[:, start:stop],
+                                 dtype=_entry_dtype(index['columns'][str(learner_id)]))
+        if ndim == 1:
+            meta_features = meta_features.ravel()
+        return meta_features
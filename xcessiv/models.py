@@ -4,16 +4,22 @@ import random
 import string
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Text, Integer, Boolean, TypeDecorator, ForeignKey, Table, UniqueConstraint
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext import mutable
 import numpy as np
 import json
 import os
+import shutil
+from six import iteritems
 from sklearn.model_selection import train_test_split
 from xcessiv import constants
 from xcessiv import exceptions
 from xcessiv import functions
+from xcessiv import loaders
+from xcessiv import workercache
 from xcessiv import app
+from xcessiv.metafeaturestore import MetaFeatureStore
 
 
 Base = declarative_base()
@@ -45,6 +51,13 @@ class JsonEncodedList(TypeDecorator):
 mutable.MutableDict.associate_with(JsonEncodedDict)
 
 
+def hash_json(value):
+    """Returns the SHA256 hash of the canonical JSON encoding of ``value``. This is the same
+    encoding used by :class:`JsonEncodedDict` and :class:`JsonEncodedList`, so equal hashes
+    mean equal stored values."""
+    return functions.hash_string(json.dumps(value, sort_keys=True).encode('utf8'))
+
+
 class Extraction(Base):
     """This table's columns are text columns representing JSON data of how
     to extract the train and test datasets, base learner cross-validation method,
@@ -67,14 +80,21 @@ class Extraction(Base):
         self.stacked_ensemble_cv = constants.DEFAULT_EXTRACTION_META_FEATURE_GENERATION
         self.data_statistics = None
 
-    def return_main_dataset(self):
+    def return_main_dataset(self, path=None):
         """Returns main data set from self
 
+        Args:
+            path (str, unicode, optional): Path to Xcessiv notebook. If given and the main
+                dataset is a file, its converted copy in the dataset cache is used.
+
         Returns:
             X (numpy.ndarray): Features
 
             y (numpy.ndarray): Labels
         """
+        if self.main_dataset.get('file'):
+            return self._return_dataset_file(self.main_dataset['file'], path)
+
         if not self.main_dataset['source']:
             raise exceptions.UserError('Source is empty')
 
@@ -87,49 +107,116 @@ class Extraction(Base):
         except Exception as e:
             raise exceptions.UserError('User code exception', exception_message=str(e))
 
-        X, y = np.array(X), np.array(y)
+        # Arrays, memory maps and sparse matrices are used as they are instead of being copied
+        X, y = functions.as_feature_array(X), np.asarray(y)
 
         return X, y
 
-    def return_train_dataset(self):
+    def _return_dataset_file(self, spec, path=None):
+        """Returns a dataset stored in a file described by ``spec``
+
+        Args:
+            spec (dict): Dataset file specification, see :mod:`xcessiv.loaders`
+
+            path (str, unicode, optional): Path to Xcessiv notebook. If given, the file is
+                converted once into the dataset cache and memory-mapped from there.
+
+        Returns:
+            X (numpy.ndarray): Features
+
+            y (numpy.ndarray): Labels
+        """
+        if path is None:
+            return loaders.read_dataset_file(spec)
+        return loaders.load_dataset_file(spec, self.dataset_files_path(path))
+
+    def dataset_file_specs(self):
+        """Returns the specifications of the dataset files used by this extraction"""
+        specs = []
+        if self.main_dataset.get('file'):
+            specs.append(self.main_dataset['file'])
+        if self.test_dataset['method'] == 'file':
+            specs.append(self.test_dataset.get('file'))
+        return specs
+
+    def _split_indices(self, y):
+        """Returns the train and test row indices of the main dataset for the split settings.
+        These are the rows :func:`sklearn.model_selection.train_test_split` would pick.
+
+        Args:
+            y (numpy.ndarray): Labels of the main dataset
+
+        Returns:
+            train_index (numpy.ndarray): Rows of the train dataset
+
+            test_index (numpy.ndarray): Rows of the test dataset
+        """
+        return train_test_split(
+            np.arange(len(y)),
+            test_size=self.test_dataset['split_ratio'],
+            random_state=self.test_dataset['split_seed'],
+            stratify=y
+        )
+
+    def _split_main_dataset(self, path=None):
+        """Splits the main dataset into train and test datasets using the split settings
+
+        Args:
+            path (str, unicode, optional): Path to Xcessiv notebook, see
+                :meth:`return_main_dataset`
+
+        Returns:
+            X (numpy.ndarray): Train features
+
+            X_test (numpy.ndarray): Test features
+
+            y (numpy.ndarray): Train labels
+
+            y_test (numpy.ndarray): Test labels
+        """
+        X, y = self.return_main_dataset(path)
+        train_index, test_index = self._split_indices(y)
+        return X[train_index], X[test_index], y[train_index], y[test_index]
+
+    def return_train_dataset(self, path=None):
         """Returns train data set
 
+        Args:
+            path (str, unicode, optional): Path to Xcessiv notebook. If given, the dataset
+                is loaded from (and stored in) the notebook's dataset cache.
+
         Returns:
             X (numpy.ndarray): Features
 
             y (numpy.ndarray): Labels
         """
-        X, y = self.return_main_dataset()
+        if path is not None:
+            return self._return_resident_dataset(path, 'train')
 
         if self.test_dataset['method'] == 'split_from_main':
-            X, X_test, y, y_test = train_test_split(
-                X,
-                y,
-                test_size=self.test_dataset['split_ratio'],
-                random_state=self.test_dataset['split_seed'],
-                stratify=y
-            )
+            X, X_test, y, y_test = self._split_main_dataset()
+            return X, y
 
-        return X, y
+        return self.return_main_dataset()
 
-    def return_test_dataset(self):
+    def return_test_dataset(self, path=None):
         """Returns test data set
 
+        Args:
+            path (str, unicode, optional): Path to Xcessiv notebook. If given, the dataset
+                is loaded from (and stored in) the notebook's dataset cache.
+
         Returns:
             X (numpy.ndarray): Features
 
             y (numpy.ndarray): Labels
         """
-        if self.test_dataset['method'] == 'split_from_main':
-            X, y = self.return_main_dataset()
-            X, X_test, y, y_test = train_test_split(
-                X,
-                y,
-                test_size=self.test_dataset['split_ratio'],
-                random_state=self.test_dataset['split_seed'],
-                stratify=y
-            )
+        if path is not None and \
+                self.test_dataset['method'] in ('split_from_main', 'source', 'file'):
+            return self._return_resident_dataset(path, 'test')
 
+        if self.test_dataset['method'] == 'split_from_main':
+            X, X_test, y, y_test = self._split_main_dataset()
             return X_test, y_test
 
         if self.test_dataset['method'] == 'source':
@@ -141,7 +228,363 @@ class Extraction(Base):
                 import_object_from_string_code(extraction_code, "extract_test_dataset")
             X_test, y_test = extraction_function()
 
-            return np.array(X_test), np.array(y_test)
+            return functions.as_feature_array(X_test), np.asarray(y_test)
+
+        if self.test_dataset['method'] == 'file':
+            return self._return_dataset_file(self.test_dataset.get('file'))
+
+    def return_base_learner_splits(self, path):
+        """Returns the base learner cross-validation splits of the train dataset. They are
+        saved in the dataset cache the first time.
+
+        Args:
+            path (str, unicode): Path to Xcessiv notebook
+
+        Returns:
+            splits (list): List of (train_index, test_index) pairs
+        """
+        def return_splits():
+            folder = self.base_learner_splits_path(path)
+            splits = functions.load_splits(folder)
+            if splits is None:
+                X, y = self.return_train_dataset(path)
+                return_splits_iterable = functions.import_object_from_string_code(
+                    self.meta_feature_generation['source'],
+                    'return_splits_iterable'
+                )
+                splits = list(return_splits_iterable(X, y))
+                if not os.path.exists(folder):
+                    try:
+                        os.makedirs(folder)
+                    except OSError:  # Another worker might have created it first
+                        if not os.path.isdir(folder):
+                            raise
+                functions.save_splits(folder, splits)
+            return splits
+
+        return self._return_resident(path, self.resident_splits_name(), return_splits)
+
+    def base_learner_splits_path(self, path):
+        """Returns path of the folder holding the saved base learner cross-validation
+        splits for the current dataset and base learner cross-validation settings
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(self.dataset_cache_path(path), self.resident_splits_name())
+
+    def return_out_of_fold_targets(self, path=None):
+        """Returns the train labels in the order of the out-of-fold meta-features i.e.
+        the concatenated test folds of the base learner cross-validation
+
+        If ``path`` is given, the labels are read from the copy saved next to the
+        meta-features, so the dataset is only extracted the first time.
+
+        Args:
+            path (str, unicode, optional): Path to Xcessiv notebook used for the cache
+
+        Returns:
+            y (numpy.ndarray): Labels
+        """
+        if path is not None:
+            targets = functions.load_dataset_from_cache(self.out_of_fold_targets_path(path),
+                                                        self.out_of_fold_targets_key())
+            if targets is not None:
+                return targets[1]
+
+        X, y = self.return_train_dataset(path)
+        return_splits_iterable = functions.import_object_from_string_code(
+            self.meta_feature_generation['source'],
+            'return_splits_iterable'
+        )
+        indices = np.concatenate([test_index for train_index, test_index
+                                  in return_splits_iterable(X, y)])
+        if path is not None:
+            self.save_out_of_fold_targets(path, indices, y[indices])
+        return y[indices]
+
+    def out_of_fold_targets_key(self):
+        """Returns the SHA256 hash identifying the out-of-fold row order i.e. the datasets
+        and the base learner cross-validation"""
+        return functions.hash_string(json.dumps(
+            {'dataset': self.dataset_cache_key(),
+             'meta_feature_generation': self.meta_feature_generation['source']},
+            sort_keys=True
+        ).encode('utf8'))
+
+    def out_of_fold_targets_path(self, path):
+        """Returns path of the folder holding the saved out-of-fold row orders
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(path, app.config['XCESSIV_META_FEATURES_FOLDER'], 'out-of-fold')
+
+    def save_out_of_fold_targets(self, path, indices, y_true):
+        """Saves the out-of-fold row order of the current settings, unless it is saved
+        already. The test indices are stored as the "X" and the labels as the "y" of a
+        cached dataset.
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+
+            indices (numpy.ndarray): Concatenated test indices of the cross-validation
+
+            y_true (numpy.ndarray): Train labels ordered by ``indices``
+        """
+        folder = self.out_of_fold_targets_path(path)
+        key = self.out_of_fold_targets_key()
+        if functions.load_dataset_from_cache(folder, key) is None:
+            functions.save_dataset_to_cache(folder, key, indices, y_true)
+
+    def fold_layout_path(self, path):
+        """Returns path of the folder holding the train dataset in fold order for the
+        current dataset and base learner cross-validation settings
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(self.dataset_cache_path(path),
+                            'folds-' + self.out_of_fold_targets_key())
+
+    def return_fold_layout(self, path, splits):
+        """Returns the train dataset with its rows permuted into fold order, so every test
+        fold of ``splits`` is a contiguous block of rows. The permuted dataset is saved
+        in the dataset cache the first time, and memory-mapped afterwards.
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+
+            splits (list): Base learner cross-validation splits of the train dataset
+
+        Returns:
+            layout (tuple or None): Tuple (X, y, contiguous_splits) where
+                ``contiguous_splits`` are ``splits`` mapped onto the permuted rows, or None
+                if the splits do not partition the dataset or it cannot be cached.
+        """
+        X, y = self.return_train_dataset(path)
+        layout = functions.contiguous_fold_layout(splits, len(y))
+        if layout is None:
+            return None
+        order, contiguous_splits = layout
+
+        folder = self.fold_layout_path(path)
+        name = functions.hash_string(np.ascontiguousarray(order, dtype=np.int64).tobytes())
+        dataset = functions.load_dataset_from_cache(folder, name)
+        if dataset is None:
+            if not functions.save_dataset_to_cache(folder, name, X, y, order):
+                return None
+            dataset = functions.load_dataset_from_cache(folder, name)
+        return dataset + (contiguous_splits,)
+
+    def dataset_cache_key(self):
+        """Returns the SHA256 hash identifying the datasets produced by this extraction
+        i.e. the main and test dataset extraction source and split settings, plus the size
+        and modification time of the dataset files used"""
+        key = {'main_dataset': self.main_dataset, 'test_dataset': self.test_dataset}
+        specs = self.dataset_file_specs()
+        for spec in specs:
+            loaders.validate_spec(spec)
+        if specs:
+            key['files'] = [loaders.file_stat(spec['path']) for spec in specs]
+        return functions.hash_string(json.dumps(key, sort_keys=True).encode('utf8'))
+
+    def dataset_cache_path(self, path):
+        """Returns path of the dataset cache folder for the current extraction settings
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(
+            path,
+            app.config['XCESSIV_DATASET_CACHE_FOLDER'],
+            self.dataset_cache_key()
+        )
+
+    def dataset_files_path(self, path):
+        """Returns path of the folder holding the converted dataset files
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(path, app.config['XCESSIV_DATASET_CACHE_FOLDER'], 'files')
+
+    def _return_cached_dataset(self, path, name):
+        """Returns dataset ``name`` from the dataset cache, extracting and storing it
+        first if it is not yet cached.
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+
+            name (str, unicode): Either "train" or "test"
+
+        Returns:
+            X (numpy.ndarray): Features, memory-mapped if the dataset could be cached
+
+            y (numpy.ndarray): Labels, memory-mapped if the dataset could be cached
+        """
+        # Converted dataset files are memory-mapped already, so they are not copied again
+        if name == 'test' and self.test_dataset['method'] == 'file':
+            return self._return_dataset_file(self.test_dataset.get('file'), path)
+        if name == 'train' and self.test_dataset['method'] != 'split_from_main' and \
+                self.main_dataset.get('file'):
+            return self.return_main_dataset(path)
+
+        cache_path = self.dataset_cache_path(path)
+        dataset = functions.load_dataset_from_cache(cache_path, name)
+        if dataset is not None:
+            return dataset
+
+        if self.test_dataset['method'] == 'split_from_main':
+            # Both datasets come out of the same split so store them together. Rows are
+            # copied straight from the main dataset into the cache files.
+            X, y = self.return_main_dataset(path)
+            train_index, test_index = self._split_indices(y)
+            datasets = {'train': (X, y, train_index), 'test': (X, y, test_index)}
+        elif name == 'train':
+            datasets = {'train': self.return_train_dataset() + (None,)}
+        else:
+            datasets = {'test': self.return_test_dataset() + (None,)}
+
+        cached = True
+        for key, (X, y, indices) in iteritems(datasets):
+            cached = functions.save_dataset_to_cache(cache_path, key, X, y, indices) and cached
+
+        if not cached:
+            X, y, indices = datasets[name]
+            if indices is None:
+                return X, y
+            return X[indices], y[indices]
+        return functions.load_dataset_from_cache(cache_path, name)
+
+    def resident_splits_name(self):
+        """Returns the name under which the base learner cross-validation splits are kept in
+        the worker cache"""
+        return 'splits-' + functions.hash_string(
+            self.meta_feature_generation['source'].encode('utf8'))
+
+    def _return_resident(self, path, name, load):
+        """Returns the value ``name`` of the notebook from the worker cache, see
+        :mod:`xcessiv.workercache`, or calls ``load`` to get it if it is not cached.
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+
+            name (str, unicode): Name of the value e.g. "train", "test"
+
+            load (callable): Returns the value
+        """
+        cache = workercache.get_cache()
+        if cache is None:
+            return load()
+
+        key = (os.path.abspath(path), self.dataset_cache_key(), name)
+        value = cache.get(key)
+        if value is None:
+            value = load()
+            # Only the worker's main process keeps values, see ResidentCache.put
+            if os.getpid() == cache.pid and workercache.nbytes(value) <= cache.max_bytes:
+                value = workercache.load_into_memory(value)
+                cache.put(key, value)
+        return value
+
+    def _return_resident_dataset(self, path, name):
+        """Returns dataset ``name`` from the worker cache or else from the dataset cache"""
+        return self._return_resident(path, name,
+                                     lambda: self._return_cached_dataset(path, name))
+
+    def _load_cached_dataset(self, path, name):
+        """Returns dataset ``name`` if the dataset cache or the converted dataset files hold
+        it already, and None otherwise. Nothing is extracted or converted."""
+        if name == 'test' and self.test_dataset['method'] == 'file':
+            return loaders.load_converted_dataset_file(self.test_dataset.get('file'),
+                                                       self.dataset_files_path(path))
+        if name == 'train' and self.test_dataset['method'] != 'split_from_main' and \
+                self.main_dataset.get('file'):
+            return loaders.load_converted_dataset_file(self.main_dataset['file'],
+                                                       self.dataset_files_path(path))
+        return functions.load_dataset_from_cache(self.dataset_cache_path(path), name)
+
+    def preload_resident(self, path):
+        """Loads the datasets and base learner cross-validation splits of the notebook into
+        the worker cache, and removes values of outdated extraction settings from it
+
+        Only values already saved on disk, in the dataset cache or as converted dataset
+        files, are loaded. No user code runs and nothing is converted, as this happens in
+        the worker's main process. Values that are not saved yet are skipped and left to
+        the job.
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        cache = workercache.get_cache()
+        if cache is None:
+            return
+        path = os.path.abspath(path)
+        dataset_key = self.dataset_cache_key()
+        loads = [('train', lambda: self._load_cached_dataset(path, 'train')),
+                 (self.resident_splits_name(),
+                  lambda: functions.load_splits(self.base_learner_splits_path(path)))]
+        if self.test_dataset['method'] in ('split_from_main', 'source', 'file'):
+            loads.append(('test', lambda: self._load_cached_dataset(path, 'test')))
+        cache.retain(path, [(path, dataset_key, name) for name, load in loads])
+
+        for name, load in loads:
+            key = (path, dataset_key, name)
+            if key in cache:
+                continue
+            value = load()
+            if value is not None and workercache.nbytes(value) <= cache.max_bytes:
+                cache.put(key, workercache.load_into_memory(value))
+
+    def cleanup_dataset_cache(self, path):
+        """Removes cached datasets, converted dataset files, saved cross-validation splits
+        and saved out-of-fold row orders that do not belong to the current extraction
+        settings
+
+        Args:
+            path (str, unicode): Absolute/local path of xcessiv folder
+        """
+        try:
+            current_key = self.dataset_cache_key()
+        except exceptions.UserError:  # A dataset file is missing or misspecified
+            current_key = None
+
+        cache_folder = os.path.join(path, app.config['XCESSIV_DATASET_CACHE_FOLDER'])
+        if os.path.isdir(cache_folder):
+            for key in os.listdir(cache_folder):
+                if key not in (current_key, 'files'):
+                    shutil.rmtree(os.path.join(cache_folder, key), ignore_errors=True)
+
+            # Fold layouts and splits depend on the base learner cross-validation as well
+            cache_path = self.dataset_cache_path(path) if current_key is not None else None
+            if cache_path is not None and os.path.isdir(cache_path):
+                current_folders = (os.path.basename(self.fold_layout_path(path)),
+                                   self.resident_splits_name())
+                for filename in os.listdir(cache_path):
+                    if filename.startswith(('folds-', 'splits-')) and \
+                            filename not in current_folders:
+                        shutil.rmtree(os.path.join(cache_path, filename), ignore_errors=True)
+
+            files_folder = self.dataset_files_path(path)
+            if os.path.isdir(files_folder):
+                current_keys = [loaders.spec_key(spec) for spec in self.dataset_file_specs()
+                                if isinstance(spec, dict) and spec.get('path')]
+                for filename in os.listdir(files_folder):
+                    if filename.split('.')[0] in current_keys:
+                        continue
+                    file_path = os.path.join(files_folder, filename)
+                    if os.path.isdir(file_path):
+                        shutil.rmtree(file_path, ignore_errors=True)
+                    else:
+                        os.remove(file_path)
+
+        targets_folder = self.out_of_fold_targets_path(path)
+        if os.path.isdir(targets_folder) and current_key is not None:
+            current_key = self.out_of_fold_targets_key()
+            for filename in os.listdir(targets_folder):
+                if not filename.startswith(current_key):
+                    os.remove(os.path.join(targets_folder, filename))
 
 
 class BaseLearnerOrigin(Base):
@@ -196,7 +639,8 @@ class BaseLearnerOrigin(Base):
             est (estimator): Estimator object
         """
         extraction_code = self.source
-        estimator = functions.import_object_from_string_code(extraction_code, "base_learner")
+        estimator = functions.import_object_from_string_code(extraction_code, "base_learner",
+                                                             fresh=True)
 
         return estimator
 
@@ -280,6 +724,7 @@ class BaseLearner(Base):
 
     id = Column(Integer, primary_key=True)
     hyperparameters = Column(JsonEncodedDict)
+    hyperparameters_hash = Column(Text, index=True)
     individual_score = Column(JsonEncodedDict)
     meta_features_exists = Column(Boolean)
     job_status = Column(Text)
@@ -297,6 +742,7 @@ class BaseLearner(Base):
 
     def __init__(self, hyperparameters, job_status, base_learner_origin):
         self.hyperparameters = hyperparameters
+        self.hyperparameters_hash = hash_json(hyperparameters)
         self.individual_score = dict()
         self.meta_features_exists = False
         self.job_status = job_status
@@ -315,7 +761,9 @@ class BaseLearner(Base):
         return estimator
 
     def meta_features_path(self, path):
-        """Returns path for meta-features
+        """Returns path of the legacy per-learner meta-features file. Meta-features are now
+        kept in the notebook's :class:`xcessiv.metafeaturestore.MetaFeatureStore` and files
+        at this path are only read to migrate older notebooks.
 
         Args:
             path (str): Absolute/local path of xcessiv folder
@@ -326,6 +774,115 @@ class BaseLearner(Base):
                 str(self.id)
             ) + '.npy'
 
+    def save_meta_features(self, path, meta_features):
+        """Saves meta-features of base learner into the notebook's meta-feature store
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+
+            meta_features (numpy.ndarray): Out-of-fold meta-features
+        """
+        MetaFeatureStore.from_notebook(path).append(self.id, meta_features)
+
+    def migrate_meta_features(self, path, store=None):
+        """Moves meta-features saved by older versions of Xcessiv into the meta-feature
+        store. Does nothing if there is no legacy file.
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+
+            store (MetaFeatureStore, optional): Store of the notebook
+        """
+        if os.path.exists(self.meta_features_path(path)):
+            store = store or MetaFeatureStore.from_notebook(path)
+            store.append(self.id, np.load(self.meta_features_path(path)))
+            os.remove(self.meta_features_path(path))
+
+    def load_meta_features(self, path):
+        """Returns meta-features of base learner
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+
+        Returns:
+            meta_features (numpy.ndarray): Out-of-fold meta-features
+        """
+        self.migrate_meta_features(path)
+        return MetaFeatureStore.from_notebook(path).get(self.id)
+
+    def checkpoint_path(self, path):
+        """Returns path of the folder holding fold-level checkpoints of meta-features
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(
+            path,
+            app.config['XCESSIV_META_FEATURES_FOLDER'],
+            str(self.id)
+        )
+
+    def fold_models_path(self, path):
+        """Returns path of the folder holding the estimators fitted on each fold, kept when
+        the ``persist_fold_models`` meta-feature generation option is set
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+        """
+        return os.path.join(
+            path,
+            app.config['XCESSIV_META_FEATURES_FOLDER'],
+            'fold-models',
+            str(self.id)
+        )
+
+    def delete_fold_models(self, path):
+        """Deletes the saved fold estimators of base learner if they exist
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+        """
+        if os.path.exists(self.fold_models_path(path)):
+            shutil.rmtree(self.fold_models_path(path), ignore_errors=True)
+
+    def save_test_meta_features(self, path, meta_features):
+        """Saves the meta-features of base learner on the test dataset into the notebook's
+        test meta-feature store
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+
+            meta_features (numpy.ndarray): Test set meta-features
+        """
+        MetaFeatureStore.from_notebook(path, 'test').append(self.id, meta_features)
+
+    def checkpoint_fingerprint(self, extraction):
+        """Returns hash of everything the base learner's out-of-fold meta-features
+        depend on. Fold checkpoints with a different fingerprint are discarded.
+
+        Args:
+            extraction (Extraction): Extraction setup used to generate meta-features
+        """
+        return functions.hash_string(json.dumps(
+            {
+                'dataset': extraction.dataset_cache_key(),
+                'cv_source': extraction.meta_feature_generation['source'],
+                'source': self.base_learner_origin.source,
+                'meta_feature_generator': self.base_learner_origin.meta_feature_generator,
+                'hyperparameters': self.hyperparameters
+            },
+            sort_keys=True
+        ).encode('utf8'))
+
+    def delete_checkpoints(self, path):
+        """Deletes fold-level checkpoints of base learner if they exist
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+        """
+        if os.path.exists(self.checkpoint_path(path)):
+            shutil.rmtree(self.checkpoint_path(path), ignore_errors=True)
+
     @property
     def serialize(self):
         return dict(
@@ -347,6 +904,11 @@ class BaseLearner(Base):
         """
         if os.path.exists(self.meta_features_path(path)):
             os.remove(self.meta_features_path(path))
+        if os.path.exists(os.path.join(path, app.config['XCESSIV_META_FEATURES_FOLDER'])):
+            MetaFeatureStore.from_notebook(path).delete(self.id)
+            MetaFeatureStore.from_notebook(path, 'test').delete(self.id)
+        self.delete_checkpoints(path)
+        self.delete_fold_models(path)
 
     def cleanup(self, path):
         """This function should be called before database deletion to do any pre-delete work
@@ -383,6 +945,7 @@ class StackedEnsemble(Base):
     base_learner_origin_id = Column(Integer, ForeignKey('baselearnerorigin.id'))
     base_learner_origin = relationship('BaseLearnerOrigin', back_populates='stacked_ensembles')
     secondary_learner_hyperparameters = Column(JsonEncodedDict)
+    ensemble_hash = Column(Text, index=True)
     individual_score = Column(JsonEncodedDict)
     job_status = Column(Text)
     job_id = Column(Text)
@@ -398,6 +961,35 @@ class StackedEnsemble(Base):
         self.job_id = None
         self.description = dict()
         self.base_learner_ids = sorted([bl.id for bl in base_learners])
+        self.ensemble_hash = self.hash_ensemble(secondary_learner_hyperparameters,
+                                                self.base_learner_ids)
+
+    @staticmethod
+    def hash_ensemble(secondary_learner_hyperparameters, base_learner_ids):
+        """Returns the hash identifying a stacked ensemble by its secondary learner
+        hyperparameters and base learners. Used for fast duplicate lookups.
+
+        Args:
+            secondary_learner_hyperparameters (dict): Hyperparameters of secondary learner
+
+            base_learner_ids (list): IDs of base learners in the ensemble
+        """
+        return hash_json([secondary_learner_hyperparameters, sorted(base_learner_ids)])
+
+    def return_secondary_features(self, path):
+        """Returns the meta-features of all base learners of the ensemble side by side,
+        gathered from the notebook's meta-feature store
+
+        Args:
+            path (str): Absolute/local path of xcessiv folder
+
+        Returns:
+            secondary_features (numpy.ndarray): Features for the secondary learner
+        """
+        store = MetaFeatureStore.from_notebook(path)
+        for base_learner in self.base_learners:
+            base_learner.migrate_meta_features(path, store)
+        return store.gather([base_learner.id for base_learner in self.base_learners])
 
     def return_secondary_learner(self):
         """Returns secondary learner using its origin and the given hyperparameters
@@ -603,3 +1195,52 @@ class StackedEnsemble(Base):
             base_learner_ids=list(map(lambda x: x.id, self.base_learners)),
             number_of_base_learners=len(self.base_learners)
         )
+
+
+def migrate_notebook(engine):
+    """Brings the database of a notebook created by an older version of Xcessiv up to date.
+    Adds and fills the indexed hash columns used for duplicate lookups.
+
+    Args:
+        engine: SQLAlchemy engine bound to the notebook database
+    """
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        tables = inspector.get_table_names()
+
+        def missing_column(table, column):
+            return table in tables and \
+                column not in [col['name'] for col in inspector.get_columns(table)]
+
+        if missing_column('baselearner', 'hyperparameters_hash'):
+            connection.execute(text('ALTER TABLE baselearner '
+                                    'ADD COLUMN hyperparameters_hash TEXT'))
+            rows = connection.execute(text('SELECT id, hyperparameters '
+                                           'FROM baselearner')).fetchall()
+            for row_id, hyperparameters in rows:
+                connection.execute(
+                    text('UPDATE baselearner SET hyperparameters_hash = :hash '
+                         'WHERE id = :id'),
+                    {'hash': hash_json(json.loads(hyperparameters)), 'id': row_id}
+                )
+
+        if missing_column('stackedensemble', 'ensemble_hash'):
+            connection.execute(text('ALTER TABLE stackedensemble '
+                                    'ADD COLUMN ensemble_hash TEXT'))
+            rows = connection.execute(text(
+                'SELECT id, secondary_learner_hyperparameters, base_learner_ids '
+                'FROM stackedensemble'
+            )).fetchall()
+            for row_id, hyperparameters, base_learner_ids in rows:
+                connection.execute(
+                    text('UPDATE stackedensemble SET ensemble_hash = :hash '
+                         'WHERE id = :id'),
+                    {'hash': StackedEnsemble.hash_ensemble(json.loads(hyperparameters),
+                                                           json.loads(base_learner_ids)),
+                     'id': row_id}
+                )
+
+        for table in (BaseLearner.__table__, StackedEnsemble.__table__):
+            if table.name in tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
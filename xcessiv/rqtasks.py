@@ -1,16 +1,18 @@
 """This module contains RQ jobs"""
 from __future__ import absolute_import, print_function, division, unicode_literals
 from rq.decorators import job
-from rq import get_current_job
+from rq import get_current_job, Queue
 from xcessiv import functions
 from xcessiv import exceptions
 from xcessiv import models
 from xcessiv import automatedruns
+from xcessiv import evaluators
+from xcessiv import artifact
+from xcessiv.metafeaturestore import MetaFeatureStore
 import numpy as np
 import os
 import sys
 import traceback
-from sklearn.model_selection import train_test_split
 from six import iteritems
 
 
@@ -26,25 +28,11 @@ def extraction_data_statistics(path):
     """
     with functions.DBContextManager(path) as session:
         extraction = session.query(models.Extraction).first()
-        X, y = extraction.return_main_dataset()
+        X, y = extraction.return_train_dataset(path)
         functions.verify_dataset(X, y)
 
-        if extraction.test_dataset['method'] == 'split_from_main':
-            X, X_test, y, y_test = train_test_split(
-                X,
-                y,
-                test_size=extraction.test_dataset['split_ratio'],
-                random_state=extraction.test_dataset['split_seed'],
-                stratify=y
-            )
-        elif extraction.test_dataset['method'] == 'source':
-            if 'source' not in extraction.test_dataset or not extraction.test_dataset['source']:
-                raise exceptions.UserError('Source is empty')
-
-            extraction_code = extraction.test_dataset["source"]
-            extraction_function = functions.\
-                import_object_from_string_code(extraction_code, "extract_test_dataset")
-            X_test, y_test = extraction_function()
+        if extraction.test_dataset['method'] in ('split_from_main', 'source', 'file'):
+            X_test, y_test = extraction.return_test_dataset(path)
         else:
             X_test, y_test = None, None
 
@@ -63,9 +51,11 @@ def extraction_data_statistics(path):
         except Exception as e:
             raise exceptions.UserError('User code exception', exception_message=str(e))
 
-        # preparation before testing stacked ensemble cross-validation
+        # preparation before testing stacked ensemble cross-validation. The stacked
+        # ensemble cross-validation runs on meta-features, not on X, so a placeholder
+        # column stands in for them instead of a copy of X.
         test_indices = np.concatenate(test_indices)
-        X, y = X[test_indices], y[test_indices]
+        X_meta, y_meta = np.zeros((len(test_indices), 1)), y[test_indices]
 
         # test stacked ensemble cross-validation
         extraction_code = extraction.stacked_ensemble_cv['source']
@@ -75,7 +65,7 @@ def extraction_data_statistics(path):
         )
         number_of_splits_stacked_cv = 0
         try:
-            for train_idx, test_idx in return_splits_iterable(X, y):
+            for train_idx, test_idx in return_splits_iterable(X_meta, y_meta):
                 number_of_splits_stacked_cv += 1
         except Exception as e:
             raise exceptions.UserError('User code exception', exception_message=str(e))
@@ -95,11 +85,39 @@ def extraction_data_statistics(path):
         session.commit()
 
 
+def _fold_dataset(path, extraction, X, y, splits):
+    """Returns the dataset and splits to fit the folds on, and whether the folds are
+    contiguous. If the ``contiguous_folds`` meta-feature generation option is set and the
+    splits allow it, these are the fold layout of the train dataset from
+    :meth:`xcessiv.models.Extraction.return_fold_layout`."""
+    if extraction.meta_feature_generation.get('contiguous_folds', False):
+        layout = extraction.return_fold_layout(path, splits)
+        if layout is not None:
+            return layout + (True,)
+    return X, y, splits, False
+
+
 @job('default', timeout=86400)
 def generate_meta_features(path, base_learner_id):
     """Generates meta-features for specified base learner
 
-    After generation of meta-features, the file is saved into the meta-features folder
+    After generation of meta-features, the file is saved into the meta-features folder.
+    The meta-features of each fold are checkpointed as soon as the fold completes, so a
+    requeued job resumes from the folds that are still missing.
+
+    If the ``fan_out`` meta-feature generation option is set, the missing folds are
+    instead enqueued as separate :func:`generate_fold_meta_features` jobs. The fold job
+    that completes last enqueues this job again, which then only has to collect the
+    checkpoints and score the base learner. If that fails, requeueing it or any fold job
+    schedules it again.
+
+    If the ``persist_fold_models`` meta-feature generation option is set, the estimator
+    fitted on each fold is kept and :func:`generate_test_meta_features` is enqueued
+    afterwards to score the base learner on the test dataset.
+
+    If the ``contiguous_folds`` meta-feature generation option is set, the folds are taken
+    from a copy of the train dataset permuted into fold order instead of being copied out
+    of it by fancy indexing.
 
     Args:
         path (str): Path to Xcessiv notebook
@@ -121,25 +139,53 @@ def generate_meta_features(path, base_learner_id):
         try:
             est = base_learner.return_estimator()
             extraction = session.query(models.Extraction).first()
-            X, y = extraction.return_train_dataset()
-            return_splits_iterable = functions.import_object_from_string_code(
-                extraction.meta_feature_generation['source'],
-                'return_splits_iterable'
+            X, y = extraction.return_train_dataset(path)
+
+            checkpoint_path = base_learner.checkpoint_path(path)
+            functions.prepare_checkpoint_folder(
+                checkpoint_path,
+                base_learner.checkpoint_fingerprint(extraction)
             )
 
-            meta_features_list = []
-            trues_list = []
-            for train_index, test_index in return_splits_iterable(X, y):
-                X_train, X_test = X[train_index], X[test_index]
-                y_train, y_test = y[train_index], y[test_index]
-                est = est.fit(X_train, y_train)
-                meta_features_list.append(
-                    getattr(est, base_learner.base_learner_origin.
-                            meta_feature_generator)(X_test)
-                )
-                trues_list.append(y_test)
-            meta_features = np.concatenate(meta_features_list, axis=0)
-            y_true = np.concatenate(trues_list)
+            if extraction.meta_feature_generation.get('persist_fold_models', False):
+                fold_models_path = base_learner.fold_models_path(path)
+            else:
+                fold_models_path = None
+                base_learner.delete_fold_models(path)
+
+            if extraction.meta_feature_generation.get('fan_out', False):
+                splits = functions.load_splits(checkpoint_path)
+                if splits is None:
+                    splits = extraction.return_base_learner_splits(path)
+                    functions.save_splits(checkpoint_path, splits)
+                missing_folds = functions.missing_fold_checkpoints(checkpoint_path,
+                                                                   len(splits))
+                if missing_folds:
+                    current_job = get_current_job()
+                    queue = Queue(current_job.origin, connection=current_job.connection)
+                    for fold in missing_folds:
+                        queue.enqueue_call(generate_fold_meta_features,
+                                           args=(path, base_learner.id, fold),
+                                           timeout=86400)
+                    return
+            else:
+                splits = extraction.return_base_learner_splits(path)
+
+            X_folds, y_folds, fold_splits, contiguous = _fold_dataset(path, extraction,
+                                                                      X, y, splits)
+            meta_features, y_true = functions.generate_out_of_fold_meta_features(
+                est, X_folds, y_folds, fold_splits,
+                base_learner.base_learner_origin.meta_feature_generator,
+                n_jobs=extraction.meta_feature_generation.get('n_jobs', 1),
+                checkpoint_path=checkpoint_path,
+                fold_models_path=fold_models_path,
+                contiguous=contiguous
+            )
+            extraction.save_out_of_fold_targets(
+                path,
+                np.concatenate([test_index for train_index, test_index in splits]),
+                y_true
+            )
 
             for key in base_learner.base_learner_origin.metric_generators:
                 metric_generator = functions.import_object_from_string_code(
@@ -148,20 +194,111 @@ def generate_meta_features(path, base_learner_id):
                 )
                 base_learner.individual_score[key] = metric_generator(y_true, meta_features)
 
-            meta_features_path = base_learner.meta_features_path(path)
-
-            if not os.path.exists(os.path.dirname(meta_features_path)):
-                os.makedirs(os.path.dirname(meta_features_path))
-
-            np.save(meta_features_path, meta_features, allow_pickle=False)
+            base_learner.save_meta_features(path, meta_features)
             base_learner.job_status = 'finished'
             base_learner.meta_features_exists = True
+
+            score_holdout = False
+            if fold_models_path is not None:
+                if functions.missing_fold_models(fold_models_path, len(splits)):
+                    base_learner.delete_fold_models(path)
+                    base_learner.description['holdout'] = dict(
+                        status='errored',
+                        error_value='Fold models are larger than '
+                                    'XCESSIV_FOLD_MODELS_MAX_BYTES and were not kept'
+                    )
+                elif extraction.test_dataset['method'] in ('split_from_main', 'source',
+                                                           'file'):
+                    score_holdout = True
+                    base_learner.description['holdout'] = dict(status='queued')
+
+            session.add(base_learner)
+            session.commit()
+            base_learner.delete_checkpoints(path)
+
+            if score_holdout:
+                current_job = get_current_job()
+                Queue(current_job.origin, connection=current_job.connection).enqueue_call(
+                    generate_test_meta_features, args=(path, base_learner.id), timeout=86400
+                )
+
+        except:
+            session.rollback()
+            functions.release_reduce(base_learner.checkpoint_path(path))
+            base_learner.job_status = 'errored'
+            base_learner.description['error_type'] = repr(sys.exc_info()[0])
+            base_learner.description['error_value'] = repr(sys.exc_info()[1])
+            base_learner.description['error_traceback'] = \
+                traceback.format_exception(*sys.exc_info())
+            session.add(base_learner)
+            session.commit()
+            raise
+
+
+@job('default', timeout=86400)
+def generate_fold_meta_features(path, base_learner_id, fold):
+    """Generates the meta-features of a single fold of a base learner and checkpoints them.
+    Enqueued by :func:`generate_meta_features` when fold fan-out is enabled.
+
+    Folds keep running after another fold of the same base learner errors, so requeueing
+    the failed fold is enough to complete the base learner. A requeued fold that caused
+    the error sets the base learner back to started.
+
+    Args:
+        path (str): Path to Xcessiv notebook
+
+        base_learner_id (str): Base learner ID
+
+        fold (int): Index of the fold in the saved cross-validation splits
+    """
+    with functions.DBContextManager(path) as session:
+        base_learner = session.query(models.BaseLearner).filter_by(id=base_learner_id).first()
+        if not base_learner:
+            raise exceptions.UserError('Base learner {} '
+                                       'does not exist'.format(base_learner_id))
+        if base_learner.job_status == 'finished':
+            return
+        if base_learner.job_status == 'errored' and \
+                base_learner.description.get('error_fold') == fold:  # Requeued
+            base_learner.job_status = 'started'
+            for key in ('error_type', 'error_value', 'error_traceback', 'error_fold'):
+                base_learner.description.pop(key, None)
             session.add(base_learner)
             session.commit()
 
+        try:
+            est = base_learner.return_estimator()
+            extraction = session.query(models.Extraction).first()
+            X, y = extraction.return_train_dataset(path)
+
+            checkpoint_path = base_learner.checkpoint_path(path)
+            splits = functions.load_splits(checkpoint_path)
+            if splits is None:
+                raise exceptions.UserError('Cross-validation splits of base learner {} '
+                                           'not found'.format(base_learner_id))
+            X, y, fold_splits, contiguous = _fold_dataset(path, extraction, X, y, splits)
+            train_index, test_index = fold_splits[fold]
+            if extraction.meta_feature_generation.get('persist_fold_models', False):
+                fold_models_path = base_learner.fold_models_path(path)
+            else:
+                fold_models_path = None
+            functions.fit_and_predict_checkpointed_fold(
+                est, X, y, train_index, test_index,
+                base_learner.base_learner_origin.meta_feature_generator,
+                checkpoint_path, fold, fold_models_path, contiguous
+            )
+
+            if not functions.missing_fold_checkpoints(checkpoint_path, len(splits)) and \
+                    functions.claim_reduce(checkpoint_path):
+                current_job = get_current_job()
+                Queue(current_job.origin, connection=current_job.connection).enqueue_call(
+                    generate_meta_features, args=(path, base_learner.id), timeout=86400
+                )
+
         except:
             session.rollback()
             base_learner.job_status = 'errored'
+            base_learner.description['error_fold'] = fold
             base_learner.description['error_type'] = repr(sys.exc_info()[0])
             base_learner.description['error_value'] = repr(sys.exc_info()[1])
             base_learner.description['error_traceback'] = \
@@ -171,6 +308,91 @@ def generate_meta_features(path, base_learner_id):
             raise
 
 
+@job('default', timeout=86400)
+def generate_test_meta_features(path, base_learner_id):
+    """Generates the meta-features of a base learner on the test dataset using the
+    estimators kept from its folds, and scores the base learner on the test dataset.
+    Nothing is refitted. The outputs of the fold estimators are combined with
+    :func:`xcessiv.functions.average_fold_predictions`.
+
+    The meta-features are saved in the notebook's ``test`` meta-feature store, where they
+    are used to score stacked ensembles on the test dataset. Progress and scores are stored
+    under ``holdout`` in the description of the base learner.
+
+    Args:
+        path (str): Path to Xcessiv notebook
+
+        base_learner_id (str): Base learner ID
+    """
+    with functions.DBContextManager(path) as session:
+        base_learner = session.query(models.BaseLearner).filter_by(id=base_learner_id).first()
+        if not base_learner:
+            raise exceptions.UserError('Base learner {} '
+                                       'does not exist'.format(base_learner_id))
+
+        base_learner.description['holdout'] = dict(job_id=get_current_job().id,
+                                                   status='started')
+        session.add(base_learner)
+        session.commit()
+
+        try:
+            extraction = session.query(models.Extraction).first()
+            X_test, y_test = extraction.return_test_dataset(path)
+
+            if not os.path.exists(base_learner.fold_models_path(path)):
+                raise exceptions.UserError('Fold models of base learner {} '
+                                           'not found'.format(base_learner_id))
+            # Fold estimators whose classes are defined in the base learner source can only
+            # be unpickled once the source is registered as a module again
+            functions.import_string_code_as_module(base_learner.base_learner_origin.source)
+            meta_feature_generator = base_learner.base_learner_origin.meta_feature_generator
+            meta_features = functions.average_fold_predictions([
+                getattr(est, meta_feature_generator)(X_test)
+                for est in functions.load_fold_models(base_learner.fold_models_path(path))
+            ])
+            base_learner.save_test_meta_features(path, meta_features)
+
+            scores = dict()
+            for key in base_learner.base_learner_origin.metric_generators:
+                metric_generator = functions.import_object_from_string_code(
+                    base_learner.base_learner_origin.metric_generators[key],
+                    'metric_generator'
+                )
+                scores[key] = metric_generator(y_test, meta_features)
+
+            base_learner.description['holdout'] = dict(job_id=get_current_job().id,
+                                                       status='finished',
+                                                       scores=scores)
+            session.add(base_learner)
+            session.commit()
+
+        except:
+            session.rollback()
+            base_learner.description['holdout'] = dict(
+                job_id=get_current_job().id,
+                status='errored',
+                error_type=repr(sys.exc_info()[0]),
+                error_value=repr(sys.exc_info()[1]),
+                error_traceback=traceback.format_exception(*sys.exc_info())
+            )
+            session.add(base_learner)
+            session.commit()
+            raise
+
+
+def _holdout_scores(path, extraction, evaluator, stacked_ensemble):
+    """Returns the scores of a stacked ensemble on the test dataset, or None if not all of
+    its base learners have test meta-features"""
+    store = MetaFeatureStore.from_notebook(path, 'test')
+    learner_ids = [bl.id for bl in stacked_ensemble.base_learners]
+    if not all(learner_id in store for learner_id in learner_ids):
+        return None
+    X_test, y_test = extraction.return_test_dataset(path)
+    return evaluator.evaluate_on_holdout(learner_ids,
+                                         stacked_ensemble.return_secondary_learner(),
+                                         store.gather(learner_ids), y_test)
+
+
 @job('default', timeout=86400)
 def start_automated_run(path, automated_run_id):
     """Starts automated run. This will automatically create
@@ -202,6 +424,9 @@ def start_automated_run(path, automated_run_id):
             elif automated_run.category == 'greedy_ensemble_search':
                 automatedruns.start_greedy_ensemble_search(automated_run, session, path)
 
+            elif automated_run.category == 'ensemble_selection':
+                automatedruns.start_ensemble_selection(automated_run, session, path)
+
             else:
                 raise Exception('Something went wrong. Invalid category for automated run')
 
@@ -244,54 +469,19 @@ def evaluate_stacked_ensemble(path, ensemble_id):
         session.commit()
 
         try:
-            meta_features_list = []
-            for base_learner in stacked_ensemble.base_learners:
-                mf = np.load(base_learner.meta_features_path(path))
-                if len(mf.shape) == 1:
-                    mf = mf.reshape(-1, 1)
-                meta_features_list.append(mf)
-
-            secondary_features = np.concatenate(meta_features_list, axis=1)
-
-            # Get data
-            extraction = session.query(models.Extraction).first()
-            return_splits_iterable = functions.import_object_from_string_code(
-                extraction.meta_feature_generation['source'],
-                'return_splits_iterable'
+            evaluator = evaluators.StackedEnsembleEvaluator.from_notebook(
+                path, session, stacked_ensemble.base_learners,
+                stacked_ensemble.base_learner_origin
             )
-            X, y = extraction.return_train_dataset()
-
-            #  We need to retrieve original order of meta-features
-            indices_list = [test_index for train_index, test_index in return_splits_iterable(X, y)]
-            indices = np.concatenate(indices_list)
-            X, y = X[indices], y[indices]
-
-            est = stacked_ensemble.return_secondary_learner()
+            scores = evaluator.evaluate([bl.id for bl in stacked_ensemble.base_learners],
+                                        stacked_ensemble.return_secondary_learner())
+            for key in scores:
+                stacked_ensemble.individual_score[key] = scores[key]
 
-            return_splits_iterable_stacked_ensemble = functions.import_object_from_string_code(
-                extraction.stacked_ensemble_cv['source'],
-                'return_splits_iterable'
-            )
-            preds = []
-            trues_list = []
-            for train_index, test_index in return_splits_iterable_stacked_ensemble(secondary_features, y):
-                X_train, X_test = secondary_features[train_index], secondary_features[test_index]
-                y_train, y_test = y[train_index], y[test_index]
-                est = est.fit(X_train, y_train)
-                preds.append(
-                    getattr(est, stacked_ensemble.base_learner_origin.
-                            meta_feature_generator)(X_test)
-                )
-                trues_list.append(y_test)
-            preds = np.concatenate(preds, axis=0)
-            y_true = np.concatenate(trues_list)
-
-            for key in stacked_ensemble.base_learner_origin.metric_generators:
-                metric_generator = functions.import_object_from_string_code(
-                    stacked_ensemble.base_learner_origin.metric_generators[key],
-                    'metric_generator'
-                )
-                stacked_ensemble.individual_score[key] = metric_generator(y_true, preds)
+            holdout_scores = _holdout_scores(path, session.query(models.Extraction).first(),
+                                             evaluator, stacked_ensemble)
+            if holdout_scores is not None:
+                stacked_ensemble.description['holdout'] = dict(scores=holdout_scores)
 
             stacked_ensemble.job_status = 'finished'
             session.add(stacked_ensemble)
@@ -307,3 +497,141 @@ def evaluate_stacked_ensemble(path, ensemble_id):
             session.add(stacked_ensemble)
             session.commit()
             raise
+
+
+@job('default', timeout=86400)
+def evaluate_stacked_ensembles(path, ensemble_ids):
+    """Evaluates several ensembles in one job and updates the database once when finished
+
+    The meta-features, labels and cross-validation splits are loaded once per secondary
+    learner origin and shared by all ensembles. An ensemble that fails to evaluate is marked
+    as errored without stopping the others.
+
+    Args:
+        path (str): Path to Xcessiv notebook
+
+        ensemble_ids (list): Ensemble IDs
+    """
+    with functions.DBContextManager(path) as session:
+        stacked_ensembles = session.query(models.StackedEnsemble).filter(
+            models.StackedEnsemble.id.in_(ensemble_ids)).all()
+        if len(stacked_ensembles) != len(set(ensemble_ids)):
+            raise exceptions.UserError('Not all stacked ensembles exist')
+
+        for stacked_ensemble in stacked_ensembles:
+            stacked_ensemble.job_id = get_current_job().id
+            stacked_ensemble.job_status = 'started'
+            session.add(stacked_ensemble)
+        session.commit()
+
+        def record_error(stacked_ensemble):
+            stacked_ensemble.job_status = 'errored'
+            stacked_ensemble.description['error_type'] = repr(sys.exc_info()[0])
+            stacked_ensemble.description['error_value'] = repr(sys.exc_info()[1])
+            stacked_ensemble.description['error_traceback'] = \
+                traceback.format_exception(*sys.exc_info())
+            session.add(stacked_ensemble)
+
+        try:
+            extraction = session.query(models.Extraction).first()
+            evaluators_by_origin = dict()
+            for stacked_ensemble in stacked_ensembles:
+                origin = stacked_ensemble.base_learner_origin
+                if origin.id not in evaluators_by_origin:
+                    library = set()
+                    for other in stacked_ensembles:
+                        if other.base_learner_origin_id == origin.id:
+                            library.update(other.base_learners)
+                    evaluators_by_origin[origin.id] = \
+                        evaluators.LinearStackedEnsembleEvaluator.from_notebook(
+                            path, session, sorted(library, key=lambda bl: bl.id), origin
+                        )
+                evaluator = evaluators_by_origin[origin.id]
+
+                try:
+                    scores = evaluator.evaluate(
+                        [bl.id for bl in stacked_ensemble.base_learners],
+                        stacked_ensemble.return_secondary_learner()
+                    )
+                    for key in scores:
+                        stacked_ensemble.individual_score[key] = scores[key]
+                    holdout_scores = _holdout_scores(path, extraction, evaluator,
+                                                     stacked_ensemble)
+                    if holdout_scores is not None:
+                        stacked_ensemble.description['holdout'] = dict(scores=holdout_scores)
+                    stacked_ensemble.job_status = 'finished'
+                    session.add(stacked_ensemble)
+                except Exception:
+                    record_error(stacked_ensemble)
+
+            session.commit()
+
+        except:
+            session.rollback()
+            for stacked_ensemble in stacked_ensembles:
+                record_error(stacked_ensemble)
+            session.commit()
+            raise
+
+
+@job('default', timeout=86400)
+def export_fitted_artifact(path, ensemble_id, name):
+    """Fits the ensemble on the training dataset once and saves it as an artifact that
+    loads without refitting. Progress is stored under `artifact_export` in the
+    description of the ensemble.
+
+    Args:
+        path (str): Path to Xcessiv notebook
+
+        ensemble_id (str): Ensemble ID
+
+        name (str): Name of artifact folder to create in the notebook
+    """
+    with functions.DBContextManager(path) as session:
+        stacked_ensemble = session.query(models.StackedEnsemble).filter_by(
+            id=ensemble_id).first()
+        if not stacked_ensemble:
+            raise exceptions.UserError('Stacked ensemble {} '
+                                       'does not exist'.format(ensemble_id))
+
+        extraction = session.query(models.Extraction).first()
+
+        stacked_ensemble.description['artifact_export'] = dict(
+            name=name,
+            job_id=get_current_job().id,
+            status='started'
+        )
+        session.add(stacked_ensemble)
+        session.commit()
+
+        try:
+            source = stacked_ensemble.export_as_code(extraction.meta_feature_generation['source'])
+            module = functions.import_string_code_as_module(source)
+
+            X, y = extraction.return_train_dataset(path)
+            ensemble = module.base_learner
+            ensemble.fit(X, y)
+
+            artifact.save_artifact(os.path.join(path, name), source, ensemble)
+
+            stacked_ensemble.description['artifact_export'] = dict(
+                name=name,
+                job_id=get_current_job().id,
+                status='finished'
+            )
+            session.add(stacked_ensemble)
+            session.commit()
+
+        except:
+            session.rollback()
+            stacked_ensemble.description['artifact_export'] = dict(
+                name=name,
+                job_id=get_current_job().id,
+                status='errored',
+                error_type=repr(sys.exc_info()[0]),
+                error_value=repr(sys.exc_info()[1]),
+                error_traceback=traceback.format_exception(*sys.exc_info())
+            )
+            session.add(stacked_ensemble)
+            session.commit()
+            raise
@@ -11,6 +11,10 @@ from six import iteritems
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from xcessiv.scripts import serve
+        return serve.main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='Launch Xcessiv server and workers')
     parser.add_argument('-w', '--worker', help='Define number of workers', type=int)
     parser.add_argument('-p', '--port', help='Port number to be used by web server',
@@ -1,5 +1,35 @@
+import logging
 from rq import Connection, Worker
 from redis import Redis
+from xcessiv import functions, models, workercache
+
+
+logger = logging.getLogger(__name__)
+
+
+class XcessivWorker(Worker):
+    """RQ worker keeping the datasets and base learner cross-validation splits of notebooks
+    in memory between jobs
+
+    Before forking the process that runs an Xcessiv job, the worker loads these for the
+    job's notebook into :mod:`xcessiv.workercache`, keyed by the extraction settings. The
+    job inherits them copy-on-write instead of loading them again.
+    """
+    def execute_job(self, job, queue):
+        self.preload(job)
+        return super(XcessivWorker, self).execute_job(job, queue)
+
+    def preload(self, job):
+        try:
+            if not job.func_name.startswith('xcessiv.') or not job.args:
+                return
+            path = job.args[0]
+            with functions.DBContextManager(path) as session:
+                extraction = session.query(models.Extraction).first()
+                extraction.preload_resident(path)
+        except Exception:
+            # The job loads what it needs by itself and reports any error
+            logger.exception('Could not preload the datasets of job {}'.format(job.id))
 
 
 def runworker(app):
@@ -8,10 +38,15 @@ def runworker(app):
     REDIS_PORT = app.config['REDIS_PORT']
     REDIS_DB = app.config['REDIS_DB']
     QUEUES = app.config['QUEUES']
+    WORKER_CACHE_MAX_BYTES = app.config['XCESSIV_WORKER_CACHE_MAX_BYTES']
 
     redis_conn = Connection(Redis(REDIS_HOST,
                                   REDIS_PORT,
                                   REDIS_DB))
     with redis_conn:
-        w = Worker(QUEUES)
+        if WORKER_CACHE_MAX_BYTES:
+            workercache.enable(WORKER_CACHE_MAX_BYTES)
+            w = XcessivWorker(QUEUES)
+        else:
+            w = Worker(QUEUES)
         w.work()
@@ -0,0 +1,33 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import argparse
+from xcessiv.serving import load_ensemble, create_app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='xcessiv serve',
+                                     description='Serve predictions of an exported ensemble')
+    parser.add_argument('path', help='Path to fitted artifact or exported package')
+    parser.add_argument('-t', '--train', help='Python file defining extract_main_dataset, '
+                                              'used to fit an exported package')
+    parser.add_argument('-m', '--method', default='predict',
+                        help='Method of the secondary learner used to predict')
+    parser.add_argument('-b', '--max-batch-size', type=int, default=256,
+                        help='Number of rows at which a batch is predicted right away')
+    parser.add_argument('-l', '--max-latency', type=float, default=5.,
+                        help='Milliseconds to wait for more requests before predicting '
+                             'a batch')
+    parser.add_argument('-a', '--address', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=1995,
+                        help='Port number to be used by prediction server')
+    args = parser.parse_args(argv)
+
+    ensemble = load_ensemble(args.path, args.train)
+    serving_app = create_app(ensemble, args.method, args.max_batch_size,
+                             args.max_latency / 1000.)
+    # Requests have to be handled in separate threads for them to be batched together
+    serving_app.run(args.address, args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""This module contains the micro-batching prediction server used by `xcessiv serve`"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+import importlib
+import io
+import os
+import sys
+import threading
+import time
+from six.moves import queue
+import numpy as np
+from flask import Flask, request, jsonify
+from xcessiv import artifact, exceptions, functions
+
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Thread-safe histogram with fixed upper bounds, one more bucket catching the rest
+
+    Args:
+        buckets (list): Increasing upper bounds of the buckets
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = int(np.searchsorted(self.buckets, value))
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    @property
+    def serialize(self):
+        with self._lock:
+            return dict(
+                buckets=[dict(le=le, count=count) for le, count in
+                         zip(self.buckets + ['+Inf'], self.counts)],
+                count=self.count,
+                sum=self.sum
+            )
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent prediction requests into batches
+
+    Requests are queued and served by a single background thread. The thread waits at most
+    `max_latency` seconds after the first request of a batch arrives for more requests, or
+    until `max_batch_size` rows are queued, then calls `predict_function` once on all rows.
+    If a batch fails, its requests are retried one by one so a bad request only fails
+    itself.
+
+    Args:
+        predict_function (callable): Takes a 2-D array and returns one prediction per row
+
+        max_batch_size (int): Number of rows at which a batch is dispatched right away
+
+        max_latency (float): Seconds to wait for more requests before dispatching a batch
+    """
+    def __init__(self, predict_function, max_batch_size=256, max_latency=0.005):
+        self.predict_function = predict_function
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.latency_histogram = Histogram(DEFAULT_LATENCY_BUCKETS)
+        self.batch_size_histogram = Histogram(
+            [2 ** i for i in range(int(np.log2(max(max_batch_size, 1))) + 1)]
+        )
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, X):
+        """Returns predictions for the rows of `X` once the batch containing them is done
+
+        Args:
+            X (array-like): 2-D array of rows to predict
+
+        Returns:
+            predictions (numpy.ndarray): Predictions for the rows of `X`
+        """
+        X = np.asarray(X)
+        if X.ndim != 2:
+            raise exceptions.UserError('Expected a 2-D array of rows')
+        pending = dict(X=X, done=threading.Event(), start=time.time())
+        self._queue.put(pending)
+        pending['done'].wait()
+        self.latency_histogram.observe(time.time() - pending['start'])
+        if 'error' in pending:
+            raise pending['error']
+        return pending['predictions']
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0]['X'])
+            deadline = batch[0]['start'] + self.max_latency
+            while rows < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                rows += len(pending['X'])
+            self._process(batch, rows)
+
+    def _process(self, batch, rows):
+        self.batch_size_histogram.observe(rows)
+        try:
+            if len(batch) == 1:
+                predictions = [self.predict_function(batch[0]['X'])]
+            else:
+                predictions = np.split(
+                    self.predict_function(np.concatenate([p['X'] for p in batch])),
+                    np.cumsum([len(p['X']) for p in batch])[:-1]
+                )
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0]['error'] = exceptions.UserError('Prediction failed',
+                                                         exception_message=str(e))
+                batch[0]['done'].set()
+            else:
+                for pending in batch:
+                    self._process([pending], len(pending['X']))
+            return
+
+        for pending, preds in zip(batch, predictions):
+            pending['predictions'] = preds
+            pending['done'].set()
+
+
+def load_ensemble(path, train_source_path=None):
+    """Loads an ensemble exported by Xcessiv for serving
+
+    Args:
+        path (str, unicode): Path to a fitted artifact or an exported package
+
+        train_source_path (str, unicode, optional): Python file defining
+            `extract_main_dataset`, used to fit an exported package. Fitted artifacts
+            need no training data.
+
+    Returns:
+        ensemble (XcessivStackedEnsemble): Fitted ensemble
+    """
+    path = os.path.abspath(path)
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        return artifact.load_artifact(path)
+
+    if not os.path.exists(os.path.join(path, 'builder.py')):
+        raise exceptions.UserError('{} is neither a fitted artifact nor '
+                                   'an exported package'.format(path))
+    if train_source_path is None:
+        raise exceptions.UserError('Training data is needed to fit exported package '
+                                   '{}'.format(path))
+
+    sys.path.insert(0, os.path.dirname(path))
+    try:
+        ensemble = importlib.import_module(os.path.basename(path)).xcessiv_ensemble
+    finally:
+        sys.path.pop(0)
+    with io.open(train_source_path, encoding='utf8') as f:
+        extract_main_dataset = functions.import_object_from_string_code(
+            f.read(), 'extract_main_dataset')
+    X, y = extract_main_dataset()
+    ensemble.fit(X, y)
+    return ensemble
+
+
+def create_app(ensemble, method='predict', max_batch_size=256, max_latency=0.005):
+    """Returns a Flask application serving predictions of `ensemble`
+
+    ``POST /predict/`` takes ``{"instances": [[...], ...]}`` and returns
+    ``{"predictions": [...]}``. ``GET /metrics/`` returns the request latency and batch
+    size histograms.
+
+    Args:
+        ensemble (XcessivStackedEnsemble): Fitted ensemble
+
+        method (str, unicode): Method of the secondary learner used to predict
+
+        max_batch_size (int): Number of rows at which a batch is dispatched right away
+
+        max_latency (float): Seconds to wait for more requests before dispatching a batch
+    """
+    def predict_function(X):
+        return ensemble._process_using_meta_feature_generator(X, method)
+
+    batcher = MicroBatcher(predict_function, max_batch_size, max_latency)
+    serving_app = Flask(__name__)
+    serving_app.config['BATCHER'] = batcher
+
+    @serving_app.errorhandler(exceptions.UserError)
+    def handle_user_error(error):
+        response = jsonify(error.to_dict())
+        response.status_code = error.status_code
+        return response
+
+    @serving_app.route('/predict/', methods=['POST'])
+    def predict():
+        req_body = request.get_json()
+        if not req_body or 'instances' not in req_body:
+            raise exceptions.UserError('Request body must contain instances')
+        predictions = batcher.predict(req_body['instances'])
+        return jsonify(predictions=predictions.tolist())
+
+    @serving_app.route('/metrics/', methods=['GET'])
+    def metrics():
+        return jsonify(
+            latency_seconds=batcher.latency_histogram.serialize,
+            batch_size_rows=batcher.batch_size_histogram.serialize
+        )
+
+    return serving_app
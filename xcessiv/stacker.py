@@ -3,19 +3,136 @@ if sklearn.__version__.startswith('0.18'):
     from sklearn.pipeline import _BasePipeline as bp
 else:
     from sklearn.utils.metaestimators import _BaseComposition as bp
+from sklearn.base import clone
 import numpy as np
+import scipy.sparse
+import time
+try:
+    import joblib
+except ImportError:  # Older scikit-learn versions vendor joblib
+    from sklearn.externals import joblib
+
+
+def _as_feature_array(X):
+    """Returns features whose rows can be selected with index arrays. Sparse matrices stay
+    sparse, with formats other than CSR and CSC converted to CSR."""
+    if scipy.sparse.issparse(X):
+        return X if X.format in ('csr', 'csc') else X.tocsr()
+    if not hasattr(X, 'shape'):
+        return np.asarray(X)
+    return X
+
+
+def _predict_meta_features(base_learner, meta_feature_generator, X):
+    """Returns the meta-features of a fitted base learner as a 2-dimensional array"""
+    preds = getattr(base_learner, meta_feature_generator)(X)
+    if len(preds.shape) == 1:
+        preds = preds.reshape(-1, 1)
+    return preds
+
+
+def _fit_and_predict_fold(base_learner, meta_feature_generator, X, y, train_idx, test_idx,
+                          return_estimator, message):
+    """Fits a base learner on a training fold and returns the estimator if requested, its
+    meta-features on the test fold and the time it took"""
+    print(message)
+    start_time = time.time()
+    base_learner.fit(X[train_idx], y[train_idx])
+    preds = _predict_meta_features(base_learner, meta_feature_generator, X[test_idx])
+    return base_learner if return_estimator else None, preds, time.time() - start_time
+
+
+class OutOfFoldCollector(object):
+    """Collects the out-of-fold predictions of cross-validation folds into one array
+
+    The output array is allocated once, with its number of rows taken from the test
+    indices of the splits and its dtype and width taken from the first fold added. Each
+    fold's predictions are written in place, so the full array is never held twice as it
+    would be by concatenating a list of per-fold arrays.
+
+    Args:
+        splits (iterable): Iterable yielding (train_index, test_index) pairs
+    """
+    def __init__(self, splits):
+        self.test_indices = [np.asarray(test_index) for train_index, test_index in splits]
+        self.offsets = np.cumsum([0] + [len(test_index) for test_index in self.test_indices])
+        self.out = None
+
+    @property
+    def test_index(self):
+        """Test indices of all folds, in the same order as the rows of the output"""
+        return np.concatenate(self.test_indices)
+
+    def add(self, fold, preds):
+        """Writes the predictions of a fold into the output array
+
+        Args:
+            fold (int): Index of the fold
+
+            preds (array-like): Predictions on the fold's test set
+        """
+        preds = np.asarray(preds)
+        start, stop = self.offsets[fold], self.offsets[fold + 1]
+        if preds.shape[0] != stop - start:
+            raise ValueError('Fold {} has {} test rows but {} predictions'.format(
+                fold, stop - start, preds.shape[0]))
+        if self.out is None:
+            self.out = np.empty((self.offsets[-1],) + preds.shape[1:], dtype=preds.dtype)
+        elif preds.shape[1:] != self.out.shape[1:]:
+            raise ValueError('Fold {} predictions have shape {} but earlier folds have '
+                             'shape {}'.format(fold, preds.shape[1:], self.out.shape[1:]))
+        dtype = np.result_type(self.out, preds)
+        if dtype != self.out.dtype:  # e.g. longer string labels than in the first fold
+            self.out = self.out.astype(dtype)
+        self.out[start:stop] = preds
+
+    def result(self):
+        """Returns the output array. Every fold must have been added."""
+        return self.out
 
 
 class XcessivStackedEnsemble(bp):
-    """Contains the class for the Xcessiv stacked ensemble"""
+    """Contains the class for the Xcessiv stacked ensemble
+
+    Args:
+        base_learners (list): Base learner estimators
+
+        meta_feature_generators (list): Name of the meta-feature generator method of each
+            base learner
+
+        secondary_learner: Estimator fitted on the meta-features of the base learners
+
+        cv_function (callable): Returns an iterable of (train_index, test_index) pairs
+            given X and y
+
+        n_jobs (int, optional): Number of base learners that generate meta-features at
+            the same time. -1 means using all processors.
+
+        backend (str, unicode, optional): joblib backend used when ``n_jobs`` is not 1.
+            "threading" works well with base learners that release the GIL, such as most
+            NumPy based models. Use "loky" or "multiprocessing" otherwise.
+
+        batch_size (int, optional): If given, data is processed in chunks of at most
+            ``batch_size`` rows so that the meta-features of only one chunk are held in
+            memory at a time
+
+        timing_callback (callable, optional): Called after fitting as
+            ``timing_callback(base_learner_index, seconds)`` with the total time spent
+            fitting and predicting the folds of each base learner
+    """
     def __init__(self, base_learners, meta_feature_generators,
-                 secondary_learner, cv_function):
+                 secondary_learner, cv_function, n_jobs=1, backend='threading',
+                 batch_size=None, timing_callback=None):
         super(XcessivStackedEnsemble, self).__init__()
 
         self.base_learners = base_learners
         self.meta_feature_generators = meta_feature_generators
         self.secondary_learner = secondary_learner
         self.cv_function = cv_function
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.batch_size = batch_size
+        self.timing_callback = timing_callback
         self._named_learners = [('bl{}'.format(idx), base_learner) for idx, base_learner
                                in enumerate(base_learners)]
         self._named_learners.append(('secondary-learner', secondary_learner))
@@ -39,34 +156,61 @@ class XcessivStackedEnsemble(bp):
         return self
 
     def fit(self, X, y):
-        print('Fitting {} base learners'.format(len(self.base_learners)))
+        """Generates the out-of-fold meta-features of all base learners and fits the
+        secondary learner on them
 
-        all_learner_meta_features = []
-        for idx, base_learner in enumerate(self.base_learners):
+        The cross-validation splits are generated once and shared by all base learners, so
+        the rows of their meta-features line up. The (base learner, fold) pairs are fitted
+        ``n_jobs`` at a time. As before, every base learner ends up fitted on the training
+        set of the last fold.
 
-            single_learner_meta_features = []
-            test_indices = []
-            for num, (train_idx, test_idx) in enumerate(self.cv_function(X, y)):
-                print('Fold {} of base learner {}'.format(num+1, idx+1))
+        Args:
+            X (array-like or sparse matrix): Features array
 
-                base_learner.fit(X[train_idx], y[train_idx])
+            y (array-like): Labels array
+        """
+        print('Fitting {} base learners'.format(len(self.base_learners)))
 
-                preds = getattr(base_learner, self.meta_feature_generators[idx])(X[test_idx])
+        X = _as_feature_array(X)
 
-                if len(preds.shape) == 1:
-                    preds = preds.reshape(-1, 1)
+        splits = list(self.cv_function(X, y))
+        last_fold = len(splits) - 1
+        tasks = [(idx, num) for idx in range(len(self.base_learners))
+                 for num in range(len(splits))]
 
-                single_learner_meta_features.append(
-                    preds
-                )
+        results = joblib.Parallel(n_jobs=self.n_jobs, backend=self.backend)(
+            joblib.delayed(_fit_and_predict_fold)(
+                # The last fold fits the base learner itself, earlier folds fit copies
+                self.base_learners[idx] if num == last_fold else clone(self.base_learners[idx]),
+                self.meta_feature_generators[idx], X, y, splits[num][0], splits[num][1],
+                num == last_fold, 'Fold {} of base learner {}'.format(num+1, idx+1)
+            )
+            for idx, num in tasks
+        )
 
-                test_indices.append(test_idx)
+        collector = OutOfFoldCollector(splits)
+        widths = [results[idx * len(splits)][1].shape[1]
+                  for idx in range(len(self.base_learners))]
+        column_offsets = np.cumsum([0] + widths)
+        all_learner_meta_features = np.empty(
+            (collector.offsets[-1], column_offsets[-1]),
+            dtype=np.result_type(*[preds for est, preds, fit_time in results])
+        )
+        fit_times = [0.] * len(self.base_learners)
+        for (idx, num), (est, preds, fit_time) in zip(tasks, results):
+            all_learner_meta_features[collector.offsets[num]:collector.offsets[num + 1],
+                                      column_offsets[idx]:column_offsets[idx + 1]] = preds
+            fit_times[idx] += fit_time
+            if est is not None and est is not self.base_learners[idx]:
+                # Fitted in another process, so keep the returned copy
+                self.base_learners[idx] = est
+                self._named_learners[idx] = (self._named_learners[idx][0], est)
 
-            single_learner_meta_features = np.concatenate(single_learner_meta_features)
-            all_learner_meta_features.append(single_learner_meta_features)
+        if self.timing_callback is not None:
+            for idx, fit_time in enumerate(fit_times):
+                self.timing_callback(idx, fit_time)
 
-        all_learner_meta_features = np.concatenate(all_learner_meta_features, axis=1)
-        test_indices = np.concatenate(test_indices)  # reorganized order due to CV
+        test_indices = collector.test_index  # reorganized order due to CV
 
         print('Fitting meta-learner')
 
@@ -82,22 +226,43 @@ class XcessivStackedEnsemble(bp):
         has the method.
 
         Args:
-            X (array-like): Features array
+            X (array-like or sparse matrix): Features array
 
             meta_feature_generator (str, unicode): Method for use by secondary learner
         """
 
-        all_learner_meta_features = []
-        for idx, base_learner in enumerate(self.base_learners):
-            single_learner_meta_features = getattr(base_learner,
-                                                   self.meta_feature_generators[idx])(X)
+        X = _as_feature_array(X)
+        n_rows = X.shape[0]
+        batch_size = self.batch_size or max(n_rows, 1)
+        parallel = joblib.Parallel(n_jobs=self.n_jobs, backend=self.backend)
 
-            if len(single_learner_meta_features.shape) == 1:
-                single_learner_meta_features = single_learner_meta_features.reshape(-1, 1)
-            all_learner_meta_features.append(single_learner_meta_features)
+        out = None
+        all_learner_meta_features = None
+        for start in range(0, max(n_rows, 1), batch_size):
+            X_batch = X[start:start + batch_size]
+            results = parallel(
+                joblib.delayed(_predict_meta_features)(base_learner,
+                                                       self.meta_feature_generators[idx],
+                                                       X_batch)
+                for idx, base_learner in enumerate(self.base_learners)
+            )
 
-        all_learner_meta_features = np.concatenate(all_learner_meta_features, axis=1)
+            batch_rows = results[0].shape[0]
+            if all_learner_meta_features is None or \
+                    all_learner_meta_features.shape[0] != batch_rows:
+                all_learner_meta_features = np.empty(
+                    (batch_rows, sum(preds.shape[1] for preds in results)),
+                    dtype=np.result_type(*results)
+                )
+            position = 0
+            for preds in results:
+                all_learner_meta_features[:, position:position + preds.shape[1]] = preds
+                position += preds.shape[1]
 
-        out = getattr(self.secondary_learner, meta_feature_generator)(all_learner_meta_features)
+            batch_out = getattr(self.secondary_learner,
+                                meta_feature_generator)(all_learner_meta_features)
+            if out is None:
+                out = np.empty((n_rows,) + batch_out.shape[1:], dtype=batch_out.dtype)
+            out[start:start + batch_rows] = batch_out
 
         return out
@@ -0,0 +1,89 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+import hashlib
+import numpy as np
+from sklearn.datasets import load_iris
+from xcessiv import artifact, exceptions, functions, models
+
+
+class TestArtifact(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.artifact_path = os.path.join(self.folder, 'artifact')
+
+        forest_origin = models.BaseLearnerOrigin(
+            source=''.join([
+                "from sklearn.ensemble import RandomForestClassifier\n",
+                "\n",
+                "\n",
+                "class MyForest(RandomForestClassifier):\n",
+                "    pass\n",
+                "\n",
+                "base_learner = MyForest(n_estimators=10, random_state=8)"
+            ]),
+            meta_feature_generator='predict_proba'
+        )
+        linear_origin = models.BaseLearnerOrigin(
+            source=''.join([
+                "from sklearn.linear_model import LogisticRegression\n",
+                "base_learner = LogisticRegression(max_iter=1000)"
+            ]),
+            meta_feature_generator='predict_proba'
+        )
+        base_learners = [
+            models.BaseLearner({'max_depth': 3}, 'finished', forest_origin),
+            models.BaseLearner({'C': 2.0}, 'finished', linear_origin)
+        ]
+        for idx, base_learner in enumerate(base_learners):
+            base_learner.id = idx + 1
+        stacked_ensemble = models.StackedEnsemble(
+            secondary_learner_hyperparameters={'C': 0.5},
+            base_learners=base_learners,
+            base_learner_origin=linear_origin,
+            job_status='finished'
+        )
+        self.source = stacked_ensemble.export_as_code(''.join([
+            "from sklearn.model_selection import KFold\n",
+            "\n",
+            "\n",
+            "def return_splits_iterable(X, y):\n",
+            "    return KFold(3, shuffle=True, random_state=8).split(X, y)"
+        ]))
+
+        self.X, self.y = load_iris(return_X_y=True)
+        self.ensemble = functions.import_string_code_as_module(self.source).base_learner
+        self.ensemble.fit(self.X, self.y)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        artifact.save_artifact(self.artifact_path, self.source, self.ensemble)
+        assert sorted(os.listdir(self.folder)) == ['artifact']
+
+        # Simulate a cold start in which the exported source was never executed
+        del sys.modules[hashlib.sha256(self.source.encode('UTF-8')).hexdigest()]
+
+        loaded = artifact.load_artifact(self.artifact_path)
+        assert type(loaded.base_learners[0]).__name__ == 'MyForest'
+        assert isinstance(loaded.base_learners[1].coef_, np.memmap)
+        np.testing.assert_array_equal(loaded.predict_proba(self.X),
+                                      self.ensemble.predict_proba(self.X))
+
+        loaded = artifact.load_artifact(self.artifact_path, mmap_mode=None)
+        assert not isinstance(loaded.base_learners[1].coef_, np.memmap)
+
+    def test_refuse_existing_path(self):
+        os.makedirs(self.artifact_path)
+        self.assertRaises(exceptions.UserError, artifact.save_artifact,
+                          self.artifact_path, self.source, self.ensemble)
+
+    def test_refuse_modified_source(self):
+        artifact.save_artifact(self.artifact_path, self.source, self.ensemble)
+        with open(os.path.join(self.artifact_path, 'ensemble.py'), 'a') as f:
+            f.write('\n')
+        self.assertRaises(exceptions.UserError, artifact.load_artifact, self.artifact_path)
@@ -0,0 +1,341 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from xcessiv import automatedruns, evaluators, functions
+from xcessiv import exceptions, models
+from xcessiv.metafeaturestore import MetaFeatureStore
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestConstantLiarOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.pbounds = {'x': (-2, 2), 'y': (0, 10)}
+        self.optimizer = automatedruns.ConstantLiarOptimizer(self.pbounds, random_state=8,
+                                                             init_points=2, n_iter=3,
+                                                             n_candidates=500)
+
+    def test_suggestions_within_bounds(self):
+        for _ in range(5):
+            params = self.optimizer.suggest()
+            assert sorted(params) == ['x', 'y']
+            assert -2 <= params['x'] <= 2
+            assert 0 <= params['y'] <= 10
+            self.optimizer.register(params, -params['x'] ** 2)
+        assert self.optimizer.finished_proposing
+
+    def surrogate_optimizer(self):
+        """Returns an optimizer that only proposes points from its surrogate, which knows
+        a grid of points of a function with its maximum at x=0, y=5"""
+        optimizer = automatedruns.ConstantLiarOptimizer(self.pbounds, random_state=8,
+                                                        init_points=2, n_iter=3,
+                                                        n_candidates=500, kappa=0.1)
+        for x in np.linspace(-2, 2, 5):
+            for y in np.linspace(0, 10, 5):
+                optimizer.register({'x': x, 'y': y}, -x ** 2 - ((y - 5) / 5) ** 2)
+        optimizer.num_proposed = optimizer.init_points
+        return optimizer
+
+    def distance(self, first, second):
+        return np.linalg.norm(self.optimizer._to_array(first) -
+                              self.optimizer._to_array(second))
+
+    def test_pending_points_are_avoided(self):
+        first = self.surrogate_optimizer().suggest()
+        assert self.distance(first, {'x': 0, 'y': 5}) < 0.05
+        # Same seed and no pending points, so the same point is proposed
+        assert self.surrogate_optimizer().suggest() == first
+
+        optimizer = self.surrogate_optimizer()
+        optimizer.add_pending(1, first)
+        assert self.distance(optimizer.suggest(), first) > 0.1
+
+        optimizer.remove_pending(1)
+        assert not optimizer.pending
+        optimizer.num_proposed = optimizer.init_points
+        assert self.distance(optimizer.suggest(), {'x': 0, 'y': 5}) < 0.05
+
+    def test_failed_points_are_avoided(self):
+        first = self.surrogate_optimizer().suggest()
+        optimizer = self.surrogate_optimizer()
+        optimizer.register_failure(first)
+        assert self.distance(optimizer.suggest(), first) > 0.1
+        assert self.distance(optimizer.suggest(), first) > 0.1
+
+    def test_unknown_acquisition(self):
+        self.optimizer.register({'x': 0, 'y': 0}, 0)
+        self.optimizer.register({'x': 1, 'y': 1}, 1)
+        self.optimizer.num_proposed = self.optimizer.init_points
+        self.optimizer.acq = 'nope'
+        self.assertRaises(exceptions.UserError, self.optimizer.suggest)
+
+
+class TestAsynchronousBayes(unittest.TestCase):
+    @mock.patch('xcessiv.automatedruns.Worker')
+    @mock.patch('xcessiv.automatedruns.Queue')
+    @mock.patch('xcessiv.automatedruns.get_current_job')
+    def test_single_worker_fails(self, get_current_job, queue, worker):
+        worker.count.return_value = 1  # Only the worker running the automated run
+        module = mock.Mock(batch_size=2, integers=[])
+        optimizer = mock.Mock()
+        self.assertRaises(exceptions.UserError, automatedruns.start_asynchronous_bayes,
+                          mock.Mock(), mock.Mock(), '', module, optimizer)
+        assert not queue.return_value.enqueue_call.called
+        assert not optimizer.suggest.called
+
+    def setup_notebook(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        engine = create_engine('sqlite:///' + os.path.join(path, 'test.db'))
+        self.addCleanup(engine.dispose)
+        models.Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        self.addCleanup(session.close)
+        origin = models.BaseLearnerOrigin(source=''.join([
+            "from sklearn.linear_model import LogisticRegression\n",
+            "base_learner = LogisticRegression()"
+        ]))
+        automated_run = models.AutomatedRun('', 'started', 'bayes', origin)
+        session.add_all([origin, automated_run])
+        session.commit()
+        module = mock.Mock(batch_size=2, integers=[], default_params={}, poll_interval=0,
+                           metric_to_optimize='Accuracy', invert_metric=False)
+        optimizer = automatedruns.ConstantLiarOptimizer({'C': (0.1, 1)}, random_state=8,
+                                                        init_points=1, n_iter=0)
+        return session, automated_run, module, optimizer
+
+    @mock.patch('xcessiv.automatedruns.Worker')
+    @mock.patch('xcessiv.automatedruns.Queue')
+    @mock.patch('xcessiv.automatedruns.get_current_job')
+    def test_dead_jobs_fail_their_points(self, get_current_job, queue, worker):
+        worker.count.return_value = 2
+        for status in ('failed', None):
+            session, automated_run, module, optimizer = self.setup_notebook()
+            job = queue.return_value.enqueue_call.return_value
+            job.id = 'job'
+            job.get_status.return_value = status
+            automatedruns.start_asynchronous_bayes(automated_run, session, '', module,
+                                                   optimizer)
+
+            base_learner = session.query(models.BaseLearner).first()
+            assert base_learner.job_status == 'errored'
+            assert base_learner.description['error_value'] == \
+                'Job job is {}'.format(status or 'missing')
+            assert len(optimizer.failed) == 1
+            assert not optimizer.pending
+            assert not optimizer.targets
+
+    @mock.patch('xcessiv.automatedruns.time')
+    @mock.patch('xcessiv.automatedruns.Worker')
+    @mock.patch('xcessiv.automatedruns.Queue')
+    @mock.patch('xcessiv.automatedruns.get_current_job')
+    def test_finished_job_leaves_base_learner_to_fold_jobs(self, get_current_job, queue,
+                                                          worker, time):
+        worker.count.return_value = 2
+        session, automated_run, module, optimizer = self.setup_notebook()
+        job = queue.return_value.enqueue_call.return_value
+        # The job fans out the folds to other jobs and finishes before the base learner
+        job.get_status.return_value = 'finished'
+
+        def finish_base_learner(seconds):
+            if time.sleep.call_count == 2:
+                base_learner = session.query(models.BaseLearner).first()
+                base_learner.job_status = 'finished'
+                base_learner.individual_score = {'Accuracy': 0.75}
+                session.add(base_learner)
+                session.commit()
+        time.sleep.side_effect = finish_base_learner
+
+        automatedruns.start_asynchronous_bayes(automated_run, session, '', module, optimizer)
+        assert job.get_status.call_count == 1
+        assert optimizer.targets == [0.75]
+        assert not optimizer.failed
+
+
+class TestEnsembleSelection(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.path, 'test.db'))
+        models.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        self.y = np.tile([0, 1], 10)
+        # Each base learner is confidently right on one half of the rows and slightly wrong
+        # on the other, so only their average is right everywhere
+        correct = np.where(np.arange(20) < 10, 0.9, 0.4)
+        probas = []
+        for proba_correct in (correct, correct[::-1]):
+            proba_ones = np.where(self.y == 1, proba_correct, 1 - proba_correct)
+            probas.append(np.column_stack([1 - proba_ones, proba_ones]))
+
+        self.origin = models.BaseLearnerOrigin(metric_generators={'Accuracy': ''.join([
+            "import numpy as np\n",
+            "from sklearn.metrics import accuracy_score\n",
+            "def metric_generator(y_true, y_probas):\n",
+            "    return accuracy_score(y_true, np.argmax(y_probas, axis=1))"
+        ])})
+        self.session.add(models.Extraction())
+        base_learners = [models.BaseLearner(dict(n=n), 'finished', self.origin)
+                         for n in range(3)]
+        self.session.add_all(base_learners)
+        self.session.commit()
+
+        store = MetaFeatureStore.from_notebook(self.path)
+        store.append(base_learners[0].id, probas[0])
+        store.append(base_learners[1].id, probas[1])
+        store.append(base_learners[2].id, np.random.rand(20, 3))
+        self.base_learner_ids = [base_learner.id for base_learner in base_learners]
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def test_weights_and_scores(self):
+        automated_run = models.AutomatedRun(''.join([
+            "metric_to_optimize = 'Accuracy'\n",
+            "invert_metric = False\n",
+            "max_num_iterations = 3\n"
+        ]), 'started', 'ensemble_selection', self.origin)
+        with mock.patch.object(models.Extraction, 'return_out_of_fold_targets',
+                               return_value=self.y):
+            automatedruns.start_ensemble_selection(automated_run, self.session, self.path)
+
+        first, second, third = self.base_learner_ids
+        assert automated_run.description['weights'] == {str(first): 0.5, str(second): 0.5}
+        assert automated_run.description['scores'] == {'Accuracy': 1.0}
+        assert automated_run.description['skipped_base_learners'] == [third]
+
+
+class TestGreedyEnsembleSearch(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.path, 'test.db'))
+        models.Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        random_state = np.random.RandomState(8)
+        self.y = np.tile([0, 1], 30)
+        # Base learners that are right on fewer and fewer rows
+        probas = []
+        for accuracy in (0.9, 0.75, 0.6):
+            correct = random_state.rand(60) < accuracy
+            proba_ones = np.where(correct == (self.y == 1), 0.8, 0.2)
+            probas.append(np.column_stack([1 - proba_ones, proba_ones]))
+
+        extraction = models.Extraction()
+        extraction.stacked_ensemble_cv = dict(source=''.join([
+            "from sklearn.model_selection import StratifiedKFold\n",
+            "\n",
+            "\n",
+            "def return_splits_iterable(X, y):\n",
+            "    return StratifiedKFold(3).split(X, y)"
+        ]))
+        self.origin = models.BaseLearnerOrigin(
+            source=''.join([
+                "from sklearn.linear_model import LogisticRegression\n",
+                "base_learner = LogisticRegression()"
+            ]),
+            metric_generators={'Accuracy': ''.join([
+                "import numpy as np\n",
+                "from sklearn.metrics import accuracy_score\n",
+                "def metric_generator(y_true, y_probas):\n",
+                "    return accuracy_score(y_true, np.argmax(y_probas, axis=1))"
+            ])}
+        )
+        self.base_learners = [models.BaseLearner(dict(n=n), 'finished', self.origin)
+                              for n in range(3)]
+        self.session.add_all([extraction, self.origin] + self.base_learners)
+        self.session.commit()
+
+        store = MetaFeatureStore.from_notebook(self.path)
+        for base_learner, proba in zip(self.base_learners, probas):
+            store.append(base_learner.id, proba)
+
+        self.hyperparameters = functions.make_serializable(
+            self.origin.return_estimator().get_params())
+        self.patch = mock.patch.object(models.Extraction, 'return_out_of_fold_targets',
+                                       return_value=self.y)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def run_search(self, persist_top_k=None):
+        source = ''.join([
+            "metric_to_optimize = 'Accuracy'\n",
+            "invert_metric = False\n",
+            "max_num_base_learners = 3\n",
+            "secondary_learner_hyperparameters = {}\n"
+        ])
+        if persist_top_k is not None:
+            source += "persist_top_k = {}\n".format(persist_top_k)
+        automated_run = models.AutomatedRun(source, 'started', 'greedy_ensemble_search',
+                                            self.origin)
+        automatedruns.start_greedy_ensemble_search(automated_run, self.session, self.path)
+
+    def stacked_ensembles(self):
+        return self.session.query(models.StackedEnsemble).all()
+
+    def assert_scores_match_evaluator(self, stacked_ensembles):
+        evaluator = evaluators.StackedEnsembleEvaluator.from_notebook(
+            self.path, self.session, self.base_learners, self.origin
+        )
+        for stacked_ensemble in stacked_ensembles:
+            assert stacked_ensemble.individual_score == evaluator.evaluate(
+                stacked_ensemble.base_learner_ids, stacked_ensemble.return_secondary_learner())
+
+    def test_saves_round_winners(self):
+        self.run_search()
+        stacked_ensembles = self.stacked_ensembles()
+        # One ensemble per round, each extending the winner of the previous round
+        assert sorted(len(se.base_learner_ids) for se in stacked_ensembles) == [1, 2, 3]
+        by_size = sorted(stacked_ensembles, key=lambda se: len(se.base_learner_ids))
+        for smaller, larger in zip(by_size, by_size[1:]):
+            assert set(smaller.base_learner_ids) < set(larger.base_learner_ids)
+        assert by_size[0].base_learner_ids == [self.base_learners[0].id]
+        assert all(se.job_status == 'finished' for se in stacked_ensembles)
+        assert all(se.secondary_learner_hyperparameters == self.hyperparameters
+                   for se in stacked_ensembles)
+        self.assert_scores_match_evaluator(stacked_ensembles)
+
+    def test_persist_top_k(self):
+        self.run_search(persist_top_k=2)
+        stacked_ensembles = self.stacked_ensembles()
+        # 3, 2 and 1 candidates per round
+        assert sorted(len(se.base_learner_ids) for se in stacked_ensembles) == \
+            [1, 1, 2, 2, 3]
+        self.assert_scores_match_evaluator(stacked_ensembles)
+
+    def test_existing_ensembles_reused(self):
+        first, second, third = self.base_learners
+        # A finished ensemble whose stored score makes it win the first round, and a queued
+        # ensemble that has to be evaluated
+        finished = models.StackedEnsemble(self.hyperparameters, [third], self.origin,
+                                          'finished')
+        finished.individual_score = {'Accuracy': 2.0}
+        queued = models.StackedEnsemble(self.hyperparameters, [third, first], self.origin,
+                                        'queued')
+        self.session.add_all([finished, queued])
+        self.session.commit()
+
+        self.run_search()
+        stacked_ensembles = self.stacked_ensembles()
+        assert sorted(sorted(se.base_learner_ids) for se in stacked_ensembles) == \
+            sorted([[third.id], sorted([first.id, third.id]),
+                    sorted([first.id, second.id, third.id])])
+        assert self.session.query(models.StackedEnsemble).\
+            filter_by(id=queued.id).first().job_status == 'queued'
+        new = [se for se in stacked_ensembles if se.id not in (finished.id, queued.id)]
+        assert len(new) == 1
+        self.assert_scores_match_evaluator(new)
@@ -0,0 +1,101 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import numpy as np
+from sklearn.datasets import load_diabetes, load_iris
+from sklearn.linear_model import LinearRegression, LogisticRegression, Ridge
+from sklearn.metrics import accuracy_score
+from sklearn.model_selection import KFold
+from xcessiv.evaluators import LinearStackedEnsembleEvaluator, StackedEnsembleEvaluator
+
+
+class TestStackedEnsembleEvaluator(unittest.TestCase):
+    def setUp(self):
+        X, self.y = load_iris(return_X_y=True)
+        self.meta_features = np.concatenate([X, X[:, :2] * 2], axis=1)
+        self.splits = list(KFold(n_splits=3, shuffle=True, random_state=8).split(X))
+        self.evaluator = StackedEnsembleEvaluator(
+            self.meta_features,
+            {1: (0, 4), 2: (4, 6)},
+            self.y,
+            self.splits,
+            {'Accuracy': ''.join([
+                "from sklearn.metrics import accuracy_score\n",
+                "def metric_generator(y_true, y_preds):\n",
+                "    return accuracy_score(y_true, y_preds)"
+            ])},
+            'predict'
+        )
+
+    def test_secondary_features(self):
+        np.testing.assert_array_equal(self.evaluator.secondary_features([2, 1]),
+                                      self.meta_features[:, [4, 5, 0, 1, 2, 3]])
+
+    def test_evaluate_matches_manual_cross_validation(self):
+        secondary_learner = LogisticRegression(max_iter=1000)
+        scores = self.evaluator.evaluate([1], secondary_learner)
+
+        preds = []
+        trues = []
+        for train_index, test_index in self.splits:
+            est = LogisticRegression(max_iter=1000).fit(self.meta_features[train_index, :4],
+                                                        self.y[train_index])
+            preds.append(est.predict(self.meta_features[test_index, :4]))
+            trues.append(self.y[test_index])
+        assert scores['Accuracy'] == accuracy_score(np.concatenate(trues),
+                                                    np.concatenate(preds))
+        assert not hasattr(secondary_learner, 'coef_')  # secondary learner is cloned
+
+    def test_evaluate_on_holdout(self):
+        test_meta_features = self.meta_features[::10, :4]
+        scores = self.evaluator.evaluate_on_holdout([1], LogisticRegression(max_iter=1000),
+                                                    test_meta_features, self.y[::10])
+
+        est = LogisticRegression(max_iter=1000).fit(self.meta_features[:, :4], self.y)
+        assert scores['Accuracy'] == accuracy_score(self.y[::10],
+                                                    est.predict(test_meta_features))
+
+
+class TestLinearStackedEnsembleEvaluator(unittest.TestCase):
+    def setUp(self):
+        X, self.y = load_diabetes(return_X_y=True)
+        self.meta_features = np.concatenate([X[:, :4], X[:, 4:6], X[:, 3:4], X[:, 6:]], axis=1)
+        self.column_ranges = {1: (0, 4), 2: (4, 6), 3: (6, 7), 4: (7, 11)}
+        self.splits = list(KFold(n_splits=3, shuffle=True, random_state=8).split(X))
+        self.evaluator = LinearStackedEnsembleEvaluator(
+            self.meta_features,
+            self.column_ranges,
+            self.y,
+            self.splits,
+            {'MSE': ''.join([
+                "from sklearn.metrics import mean_squared_error\n",
+                "def metric_generator(y_true, y_preds):\n",
+                "    return mean_squared_error(y_true, y_preds)"
+            ])},
+            'predict'
+        )
+
+    def regular_score(self, learner_ids, secondary_learner):
+        return StackedEnsembleEvaluator.evaluate(self.evaluator, learner_ids,
+                                                 secondary_learner)['MSE']
+
+    def test_matches_regular_evaluation(self):
+        for secondary_learner in [Ridge(alpha=0.5), Ridge(fit_intercept=False),
+                                  LinearRegression()]:
+            assert self.evaluator.supports(secondary_learner)
+            for learner_ids in ([1], [1, 2], [1, 2, 4], [2, 4, 1]):
+                np.testing.assert_allclose(
+                    self.evaluator.evaluate(learner_ids, secondary_learner)['MSE'],
+                    self.regular_score(learner_ids, secondary_learner)
+                )
+
+    def test_collinear_columns(self):
+        # Base learner 3 duplicates a column of base learner 1
+        np.testing.assert_allclose(
+            self.evaluator.evaluate([1, 3], LinearRegression())['MSE'],
+            self.regular_score([1, 3], LinearRegression())
+        )
+
+    def test_unsupported_learner(self):
+        secondary_learner = LogisticRegression()
+        assert not self.evaluator.supports(secondary_learner)
+        assert not self.evaluator.supports(Ridge(positive=True))
@@ -1,13 +1,24 @@
 from __future__ import absolute_import, print_function, division, unicode_literals
 import unittest
 import os
+import shutil
+import tempfile
 import numpy as np
+from scipy import sparse
 from xcessiv import functions, exceptions
 from sklearn.datasets import load_digits
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.naive_bayes import GaussianNB
+from sklearn.svm import LinearSVC
 from sklearn.decomposition import PCA
 from sklearn.pipeline import Pipeline
+from sklearn.model_selection import KFold
+from sqlalchemy import text
 import pickle
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 filepath = os.path.join(os.path.dirname(__file__),
@@ -41,6 +52,23 @@ class TestImportObjectFromStringCode(unittest.TestCase):
 
         pickle.loads(pickle.dumps(returned_object))  # make sure pickle works
 
+    def test_cached_module(self):
+        code = 'params = dict(a=1)\n'
+        first = functions.import_object_from_string_code(code, 'params')
+        assert functions.import_object_from_string_code(code, 'params') is first
+        assert functions.import_object_from_string_code(code, 'params', fresh=True) \
+            is not first
+
+    def test_eviction(self):
+        sha256 = functions.hashlib.sha256('x = 0\n'.encode('UTF-8')).hexdigest()
+        with mock.patch.dict(functions.app.config, {'XCESSIV_MODULE_CACHE_SIZE': 2}):
+            functions.import_object_from_string_code('x = 0\n', 'x')
+            assert sha256 in functions.sys.modules
+            functions.import_object_from_string_code('x = 1\n', 'x')
+            functions.import_object_from_string_code('x = 2\n', 'x')
+        assert sha256 not in functions.sys.modules
+        assert sha256 not in functions._module_cache
+
 
 class TestImportStringCodeAsModule(unittest.TestCase):
     def test_import_string_code_as_module(self):
@@ -60,6 +88,15 @@ class TestVerifyDataset(unittest.TestCase):
         verification_dict = functions.verify_dataset(X, y)
         assert verification_dict['features_shape'] == (1797,64)
         assert verification_dict['labels_shape'] == (1797,)
+        assert verification_dict['features_format'] == 'dense'
+
+    def test_sparse_dataset(self):
+        X = sparse.random(100, 1000, density=0.01, format='csr', random_state=8)
+        verification_dict = functions.verify_dataset(X, np.arange(100))
+        assert verification_dict['features_shape'] == (100, 1000)
+        assert verification_dict['features_format'] == 'csr'
+        assert verification_dict['features_nnz'] == 1000
+        assert verification_dict['features_density'] == 0.01
 
     def test_invalid_assertions(self):
         self.assertRaises(exceptions.UserError,
@@ -227,3 +264,273 @@ class TestVerifyEstimatorClass(unittest.TestCase):
             dict(Accuracy=self.source),
             self.dataset_properties
         )
+
+
+class TestGenerateOutOfFoldMetaFeatures(unittest.TestCase):
+    def setUp(self):
+        self.X, self.y = load_digits(return_X_y=True)
+        self.splits = list(KFold(n_splits=3, shuffle=True, random_state=8).split(self.X))
+
+    def test_serial(self):
+        meta_features, y_true = functions.generate_out_of_fold_meta_features(
+            RandomForestClassifier(n_estimators=5, random_state=8),
+            self.X, self.y, self.splits, 'predict_proba'
+        )
+        assert meta_features.shape == (1797, 10)
+        np.testing.assert_array_equal(
+            y_true, self.y[np.concatenate([test for train, test in self.splits])]
+        )
+
+    def test_parallel_matches_serial(self):
+        serial, y_serial = functions.generate_out_of_fold_meta_features(
+            RandomForestClassifier(n_estimators=5, random_state=8),
+            self.X, self.y, self.splits, 'predict_proba'
+        )
+        parallel, y_parallel = functions.generate_out_of_fold_meta_features(
+            RandomForestClassifier(n_estimators=5, random_state=8),
+            self.X, self.y, self.splits, 'predict_proba', n_jobs=2
+        )
+        assert serial.tobytes() == parallel.tobytes()
+        np.testing.assert_array_equal(y_serial, y_parallel)
+
+    def test_resume_from_checkpoint(self):
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        try:
+            functions.prepare_checkpoint_folder(checkpoint_path, 'fingerprint')
+            full, y_full = functions.generate_out_of_fold_meta_features(
+                RandomForestClassifier(n_estimators=5, random_state=8),
+                self.X, self.y, self.splits, 'predict_proba',
+                checkpoint_path=checkpoint_path
+            )
+            for fold in range(3):
+                assert os.path.exists(os.path.join(checkpoint_path,
+                                                   'fold_{}.npy'.format(fold)))
+
+            # Simulate a worker that died before finishing the last fold
+            os.remove(os.path.join(checkpoint_path, 'fold_2.npy'))
+            est = RandomForestClassifier(n_estimators=5, random_state=8)
+            est.fit = mock.Mock(wraps=est.fit)
+            resumed, y_resumed = functions.generate_out_of_fold_meta_features(
+                est, self.X, self.y, self.splits, 'predict_proba',
+                checkpoint_path=checkpoint_path
+            )
+            assert est.fit.call_count == 1
+            np.testing.assert_array_equal(full, resumed)
+
+            # A different fingerprint invalidates existing checkpoints
+            functions.prepare_checkpoint_folder(checkpoint_path, 'other')
+            assert not os.path.exists(os.path.join(checkpoint_path, 'fold_0.npy'))
+        finally:
+            shutil.rmtree(os.path.dirname(checkpoint_path))
+
+
+    def test_contiguous_fold_layout(self):
+        expected, y_expected = functions.generate_out_of_fold_meta_features(
+            GaussianNB(), self.X, self.y, self.splits, 'predict_proba'
+        )
+        order, contiguous_splits = functions.contiguous_fold_layout(self.splits, 1797)
+        meta_features, y_true = functions.generate_out_of_fold_meta_features(
+            GaussianNB(), self.X[order], self.y[order], contiguous_splits, 'predict_proba',
+            contiguous=True
+        )
+        np.testing.assert_allclose(meta_features, expected)
+        np.testing.assert_array_equal(y_true, y_expected)
+
+
+class TestTakeRows(unittest.TestCase):
+    def test_take_rows(self):
+        X = np.arange(20).reshape(10, 2)
+        assert np.shares_memory(functions.take_rows(X, np.arange(2, 6)), X)
+        for index in ([0, 1, 7, 8, 9], [3, 1], [0, 2, 4, 6], [], [-2, -1]):
+            np.testing.assert_array_equal(functions.take_rows(X, np.array(index, dtype=int)),
+                                          X[index])
+
+        X_sparse = sparse.csr_matrix(X)
+        assert functions.take_rows(X_sparse, np.array([0, 1, 7, 8, 9])).format == 'csr'
+        np.testing.assert_array_equal(
+            functions.take_rows(X_sparse, np.array([0, 1, 7, 8, 9])).toarray(),
+            X[[0, 1, 7, 8, 9]]
+        )
+
+
+class TestContiguousFoldLayout(unittest.TestCase):
+    def test_k_fold(self):
+        splits = list(KFold(n_splits=3, shuffle=True, random_state=8).split(np.zeros(10)))
+        order, contiguous_splits = functions.contiguous_fold_layout(splits, 10)
+        for (train_index, test_index), (contiguous_train, contiguous_test) in \
+                zip(splits, contiguous_splits):
+            np.testing.assert_array_equal(order[contiguous_test], test_index)
+            np.testing.assert_array_equal(np.sort(order[contiguous_train]), train_index)
+        np.testing.assert_array_equal(contiguous_splits[1][1], np.arange(4, 7))
+        np.testing.assert_array_equal(contiguous_splits[1][0], np.arange(7, 14))
+        assert len(order) == 17
+
+    def test_not_a_partition(self):
+        splits = [(np.array([0, 1]), np.array([2, 3])), (np.array([1, 2]), np.array([0]))]
+        assert functions.contiguous_fold_layout(splits, 4) is None
+        splits = [(np.array([1]), np.array([0])), (np.array([0]), np.array([1]))]
+        assert functions.contiguous_fold_layout(splits, 3) is None
+        splits = [(np.array([2]), np.array([0, 1])), (np.array([0]), np.array([2]))]
+        assert functions.contiguous_fold_layout(splits, 3) is None
+
+
+class TestGetEngine(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'test.db')
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        functions.get_engine(self.path).dispose()
+        shutil.rmtree(self.folder)
+
+    def test_cached_engine(self):
+        engine = functions.get_engine(self.path)
+        assert functions.get_engine(self.path) is engine
+        with engine.connect() as connection:
+            assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+
+        os.remove(self.path)
+        open(self.path, 'w').close()
+        assert functions.get_engine(self.path) is not engine
+
+
+class TestFoldFanOut(unittest.TestCase):
+    def setUp(self):
+        self.checkpoint_path = tempfile.mkdtemp()
+        self.splits = list(KFold(3, shuffle=True, random_state=8).split(np.arange(10)))
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_path)
+
+    def test_save_and_load_splits(self):
+        assert functions.load_splits(self.checkpoint_path) is None
+        functions.save_splits(self.checkpoint_path, self.splits)
+        loaded = functions.load_splits(self.checkpoint_path)
+        assert len(loaded) == 3
+        for (train_index, test_index), (loaded_train, loaded_test) in zip(self.splits, loaded):
+            np.testing.assert_array_equal(train_index, loaded_train)
+            np.testing.assert_array_equal(test_index, loaded_test)
+
+    def test_missing_folds_and_claim(self):
+        assert functions.missing_fold_checkpoints(self.checkpoint_path, 3) == [0, 1, 2]
+        functions.save_fold_checkpoint(self.checkpoint_path, 1, np.zeros(3), dict(fold=1))
+        assert functions.missing_fold_checkpoints(self.checkpoint_path, 3) == [0, 2]
+
+        assert functions.claim_reduce(self.checkpoint_path)
+        assert not functions.claim_reduce(self.checkpoint_path)
+
+
+class TestFoldModels(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fold_models_path = os.path.join(self.folder, 'fold-models')
+        self.X, self.y = load_digits(return_X_y=True)
+        self.splits = list(KFold(n_splits=3, shuffle=True, random_state=8).split(self.X))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_fold_models_saved(self):
+        meta_features, y_true = functions.generate_out_of_fold_meta_features(
+            RandomForestClassifier(n_estimators=5, random_state=8),
+            self.X, self.y, self.splits, 'predict_proba',
+            fold_models_path=self.fold_models_path
+        )
+        assert functions.missing_fold_models(self.fold_models_path, 3) == []
+
+        estimators = functions.load_fold_models(self.fold_models_path)
+        assert len(estimators) == 3
+        np.testing.assert_array_equal(
+            estimators[0].predict_proba(self.X[self.splits[0][1]]),
+            meta_features[:len(self.splits[0][1])]
+        )
+
+    def test_size_cap(self):
+        est = RandomForestClassifier(n_estimators=5, random_state=8).fit(self.X, self.y)
+        assert functions.save_fold_model(self.fold_models_path, 0, est, 1024 ** 3)
+        assert not functions.save_fold_model(self.fold_models_path, 1, est, 1)
+        assert functions.missing_fold_models(self.fold_models_path, 2) == [1]
+        assert os.listdir(self.fold_models_path) == ['fold_0.joblib']
+
+    def test_size_cap_counts_concurrent_folds(self):
+        est = RandomForestClassifier(n_estimators=5, random_state=8).fit(self.X, self.y)
+        assert functions.save_fold_model(self.fold_models_path, 0, est, 1024 ** 3)
+        size = os.path.getsize(functions.fold_model_file(self.fold_models_path, 0))
+        shutil.rmtree(self.fold_models_path)
+
+        rename = os.rename
+
+        def rename_while_fold_one_finishes(src, dst):
+            rename(src, dst)
+            shutil.copy(dst, functions.fold_model_file(self.fold_models_path, 1))
+
+        with mock.patch.object(functions.os, 'rename',
+                               side_effect=rename_while_fold_one_finishes):
+            assert not functions.save_fold_model(self.fold_models_path, 0, est,
+                                                 int(size * 1.5))
+        assert os.listdir(self.fold_models_path) == ['fold_1.joblib']
+
+
+class TestAverageFoldPredictions(unittest.TestCase):
+    def test_floats_averaged(self):
+        np.testing.assert_allclose(
+            functions.average_fold_predictions([np.array([[0.2, 0.8]]),
+                                                np.array([[0.4, 0.6]])]),
+            [[0.3, 0.7]]
+        )
+
+    def test_labels_voted(self):
+        np.testing.assert_array_equal(
+            functions.average_fold_predictions([np.array([1, 2, 3]),
+                                                np.array([1, 0, 3]),
+                                                np.array([0, 0, 3])]),
+            [1, 0, 3]
+        )
+
+
+class TestSaveDatasetToCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path)
+
+    def test_save_selected_rows(self):
+        X, y = np.arange(30.).reshape(10, 3), np.arange(10)
+        indices = np.array([7, 2, 5])
+        assert functions.save_dataset_to_cache(self.cache_path, 'train', X, y, indices)
+        X_cached, y_cached = functions.load_dataset_from_cache(self.cache_path, 'train')
+        np.testing.assert_array_equal(X_cached, X[indices])
+        np.testing.assert_array_equal(y_cached, y[indices])
+
+    def test_sparse_features(self):
+        X = sparse.random(10, 50, density=0.1, format='csc', random_state=8)
+        y = np.arange(10)
+        indices = np.array([7, 2, 5])
+        assert functions.save_dataset_to_cache(self.cache_path, 'train', X, y, indices)
+        X_cached, y_cached = functions.load_dataset_from_cache(self.cache_path, 'train')
+        assert X_cached.format == 'csc'
+        np.testing.assert_array_equal(X_cached.toarray(), X[indices].toarray())
+        np.testing.assert_array_equal(y_cached, y[indices])
+
+    def test_sparse_features_with_unsorted_indices(self):
+        X = sparse.csr_matrix((np.array([1., 2., 3., 4.]), np.array([2, 0, 2, 1]),
+                               np.array([0, 3, 4])), shape=(2, 3))
+        assert not X.has_canonical_format
+        assert functions.save_dataset_to_cache(self.cache_path, 'train', X, np.arange(2))
+        assert not X.has_canonical_format  # The given matrix is left alone
+
+        X_cached, y_cached = functions.load_dataset_from_cache(self.cache_path, 'train')
+        assert not X_cached.data.flags.writeable
+        assert X_cached.has_canonical_format
+        np.testing.assert_array_equal(X_cached.indices, [0, 2, 1])
+        np.testing.assert_array_equal(X_cached.toarray(), X.toarray())
+        X_cached.sort_indices()
+        X_cached.sum_duplicates()
+        LinearSVC().fit(X_cached, [0, 1])
+
+    def test_object_arrays_not_cached(self):
+        X = np.array([[1, 'a'], [2, None]], dtype=object)
+        assert not functions.save_dataset_to_cache(self.cache_path, 'train', X, np.arange(2))
+        assert functions.load_dataset_from_cache(self.cache_path, 'train') is None
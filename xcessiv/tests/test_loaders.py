@@ -0,0 +1,89 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import io
+import os
+import shutil
+import tempfile
+import numpy as np
+from xcessiv import exceptions, functions, loaders
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestLoadDatasetFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.converted_folder = os.path.join(self.folder, 'files')
+        self.csv_path = os.path.join(self.folder, 'data.csv')
+        with io.open(self.csv_path, 'w') as f:
+            f.write('a,label,b\n1,cat,2.5\n3,dog,4\n\n5,cat,6\n')
+        self.spec = {'path': self.csv_path, 'format': 'csv', 'label_column': 'label'}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_csv(self):
+        X, y = loaders.load_dataset_file(self.spec, self.converted_folder)
+        assert isinstance(X, np.memmap)
+        np.testing.assert_array_equal(X, [[1, 2.5], [3, 4], [5, 6]])
+        np.testing.assert_array_equal(y, ['cat', 'dog', 'cat'])
+
+        X, y = loaders.read_dataset_file(self.spec)
+        assert not isinstance(X, np.memmap)
+
+        self.assertRaises(exceptions.UserError, loaders.read_dataset_file,
+                          dict(self.spec, label_column='missing'))
+        # The text column is then a feature
+        self.assertRaises(exceptions.UserError, loaders.read_dataset_file,
+                          dict(self.spec, label_column=0))
+
+    def test_csv_without_header(self):
+        with io.open(self.csv_path, 'w') as f:
+            f.write('1,0.5,2\n3,1.5,4\n')
+        X, y = loaders.read_dataset_file(dict(self.spec, header=False, label_column=-1))
+        np.testing.assert_array_equal(X, [[1, 0.5], [3, 1.5]])
+        assert y.dtype == np.int64
+        np.testing.assert_array_equal(y, [2, 4])
+
+    def test_npy(self):
+        npy_path = os.path.join(self.folder, 'data.npy')
+        np.save(npy_path, np.arange(12, dtype=np.float32).reshape(4, 3))
+        X, y = loaders.load_dataset_file({'path': npy_path, 'format': 'npy'},
+                                         self.converted_folder)
+        assert X.dtype == np.float32
+        np.testing.assert_array_equal(X, [[0, 1], [3, 4], [6, 7], [9, 10]])
+        np.testing.assert_array_equal(y, [2, 5, 8, 11])
+
+    def test_converted_once(self):
+        loaders.load_dataset_file(self.spec, self.converted_folder)
+        with mock.patch.object(functions, 'hash_file') as hash_file:
+            X, y = loaders.load_dataset_file(self.spec, self.converted_folder)
+            assert not hash_file.called
+
+        # A new modification time alone only costs a hash of the file
+        os.utime(self.csv_path, (0, 0))
+        with mock.patch.object(loaders, '_convert_csv') as convert:
+            loaders.load_dataset_file(self.spec, self.converted_folder)
+            assert not convert.called
+        with mock.patch.object(functions, 'hash_file') as hash_file:
+            loaders.load_dataset_file(self.spec, self.converted_folder)
+            assert not hash_file.called
+
+        with io.open(self.csv_path, 'a') as f:
+            f.write('7,dog,8\n')
+        X, y = loaders.load_dataset_file(self.spec, self.converted_folder)
+        assert X.shape == (4, 2)
+        assert sorted(os.listdir(self.converted_folder)) == [
+            loaders.spec_key(self.spec), loaders.spec_key(self.spec) + '.lock'
+        ]
+
+    def test_invalid_spec(self):
+        self.assertRaises(exceptions.UserError, loaders.validate_spec,
+                          {'path': self.csv_path, 'format': 'xlsx'})
+        self.assertRaises(exceptions.UserError, loaders.validate_spec,
+                          {'path': self.csv_path, 'format': 'csv'})
+        self.assertRaises(exceptions.UserError, loaders.load_dataset_file,
+                          dict(self.spec, path=os.path.join(self.folder, 'missing.csv')),
+                          self.converted_folder)
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from xcessiv import exceptions
+from xcessiv.metafeaturestore import MetaFeatureStore
+
+
+class TestMetaFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = MetaFeatureStore(self.folder)
+        self.store.initial_capacity = 4
+        np.random.seed(8)
+        self.probas = np.random.rand(20, 3)
+        self.preds = np.random.randint(0, 3, 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_append_and_gather(self):
+        self.store.append(1, self.probas)
+        self.store.append(2, self.preds)
+        assert 1 in self.store
+        assert 3 not in self.store
+
+        np.testing.assert_array_equal(self.store.get(1), self.probas)
+        np.testing.assert_array_equal(self.store.get(2), self.preds)
+        assert self.store.get(2).shape == (20,)
+
+        secondary_features = self.store.gather([2, 1])
+        np.testing.assert_array_equal(
+            secondary_features,
+            np.concatenate([self.preds.reshape(-1, 1), self.probas], axis=1)
+        )
+
+    def test_growth_preserves_columns(self):
+        for learner_id in range(10):
+            self.store.append(learner_id, self.probas + learner_id)
+        for learner_id in range(10):
+            np.testing.assert_array_equal(self.store.get(learner_id), self.probas + learner_id)
+
+    def test_delete_and_compact(self):
+        for learner_id in range(4):
+            self.store.append(learner_id, self.probas + learner_id)
+        self.store.delete(1)
+        self.store.delete(2)
+        assert 1 not in self.store
+        self.store.compact()
+        assert self.store._read_index()['used'] == 6
+        np.testing.assert_array_equal(self.store.gather([3, 0]),
+                                      np.concatenate([self.probas + 3, self.probas], axis=1))
+
+    def test_replace_existing(self):
+        self.store.append(1, self.probas)
+        self.store.append(1, self.probas * 2)
+        np.testing.assert_array_equal(self.store.get(1), self.probas * 2)
+
+    def test_row_mismatch(self):
+        self.store.append(1, self.probas)
+        self.assertRaises(exceptions.UserError, self.store.append, 2, self.probas[:10])
+        self.assertRaises(exceptions.UserError, self.store.gather, [1, 2])
+
+    def test_widths(self):
+        self.store.append(1, self.probas)
+        self.store.append(2, self.preds)
+        assert self.store.widths([2, 1]) == [1, 3]
+        self.assertRaises(exceptions.UserError, self.store.widths, [3])
+
+    def test_dtypes(self):
+        self.store.append(1, self.preds)
+        self.store.append(2, self.preds > 0)
+        assert self.store.get(1).dtype == self.preds.dtype
+        assert self.store.get(2).dtype == np.bool_
+        assert self.store.gather([1, 2]).dtype == self.preds.dtype
+        assert self.store.gather([1, 2, 1]).shape == (20, 3)
+        self.store.append(3, self.probas)
+        assert self.store.gather([1, 3]).dtype == np.float64
+
+    def test_string_labels(self):
+        labels = np.array(['cat', 'dog', 'fish'])[self.preds]
+        self.store.append(1, self.probas)
+        self.store.append(2, labels)
+        assert 2 in self.store
+        assert self.store.widths([1, 2]) == [3, 1]
+        np.testing.assert_array_equal(self.store.get(2), labels)
+        secondary_features = self.store.gather([2])
+        assert secondary_features.shape == (20, 1)
+        np.testing.assert_array_equal(secondary_features.ravel(), labels)
+        assert self.store.gather([1, 2]).shape == (20, 4)
+        self.assertRaises(exceptions.UserError, self.store.append, 3, labels[:10])
+
+        # Replacing them with numbers moves them into the matrix
+        self.store.append(2, self.preds)
+        np.testing.assert_array_equal(self.store.get(2), self.preds)
+        assert not self.store._read_index()['files']
+
+        self.store.append(2, labels)
+        self.store.delete(2)
+        self.store.delete(1)
+        assert 2 not in self.store
+        self.store.append(3, labels[:10])
+        np.testing.assert_array_equal(self.store.get(3), labels[:10])
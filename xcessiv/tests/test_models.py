@@ -1,7 +1,17 @@
 from __future__ import absolute_import, print_function, division, unicode_literals
 import unittest
-from xcessiv import models
+import os
+import shutil
+import tempfile
+import numpy as np
+from xcessiv import app, models, workercache
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import KFold
+from sqlalchemy import create_engine, inspect, text
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 class TestReturnTrainDataFromJSON(unittest.TestCase):
@@ -75,3 +85,228 @@ class TestReturnEstimator(unittest.TestCase):
     def test_return_estimator_from_json(self):
         est = self.base_learner_origin.return_estimator()
         assert isinstance(est, RandomForestClassifier)
+
+
+class TestDatasetCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.extraction = models.Extraction()
+        self.extraction.main_dataset['source'] = ''.join([
+            "from sklearn.datasets import load_digits\n",
+            "\n",
+            "\n",
+            "def extract_main_dataset():\n",
+            "    X, y = load_digits(return_X_y=True)\n",
+            "    return X, y"
+        ])
+        self.extraction.test_dataset['method'] = 'split_from_main'
+        self.extraction.test_dataset['split_ratio'] = 0.1
+        self.extraction.test_dataset['split_seed'] = 8
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cached_datasets_match_extraction(self):
+        X, y = self.extraction.return_train_dataset(self.path)
+        assert isinstance(X, np.memmap)
+        assert os.path.exists(os.path.join(self.extraction.dataset_cache_path(self.path),
+                                           'test_X.npy'))
+
+        X_uncached, y_uncached = self.extraction.return_train_dataset()
+        np.testing.assert_array_equal(X, X_uncached)
+        np.testing.assert_array_equal(y, y_uncached)
+
+        X_test, y_test = self.extraction.return_test_dataset(self.path)
+        assert X_test.shape == (180, 64)
+        assert y_test.shape == (180,)
+
+    def test_memory_mapped_main_dataset_not_copied(self):
+        X, y = self.extraction.return_main_dataset()
+        np.save(os.path.join(self.path, 'X.npy'), X)
+        np.save(os.path.join(self.path, 'y.npy'), y)
+        self.extraction.main_dataset['source'] = ''.join([
+            "import numpy as np\n",
+            "\n",
+            "\n",
+            "def extract_main_dataset():\n",
+            "    return (np.load({!r}, mmap_mode='r'),\n".format(os.path.join(self.path, 'X.npy')),
+            "            np.load({!r}, mmap_mode='r'))".format(os.path.join(self.path, 'y.npy'))
+        ])
+        X_main, y_main = self.extraction.return_main_dataset()
+        assert isinstance(X_main.base, np.memmap)
+
+        X_train, y_train = self.extraction.return_train_dataset(self.path)
+        X_uncached, y_uncached = self.extraction.return_train_dataset()
+        np.testing.assert_array_equal(X_train, X_uncached)
+        np.testing.assert_array_equal(y_train, y_uncached)
+
+    def test_sparse_main_dataset(self):
+        self.extraction.main_dataset['source'] = ''.join([
+            "import numpy as np\n",
+            "from scipy import sparse\n",
+            "\n",
+            "\n",
+            "def extract_main_dataset():\n",
+            "    X = sparse.random(200, 1000, density=0.01, format='coo', random_state=8)\n",
+            "    return X, np.arange(200) % 2"
+        ])
+        X, y = self.extraction.return_train_dataset(self.path)
+        assert X.format == 'csr'
+        assert X.shape == (180, 1000)
+        X_uncached, y_uncached = self.extraction.return_train_dataset()
+        np.testing.assert_array_equal(X.toarray(), X_uncached.toarray())
+        np.testing.assert_array_equal(y, y_uncached)
+
+    def test_cache_key_changes_with_settings(self):
+        key = self.extraction.dataset_cache_key()
+        self.extraction.return_train_dataset(self.path)
+
+        self.extraction.test_dataset['split_seed'] = 9
+        assert self.extraction.dataset_cache_key() != key
+
+        self.extraction.cleanup_dataset_cache(self.path)
+        assert not os.listdir(os.path.join(self.path,
+                                           app.config['XCESSIV_DATASET_CACHE_FOLDER']))
+
+    def test_file_main_dataset(self):
+        X, y = self.extraction.return_main_dataset()
+        file_path = os.path.join(self.path, 'digits.npy')
+        np.save(file_path, np.column_stack([X, y]))
+        self.extraction.main_dataset['file'] = {'path': file_path, 'format': 'npy'}
+
+        X_train, y_train = self.extraction.return_train_dataset(self.path)
+        X_uncached, y_uncached = self.extraction.return_train_dataset()
+        np.testing.assert_array_equal(X_train, X_uncached)
+        np.testing.assert_array_equal(y_train, y_uncached)
+        assert os.listdir(self.extraction.dataset_files_path(self.path))
+
+        key = self.extraction.dataset_cache_key()
+        os.utime(file_path, (0, 0))
+        assert self.extraction.dataset_cache_key() != key
+        self.extraction.cleanup_dataset_cache(self.path)
+        assert os.listdir(os.path.join(self.path, app.config['XCESSIV_DATASET_CACHE_FOLDER'])) \
+            == ['files']
+
+        self.extraction.test_dataset['method'] = 'file'
+        self.extraction.test_dataset['file'] = {'path': file_path, 'format': 'npy'}
+        X_test, y_test = self.extraction.return_test_dataset(self.path)
+        assert isinstance(X_test, np.memmap)
+        assert X_test.shape == (1797, 64)
+
+    def test_fold_layout(self):
+        self.extraction.meta_feature_generation['source'] = ''.join([
+            "from sklearn.model_selection import KFold\n",
+            "\n",
+            "\n",
+            "def return_splits_iterable(X, y):\n",
+            "    return KFold(3, shuffle=True, random_state=8).split(X, y)"
+        ])
+        X, y = self.extraction.return_train_dataset(self.path)
+        splits = list(KFold(3, shuffle=True, random_state=8).split(X, y))
+        X_folds, y_folds, contiguous_splits = self.extraction.return_fold_layout(self.path,
+                                                                                 splits)
+        assert isinstance(X_folds, np.memmap)
+        for (train_index, test_index), (contiguous_train, contiguous_test) in \
+                zip(splits, contiguous_splits):
+            np.testing.assert_array_equal(X_folds[contiguous_test], X[test_index])
+            np.testing.assert_array_equal(y_folds[contiguous_test], y[test_index])
+        assert len(os.listdir(self.extraction.fold_layout_path(self.path))) == 2
+
+        self.extraction.meta_feature_generation['source'] += '\n'
+        self.extraction.cleanup_dataset_cache(self.path)
+        assert not [filename for filename in
+                    os.listdir(self.extraction.dataset_cache_path(self.path))
+                    if filename.startswith('folds-')]
+
+    def test_worker_cache(self):
+        self.extraction.meta_feature_generation['source'] = ''.join([
+            "from sklearn.model_selection import KFold\n",
+            "\n",
+            "\n",
+            "def return_splits_iterable(X, y):\n",
+            "    return KFold(3, shuffle=True, random_state=8).split(X, y)"
+        ])
+        cache = workercache.ResidentCache(1024 ** 3)
+        with mock.patch.object(workercache, '_cache', cache):
+            # The worker's main process does not extract datasets that are not cached yet
+            with mock.patch.object(models.Extraction, 'return_main_dataset') as extract:
+                self.extraction.preload_resident(self.path)
+                assert not extract.called
+            assert len(cache) == 0
+
+        # A job extracts the datasets and saves the splits
+        self.extraction.return_base_learner_splits(self.path)
+        self.extraction.return_test_dataset(self.path)
+
+        with mock.patch.object(workercache, '_cache', cache):
+            with mock.patch.object(models.Extraction, 'return_main_dataset') as extract:
+                self.extraction.preload_resident(self.path)
+                assert not extract.called
+            assert len(cache) == 3
+
+            with mock.patch.object(models.Extraction, '_return_cached_dataset') as load:
+                X, y = self.extraction.return_train_dataset(self.path)
+                splits = self.extraction.return_base_learner_splits(self.path)
+                assert not load.called
+            assert not isinstance(X, np.memmap)
+            assert len(splits) == 3
+
+            # Values of outdated extraction settings are dropped on the next preload
+            self.extraction.test_dataset['split_seed'] = 9
+            self.extraction.preload_resident(self.path)
+            assert len(cache) == 0
+            X_new, y_new = self.extraction.return_train_dataset(self.path)
+            assert not np.array_equal(y, y_new)
+
+    def test_out_of_fold_targets_saved(self):
+        self.extraction.meta_feature_generation['source'] = ''.join([
+            "from sklearn.model_selection import KFold\n",
+            "\n",
+            "\n",
+            "def return_splits_iterable(X, y):\n",
+            "    return KFold(3, shuffle=True, random_state=8).split(X, y)"
+        ])
+        y_true = self.extraction.return_out_of_fold_targets(self.path)
+        assert y_true.shape == (1617,)
+
+        with mock.patch.object(models.Extraction, 'return_train_dataset') as extract:
+            np.testing.assert_array_equal(
+                self.extraction.return_out_of_fold_targets(self.path), y_true)
+            assert not extract.called
+
+        self.extraction.meta_feature_generation['source'] += '\n'
+        self.extraction.cleanup_dataset_cache(self.path)
+        assert not os.listdir(self.extraction.out_of_fold_targets_path(self.path))
+
+
+class TestMigrateNotebook(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.folder, 'test.db'))
+        with self.engine.begin() as connection:
+            connection.execute(text('CREATE TABLE baselearner (id INTEGER PRIMARY KEY, '
+                                    'hyperparameters TEXT)'))
+            connection.execute(text('CREATE TABLE stackedensemble (id INTEGER PRIMARY KEY, '
+                                    'secondary_learner_hyperparameters TEXT, '
+                                    'base_learner_ids TEXT)'))
+            connection.execute(text("INSERT INTO baselearner VALUES "
+                                    "(1, '{\"a\": 1, \"b\": [2, 3]}')"))
+            connection.execute(text("INSERT INTO stackedensemble VALUES "
+                                    "(1, '{\"C\": 1.0}', '[2, 1]')"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.folder)
+
+    def test_migrate(self):
+        models.migrate_notebook(self.engine)
+        models.migrate_notebook(self.engine)  # Running twice is harmless
+
+        with self.engine.connect() as connection:
+            assert connection.execute(text('SELECT hyperparameters_hash FROM baselearner')).\
+                scalar() == models.hash_json({'b': [2, 3], 'a': 1})
+            assert connection.execute(text('SELECT ensemble_hash FROM stackedensemble')).\
+                scalar() == models.StackedEnsemble.hash_ensemble({'C': 1.0}, [1, 2])
+
+        index_names = [index['name'] for index in inspect(self.engine).get_indexes('baselearner')]
+        assert 'ix_baselearner_hyperparameters_hash' in index_names
@@ -0,0 +1,258 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from sqlalchemy import create_engine
+from xcessiv import app, functions, models, rqtasks
+from xcessiv.metafeaturestore import MetaFeatureStore
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class FakeQueue(object):
+    """Collects enqueued jobs instead of sending them to Redis"""
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def enqueue_call(self, func, args=(), timeout=None):
+        self.jobs.append((func, args))
+
+
+class NotebookTestCase(unittest.TestCase):
+    """Creates a notebook with a single base learner and runs its jobs synchronously"""
+    meta_feature_generation = dict()
+    base_learner_source = ''.join([
+        "from sklearn.linear_model import LogisticRegression\n",
+        "base_learner = LogisticRegression(max_iter=1000)"
+    ])
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        engine = create_engine('sqlite:///' + os.path.join(self.path,
+                                                           app.config['XCESSIV_NOTEBOOK_NAME']))
+        models.Base.metadata.create_all(engine)
+        engine.dispose()
+
+        with functions.DBContextManager(self.path) as session:
+            extraction = models.Extraction()
+            extraction.main_dataset = dict(source=''.join([
+                "from sklearn.datasets import load_iris\n",
+                "\n",
+                "\n",
+                "def extract_main_dataset():\n",
+                "    return load_iris(return_X_y=True)"
+            ]))
+            extraction.test_dataset = dict(method='split_from_main', split_ratio=0.2,
+                                           split_seed=8)
+            extraction.meta_feature_generation = dict(
+                self.meta_feature_generation,
+                source=''.join([
+                    "from sklearn.model_selection import KFold\n",
+                    "\n",
+                    "\n",
+                    "def return_splits_iterable(X, y):\n",
+                    "    return KFold(3, shuffle=True, random_state=8).split(X, y)"
+                ])
+            )
+            base_learner_origin = models.BaseLearnerOrigin(
+                source=self.base_learner_source,
+                metric_generators={'Accuracy': ''.join([
+                    "import numpy as np\n",
+                    "from sklearn.metrics import accuracy_score\n",
+                    "def metric_generator(y_true, y_probas):\n",
+                    "    return accuracy_score(y_true, np.argmax(y_probas, axis=1))"
+                ])}
+            )
+            base_learner = models.BaseLearner(dict(C=1.0), 'queued', base_learner_origin)
+            session.add_all([extraction, base_learner_origin, base_learner])
+            session.commit()
+            self.base_learner_id = base_learner.id
+
+        self.jobs = []
+        current_job = mock.Mock(id='job')
+        self.patches = [
+            mock.patch.object(rqtasks, 'get_current_job', return_value=current_job),
+            mock.patch.object(rqtasks, 'Queue', lambda *args, **kwargs: FakeQueue(self.jobs))
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.path)
+
+    def run_jobs(self):
+        """Runs the enqueued jobs in order and returns the ones that raised"""
+        failed = []
+        while self.jobs:
+            func, args = self.jobs.pop(0)
+            try:
+                func(*args)
+            except ValueError:
+                failed.append((func, args))
+        return failed
+
+    def base_learner(self, session):
+        return session.query(models.BaseLearner).filter_by(id=self.base_learner_id).first()
+
+
+class TestFoldFanOut(NotebookTestCase):
+    meta_feature_generation = dict(fan_out=True)
+
+    def test_requeue_failed_fold(self):
+        fit_and_predict = functions.fit_and_predict_checkpointed_fold
+
+        def fail_fold_one(*args):
+            if args[7] == 1:
+                raise ValueError('fold failed')
+            return fit_and_predict(*args)
+
+        rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        assert [args[2] for func, args in self.jobs] == [0, 1, 2]
+        with mock.patch.object(functions, 'fit_and_predict_checkpointed_fold',
+                               side_effect=fail_fold_one):
+            failed = self.run_jobs()
+        assert [args[2] for func, args in failed] == [1]
+        with functions.DBContextManager(self.path) as session:
+            base_learner = self.base_learner(session)
+            assert base_learner.job_status == 'errored'
+            checkpoint_path = base_learner.checkpoint_path(self.path)
+        # The folds after the failed one still ran
+        assert functions.missing_fold_checkpoints(checkpoint_path, 3) == [1]
+
+        # Requeueing the failed fold completes the base learner
+        self.jobs.extend(failed)
+        assert not self.run_jobs()
+        with functions.DBContextManager(self.path) as session:
+            base_learner = self.base_learner(session)
+            assert base_learner.job_status == 'finished'
+            assert 'error_fold' not in base_learner.description
+            assert base_learner.load_meta_features(self.path).shape == (120, 3)
+            assert base_learner.individual_score['Accuracy'] > 0.9
+
+    def test_requeue_after_failed_reduce(self):
+        rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        fold_jobs = list(self.jobs)
+        # The last fold job enqueues the reduce, which fails
+        with mock.patch.object(functions, 'generate_out_of_fold_meta_features',
+                               side_effect=ValueError('reduce failed')):
+            failed = self.run_jobs()
+        assert [func for func, args in failed] == [rqtasks.generate_meta_features]
+        with functions.DBContextManager(self.path) as session:
+            assert self.base_learner(session).job_status == 'errored'
+
+        # A fold job that completes the checkpoints again schedules the reduce again
+        self.jobs.append(fold_jobs[0])
+        assert not self.run_jobs()
+        with functions.DBContextManager(self.path) as session:
+            assert self.base_learner(session).job_status == 'finished'
+
+
+class TestEvaluateStackedEnsembles(NotebookTestCase):
+    def test_failing_ensemble_does_not_stop_batch(self):
+        rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        with functions.DBContextManager(self.path) as session:
+            base_learner = self.base_learner(session)
+            stacked_ensembles = [
+                models.StackedEnsemble(dict(C=C), [base_learner],
+                                       base_learner.base_learner_origin, 'queued')
+                for C in (1.0, -1.0, 0.5)  # A negative C fails to fit
+            ]
+            session.add_all(stacked_ensembles)
+            session.commit()
+            ensemble_ids = [stacked_ensemble.id for stacked_ensemble in stacked_ensembles]
+
+        rqtasks.evaluate_stacked_ensembles(self.path, ensemble_ids)
+        with functions.DBContextManager(self.path) as session:
+            stacked_ensembles = [session.query(models.StackedEnsemble).filter_by(id=id).first()
+                                 for id in ensemble_ids]
+            assert [stacked_ensemble.job_status for stacked_ensemble in stacked_ensembles] == \
+                ['finished', 'errored', 'finished']
+            assert stacked_ensembles[0].individual_score['Accuracy'] > 0.9
+            assert not stacked_ensembles[1].individual_score
+            assert 'error_value' in stacked_ensembles[1].description
+
+
+class TestTestMetaFeatures(NotebookTestCase):
+    meta_feature_generation = dict(persist_fold_models=True)
+
+    def test_holdout_scores(self):
+        rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        assert [func for func, args in self.jobs] == [rqtasks.generate_test_meta_features]
+        with functions.DBContextManager(self.path) as session:
+            assert self.base_learner(session).description['holdout'] == dict(status='queued')
+        assert not self.run_jobs()
+
+        with functions.DBContextManager(self.path) as session:
+            base_learner = self.base_learner(session)
+            holdout = base_learner.description['holdout']
+            assert holdout['status'] == 'finished'
+            assert holdout['scores']['Accuracy'] > 0.9
+            stacked_ensemble = models.StackedEnsemble(dict(), [base_learner],
+                                                      base_learner.base_learner_origin,
+                                                      'queued')
+            session.add(stacked_ensemble)
+            session.commit()
+            ensemble_id = stacked_ensemble.id
+        test_meta_features = MetaFeatureStore.from_notebook(self.path, 'test').get(
+            self.base_learner_id)
+        assert test_meta_features.shape == (30, 3)
+        np.testing.assert_allclose(test_meta_features.sum(axis=1), 1)
+
+        rqtasks.evaluate_stacked_ensembles(self.path, [ensemble_id])
+        with functions.DBContextManager(self.path) as session:
+            stacked_ensemble = session.query(models.StackedEnsemble).\
+                filter_by(id=ensemble_id).first()
+            assert stacked_ensemble.job_status == 'finished'
+            assert stacked_ensemble.description['holdout']['scores']['Accuracy'] > 0.9
+
+    def test_fold_models_over_cap(self):
+        with mock.patch.dict(app.config, {'XCESSIV_FOLD_MODELS_MAX_BYTES': 1}):
+            rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        assert not self.jobs
+        with functions.DBContextManager(self.path) as session:
+            base_learner = self.base_learner(session)
+            assert base_learner.job_status == 'finished'
+            assert base_learner.description['holdout']['status'] == 'errored'
+            assert not os.path.exists(base_learner.fold_models_path(self.path))
+
+
+class TestTestMetaFeaturesCustomEstimator(NotebookTestCase):
+    meta_feature_generation = dict(persist_fold_models=True)
+    base_learner_source = ''.join([
+        "from sklearn.linear_model import LogisticRegression\n",
+        "\n",
+        "\n",
+        "class CustomLogisticRegression(LogisticRegression):\n",
+        "    pass\n",
+        "\n",
+        "\n",
+        "base_learner = CustomLogisticRegression(max_iter=1000)"
+    ])
+
+    def test_holdout_scores(self):
+        rqtasks.generate_meta_features(self.path, self.base_learner_id)
+        assert [func for func, args in self.jobs] == [rqtasks.generate_test_meta_features]
+
+        # The test meta-features are generated in a fresh process that has not executed
+        # the base learner source yet
+        sha256 = hashlib.sha256(self.base_learner_source.encode('UTF-8')).hexdigest()
+        with mock.patch.dict(sys.modules), \
+                mock.patch.object(functions, '_module_cache', OrderedDict()):
+            sys.modules.pop(sha256, None)
+            assert not self.run_jobs()
+
+        with functions.DBContextManager(self.path) as session:
+            holdout = self.base_learner(session).description['holdout']
+            assert holdout['status'] == 'finished'
+            assert holdout['scores']['Accuracy'] > 0.9
+        assert MetaFeatureStore.from_notebook(self.path, 'test').get(
+            self.base_learner_id).shape == (30, 3)
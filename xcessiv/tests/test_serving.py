@@ -0,0 +1,94 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import json
+import threading
+import numpy as np
+from xcessiv import exceptions, serving
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = serving.Histogram([1, 2, 4])
+        for value in [0.5, 1, 3, 10]:
+            histogram.observe(value)
+        serialized = histogram.serialize
+        assert [bucket['count'] for bucket in serialized['buckets']] == [2, 0, 1, 1]
+        assert serialized['buckets'][-1]['le'] == '+Inf'
+        assert serialized['count'] == 4
+        assert serialized['sum'] == 14.5
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+        def predict_function(X):
+            if np.any(X < 0):
+                raise ValueError('negative value')
+            self.batches.append(len(X))
+            return X.sum(axis=1)
+
+        self.batcher = serving.MicroBatcher(predict_function, max_batch_size=100,
+                                            max_latency=0.5)
+
+    def predict_concurrently(self, requests):
+        results = [None] * len(requests)
+
+        def target(idx):
+            try:
+                results[idx] = self.batcher.predict(requests[idx])
+            except exceptions.UserError as e:
+                results[idx] = e
+
+        threads = [threading.Thread(target=target, args=(idx,))
+                   for idx in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_requests_coalesced(self):
+        results = self.predict_concurrently([[[idx, 1]] for idx in range(8)])
+        for idx, result in enumerate(results):
+            np.testing.assert_array_equal(result, [idx + 1])
+        assert sum(self.batches) == 8
+        assert len(self.batches) < 8
+        assert self.batcher.batch_size_histogram.serialize['count'] == len(self.batches)
+        assert self.batcher.latency_histogram.serialize['count'] == 8
+
+    def test_bad_request_fails_alone(self):
+        results = self.predict_concurrently([[[1, 1]], [[-1, 1]], [[2, 2], [3, 3]]])
+        np.testing.assert_array_equal(results[0], [2])
+        assert isinstance(results[1], exceptions.UserError)
+        np.testing.assert_array_equal(results[2], [4, 6])
+
+    def test_reject_one_dimensional(self):
+        self.assertRaises(exceptions.UserError, self.batcher.predict, [1, 2])
+
+
+class TestCreateApp(unittest.TestCase):
+    def setUp(self):
+        class Ensemble(object):
+            def _process_using_meta_feature_generator(self, X, method):
+                assert method == 'predict_proba'
+                return np.hstack([X[:, :1], 1 - X[:, :1]])
+
+        self.app = serving.create_app(Ensemble(), 'predict_proba', max_latency=0.001)
+        self.client = self.app.test_client()
+
+    def test_predict_and_metrics(self):
+        rv = self.client.post('/predict/', data=json.dumps({'instances': [[0.25, 3]]}),
+                              content_type='application/json')
+        assert rv.status_code == 200
+        assert json.loads(rv.data.decode('utf8')) == {'predictions': [[0.25, 0.75]]}
+
+        rv = self.client.get('/metrics/')
+        metrics = json.loads(rv.data.decode('utf8'))
+        assert metrics['latency_seconds']['count'] == 1
+        assert metrics['batch_size_rows']['sum'] == 1
+
+    def test_missing_instances(self):
+        rv = self.client.post('/predict/', data=json.dumps({}),
+                              content_type='application/json')
+        assert rv.status_code == 400
@@ -1,10 +1,11 @@
 from __future__ import absolute_import, print_function, division, unicode_literals
 import unittest
 import numpy as np
+from scipy import sparse
 from xcessiv import stacker
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.model_selection import KFold, StratifiedKFold, train_test_split
 from sklearn.datasets import load_iris
 from sklearn.metrics import accuracy_score
 
@@ -50,3 +51,106 @@ class TestStacker(unittest.TestCase):
         self.stacked_ensemble.set_params(**{'secondary-learner__C': 1.5})
         assert self.stacked_ensemble.get_params()['secondary-learner__C'] == 1.5
         assert self.stacked_ensemble.get_params()['secondary-learner'].get_params()['C'] == 1.5
+
+
+class TestOutOfFoldCollector(unittest.TestCase):
+    def setUp(self):
+        self.splits = [(np.array([2, 3]), np.array([0, 1])),
+                       (np.array([0, 1]), np.array([2, 3, 4]))]
+
+    def test_add_out_of_order(self):
+        collector = stacker.OutOfFoldCollector(self.splits)
+        collector.add(1, np.ones((3, 2)))
+        collector.add(0, np.zeros((2, 2)))
+        np.testing.assert_array_equal(collector.result(),
+                                      np.concatenate([np.zeros((2, 2)), np.ones((3, 2))]))
+        np.testing.assert_array_equal(collector.test_index, [0, 1, 2, 3, 4])
+
+    def test_dtype_widening(self):
+        collector = stacker.OutOfFoldCollector(self.splits)
+        collector.add(0, np.array(['a', 'b']))
+        collector.add(1, np.array(['ccc', 'd', 'e']))
+        assert collector.result().tolist() == ['a', 'b', 'ccc', 'd', 'e']
+
+    def test_shape_mismatch(self):
+        collector = stacker.OutOfFoldCollector(self.splits)
+        self.assertRaises(ValueError, collector.add, 0, np.zeros(3))
+        collector.add(0, np.zeros((2, 2)))
+        self.assertRaises(ValueError, collector.add, 1, np.zeros((3, 3)))
+
+
+class TestStackerPrediction(unittest.TestCase):
+    def setUp(self):
+        X, y = load_iris(return_X_y=True)
+        self.X_train, self.X_test, y_train, y_test = train_test_split(X, y, random_state=8)
+        self.stacked_ensemble = stacker.XcessivStackedEnsemble(
+            [RandomForestClassifier(n_estimators=10, random_state=8), LogisticRegression()],
+            ['predict', 'predict_proba'],
+            LogisticRegression(),
+            KFold(n_splits=3, shuffle=True, random_state=8).split
+        )
+        self.stacked_ensemble.fit(self.X_train, y_train)
+        self.expected = self.stacked_ensemble._process_using_meta_feature_generator(
+            self.X_test, 'predict_proba')
+
+    def test_batches_match_single_pass(self):
+        self.stacked_ensemble.set_params(batch_size=7)
+        np.testing.assert_array_equal(
+            self.stacked_ensemble._process_using_meta_feature_generator(self.X_test,
+                                                                        'predict_proba'),
+            self.expected
+        )
+
+    def test_parallel_matches_serial(self):
+        self.stacked_ensemble.set_params(n_jobs=2, batch_size=10)
+        assert self.stacked_ensemble.get_params()['n_jobs'] == 2
+        np.testing.assert_array_equal(
+            self.stacked_ensemble._process_using_meta_feature_generator(self.X_test,
+                                                                        'predict_proba'),
+            self.expected
+        )
+
+
+class TestStackerFit(unittest.TestCase):
+    def setUp(self):
+        X, y = load_iris(return_X_y=True)
+        self.X_train, self.X_test, self.y_train, y_test = train_test_split(X, y,
+                                                                           random_state=8)
+
+    def return_ensemble(self, **kwargs):
+        return stacker.XcessivStackedEnsemble(
+            [RandomForestClassifier(n_estimators=10, random_state=8), LogisticRegression()],
+            ['predict', 'predict_proba'],
+            LogisticRegression(),
+            KFold(n_splits=3, shuffle=True, random_state=8).split,
+            **kwargs
+        )
+
+    def test_parallel_fit_matches_serial(self):
+        expected = self.return_ensemble().fit(self.X_train, self.y_train).\
+            _process_using_meta_feature_generator(self.X_test, 'predict_proba')
+        for backend in ('threading', 'multiprocessing'):
+            stacked_ensemble = self.return_ensemble(n_jobs=2, backend=backend)
+            stacked_ensemble.fit(self.X_train, self.y_train)
+            np.testing.assert_array_equal(
+                stacked_ensemble._process_using_meta_feature_generator(self.X_test,
+                                                                       'predict_proba'),
+                expected
+            )
+
+    def test_sparse_features(self):
+        expected = self.return_ensemble().fit(self.X_train, self.y_train).\
+            _process_using_meta_feature_generator(self.X_test, 'predict_proba')
+        stacked_ensemble = self.return_ensemble(batch_size=10)
+        stacked_ensemble.fit(sparse.coo_matrix(self.X_train), self.y_train)
+        np.testing.assert_allclose(
+            stacked_ensemble._process_using_meta_feature_generator(
+                sparse.csr_matrix(self.X_test), 'predict_proba'),
+            expected
+        )
+
+    def test_timing_callback(self):
+        timings = []
+        self.return_ensemble(timing_callback=lambda idx, seconds: timings.append(idx)).\
+            fit(self.X_train, self.y_train)
+        assert timings == [0, 1]
@@ -2,7 +2,12 @@ from __future__ import absolute_import, print_function, division, unicode_litera
 import unittest
 import json
 import os
-from xcessiv import app, functions, models, constants
+import shutil
+from xcessiv import app, functions, models, constants, rqtasks
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 class TestCreateNewEnsemble(unittest.TestCase):
@@ -13,9 +18,7 @@ class TestCreateNewEnsemble(unittest.TestCase):
     def tearDown(self):
         if os.path.exists(os.path.join(self.test_location,
                                        app.config['XCESSIV_NOTEBOOK_NAME'])):
-            os.remove(os.path.join(self.test_location,
-                                   app.config['XCESSIV_NOTEBOOK_NAME']))
-            os.rmdir(self.test_location)
+            shutil.rmtree(self.test_location)  # Includes the WAL files of the notebook
 
     def test_creation(self):
         rv = self.app.post(
@@ -60,3 +63,77 @@ class TestCreateNewEnsemble(unittest.TestCase):
         )
 
         assert rv.status_code == 400
+
+
+class TestCreateStackedEnsembleBatch(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.test_location = 'test_folder'
+        self.app.post('/ensemble/', data=json.dumps({'ensemble_name': self.test_location}),
+                      content_type='application/json')
+        with functions.DBContextManager(self.test_location) as session:
+            base_learner_origin = models.BaseLearnerOrigin(source=''.join([
+                "from sklearn.linear_model import LogisticRegression\n",
+                "base_learner = LogisticRegression()"
+            ]))
+            base_learners = [models.BaseLearner(dict(C=C), 'finished', base_learner_origin)
+                             for C in (0.1, 1.0, 10.0)]
+            session.add_all([base_learner_origin] + base_learners)
+            session.commit()
+            self.base_learner_origin_id = base_learner_origin.id
+            self.base_learner_ids = [base_learner.id for base_learner in base_learners]
+
+    def tearDown(self):
+        if os.path.exists(os.path.join(self.test_location,
+                                       app.config['XCESSIV_NOTEBOOK_NAME'])):
+            shutil.rmtree(self.test_location)
+
+    def post_batch(self, *base_learner_ids_list):
+        with mock.patch.object(rqtasks.evaluate_stacked_ensembles, 'delay') as delay:
+            rv = self.app.post(
+                '/ensemble/stacked/batch/?path={}'.format(self.test_location),
+                data=json.dumps({
+                    'base_learner_origin_id': self.base_learner_origin_id,
+                    'ensembles': [{'base_learner_ids': base_learner_ids,
+                                   'secondary_learner_hyperparameters': {'C': 2.0}}
+                                  for base_learner_ids in base_learner_ids_list]
+                }),
+                content_type='application/json'
+            )
+        return rv, delay
+
+    def number_of_ensembles(self):
+        with functions.DBContextManager(self.test_location) as session:
+            return session.query(models.StackedEnsemble).count()
+
+    def test_skips_existing_ensembles(self):
+        first, second, third = self.base_learner_ids
+        rv, delay = self.post_batch([first, second], [second, first])
+        assert rv.status_code == 200
+        assert len(json.loads(rv.data.decode('utf8'))) == 1
+        assert delay.call_count == 1
+
+        rv, delay = self.post_batch([second, first], [third, first])
+        assert rv.status_code == 200
+        created = json.loads(rv.data.decode('utf8'))
+        assert [sorted(ensemble['base_learner_ids']) for ensemble in created] == \
+            [[first, third]]
+        delay.assert_called_once_with(self.test_location, [created[0]['id']])
+        assert self.number_of_ensembles() == 2
+
+        rv, delay = self.post_batch([first, second])
+        assert json.loads(rv.data.decode('utf8')) == []
+        assert not delay.called
+
+    def test_unknown_base_learners(self):
+        rv, delay = self.post_batch(self.base_learner_ids[:2], [self.base_learner_ids[0], 100])
+        assert rv.status_code == 400
+        assert not delay.called
+        assert self.number_of_ensembles() == 0
+
+    def test_repeated_base_learners(self):
+        first, second, third = self.base_learner_ids
+        rv, delay = self.post_batch([first, second], [first, first, third])
+        assert rv.status_code == 400
+        assert not delay.called
+        assert self.number_of_ensembles() == 0
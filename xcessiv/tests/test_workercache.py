@@ -0,0 +1,97 @@
+from __future__ import absolute_import, print_function, division, unicode_literals
+import unittest
+import numpy as np
+from scipy import sparse
+from xcessiv import workercache
+from xcessiv.scripts.runworker import XcessivWorker
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestResidentCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = workercache.ResidentCache(max_bytes=2500)
+
+    def test_least_recently_used_evicted(self):
+        for name in ('a', 'b', 'c'):
+            assert self.cache.put(('path', 'key', name), np.zeros(100))
+        assert self.cache.get(('path', 'key', 'a')) is not None
+        self.cache.put(('path', 'key', 'd'), np.zeros(100))
+        assert ('path', 'key', 'b') not in self.cache
+        assert len(self.cache) == 3
+        assert self.cache.nbytes == 2400
+        assert not self.cache.put(('path', 'key', 'e'), np.zeros(400))
+
+    def test_retain(self):
+        self.cache.put(('path', 'old', 'train'), np.zeros(10))
+        self.cache.put(('path', 'new', 'train'), np.zeros(10))
+        self.cache.put(('other', 'old', 'train'), np.zeros(10))
+        self.cache.retain('path', [('path', 'new', 'train')])
+        assert ('path', 'old', 'train') not in self.cache
+        assert ('path', 'new', 'train') in self.cache
+        assert ('other', 'old', 'train') in self.cache
+        assert self.cache.nbytes == 160
+
+    def test_forked_process_does_not_cache(self):
+        with mock.patch('os.getpid', return_value=self.cache.pid + 1):
+            assert not self.cache.put(('path', 'key', 'a'), np.zeros(10))
+        assert not len(self.cache)
+
+
+class TestLoadIntoMemory(unittest.TestCase):
+    def test_load_into_memory(self):
+        X, y = workercache.load_into_memory((np.arange(6).reshape(3, 2), [1, 2, 3]))
+        assert not X.flags.writeable
+        np.testing.assert_array_equal(y, [1, 2, 3])
+
+        X = workercache.load_into_memory(sparse.eye(3, format='csc'))
+        assert X.format == 'csc'
+        assert not X.data.flags.writeable
+        assert workercache.nbytes(X) == X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+
+    def test_sparse_matrix_made_canonical(self):
+        X = sparse.csr_matrix((np.array([1., 2., 3.]), np.array([2, 0, 2]),
+                               np.array([0, 3])), shape=(1, 3))
+        X_resident = workercache.load_into_memory(X)
+        assert not X_resident.data.flags.writeable
+        assert X_resident.has_canonical_format
+        np.testing.assert_array_equal(X_resident.toarray(), [[2, 0, 4]])
+        X_resident.sort_indices()
+        X_resident.sum_duplicates()
+
+
+class TestXcessivWorker(unittest.TestCase):
+    def setUp(self):
+        self.worker = XcessivWorker.__new__(XcessivWorker)
+
+    def preload(self, func_name, args):
+        job = mock.Mock(id='job', func_name=func_name, args=args)
+        with mock.patch('xcessiv.functions.DBContextManager') as db:
+            with mock.patch('xcessiv.scripts.runworker.logger') as logger:
+                self.worker.preload(job)
+        extraction = db.return_value.__enter__.return_value.query.return_value.first.\
+            return_value
+        return db, extraction, logger
+
+    def test_preloads_notebook_of_xcessiv_jobs(self):
+        db, extraction, logger = self.preload('xcessiv.rqtasks.generate_meta_features',
+                                              ('notebook', 1))
+        db.assert_called_once_with('notebook')
+        extraction.preload_resident.assert_called_once_with('notebook')
+        assert not logger.exception.called
+
+    def test_ignores_other_jobs(self):
+        for func_name, args in (('mymodule.work', ('notebook',)),
+                                ('xcessiv.rqtasks.generate_meta_features', ())):
+            db, extraction, logger = self.preload(func_name, args)
+            assert not db.called
+
+    def test_errors_are_logged(self):
+        with mock.patch('xcessiv.functions.DBContextManager',
+                        side_effect=ValueError('no notebook')):
+            with mock.patch('xcessiv.scripts.runworker.logger') as logger:
+                self.worker.preload(mock.Mock(id='job', func_name='xcessiv.rqtasks.a',
+                                              args=('notebook',)))
+        assert logger.exception.called
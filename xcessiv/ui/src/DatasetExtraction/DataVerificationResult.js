@@ -29,6 +29,10 @@ function BasicDataStatistics(props) {
     <ul>
       <li>Features shape: <b>{String(stats.features_shape)}</b></li>
       <li>Labels shape: <b>{String(stats.labels_shape)}</b></li>
+      {stats.features_nnz !== undefined &&
+        <li>Sparse features: <b>{stats.features_format.toUpperCase() + ', ' +
+          stats.features_nnz + ' stored values (' +
+          (100 * stats.features_density).toPrecision(3) + '% dense)'}</b></li>}
     </ul>
   )
 }
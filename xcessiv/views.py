@@ -89,6 +89,7 @@ def extraction_main_dataset():
                 extraction.main_dataset[key] = value
             session.add(extraction)
             session.commit()
+            extraction.cleanup_dataset_cache(path)
             return jsonify(extraction.main_dataset)
 
 
@@ -109,6 +110,7 @@ def extraction_test_dataset():
                 extraction.test_dataset[key] = value
             session.add(extraction)
             session.commit()
+            extraction.cleanup_dataset_cache(path)
             return jsonify(extraction.test_dataset)
 
 
@@ -129,6 +131,7 @@ def extraction_meta_feature_generation():
                 extraction.meta_feature_generation[key] = value
             session.add(extraction)
             session.commit()
+            extraction.cleanup_dataset_cache(path)
             return jsonify(extraction.meta_feature_generation)
 
 
@@ -326,7 +329,7 @@ def create_base_learner(id):
 
         base_learners = session.query(models.BaseLearner).\
             filter_by(base_learner_origin_id=id,
-                      hyperparameters=hyperparameters).all()
+                      hyperparameters_hash=models.hash_json(hyperparameters)).all()
         if base_learners:
             raise exceptions.UserError('Base learner exists with given hyperparameters')
 
@@ -392,7 +395,7 @@ def search_base_learner(id):
 
             base_learners = session.query(models.BaseLearner).\
                 filter_by(base_learner_origin_id=id,
-                          hyperparameters=hyperparameters).all()
+                          hyperparameters_hash=models.hash_json(hyperparameters)).all()
             if base_learners:  # already exists
                 continue
 
@@ -439,7 +442,7 @@ def get_automated_runs():
         with functions.DBContextManager(path) as session:
             base_learner_origin = None
 
-            if req_body['category'] == 'bayes' or req_body['category'] == 'greedy_ensemble_search':
+            if req_body['category'] in ('bayes', 'greedy_ensemble_search', 'ensemble_selection'):
                 base_learner_origin = session.query(models.BaseLearnerOrigin).\
                     filter_by(id=req_body['base_learner_origin_id']).first()
                 if base_learner_origin is None:
@@ -566,8 +569,8 @@ def create_new_stacked_ensemble():
 
             stacked_ensembles = session.query(models.StackedEnsemble).\
                 filter_by(base_learner_origin_id=req_body['base_learner_origin_id'],
-                          secondary_learner_hyperparameters=hyperparameters,
-                          base_learner_ids=sorted([bl.id for bl in base_learners])).all()
+                          ensemble_hash=models.StackedEnsemble.hash_ensemble(
+                              hyperparameters, [bl.id for bl in base_learners])).all()
             if stacked_ensembles:
                 raise exceptions.UserError('Stacked ensemble exists')
 
@@ -587,6 +590,69 @@ def create_new_stacked_ensemble():
             return jsonify(stacked_ensemble.serialize)
 
 
+@app.route('/ensemble/stacked/batch/', methods=['POST'])
+def create_stacked_ensemble_batch():
+    path = functions.get_path_from_query_string(request)
+    req_body = request.get_json()
+
+    with functions.DBContextManager(path) as session:
+        base_learner_origin = session.query(models.BaseLearnerOrigin).\
+            filter_by(id=req_body['base_learner_origin_id']).first()
+        if base_learner_origin is None:
+            raise exceptions.UserError('Base learner origin {} not '
+                                       'found'.format(req_body['base_learner_origin_id']), 404)
+
+        all_ids = set()
+        for spec in req_body['ensembles']:
+            if len(set(spec['base_learner_ids'])) != len(spec['base_learner_ids']):
+                raise exceptions.UserError('Base learners of stacked ensemble {} are not '
+                                           'unique'.format(spec['base_learner_ids']))
+            all_ids.update(spec['base_learner_ids'])
+        base_learners = dict(
+            (bl.id, bl) for bl in session.query(models.BaseLearner).
+            filter(models.BaseLearner.id.in_(all_ids)).all()
+        )
+        if len(base_learners) != len(all_ids):
+            raise exceptions.UserError('Not all base learners found')
+        for learner in base_learners.values():
+            if learner.job_status != 'finished':
+                raise exceptions.UserError('Not all base learners have finished')
+
+        stacked_ensembles = []
+        ensemble_hashes = set()
+        for spec in req_body['ensembles']:
+            # Retrieve full hyperparameters
+            est = base_learner_origin.return_estimator()
+            est.set_params(**spec.get('secondary_learner_hyperparameters', {}))
+            hyperparameters = functions.make_serializable(est.get_params())
+
+            ensemble_hash = models.StackedEnsemble.hash_ensemble(hyperparameters,
+                                                                 spec['base_learner_ids'])
+            if ensemble_hash in ensemble_hashes or session.query(models.StackedEnsemble).\
+                    filter_by(base_learner_origin_id=base_learner_origin.id,
+                              ensemble_hash=ensemble_hash).first() is not None:
+                continue  # already exists
+            ensemble_hashes.add(ensemble_hash)
+
+            stacked_ensemble = models.StackedEnsemble(
+                secondary_learner_hyperparameters=hyperparameters,
+                base_learners=[base_learners[bl_id] for bl_id in spec['base_learner_ids']],
+                base_learner_origin=base_learner_origin,
+                job_status='queued'
+            )
+            session.add(stacked_ensemble)
+            stacked_ensembles.append(stacked_ensemble)
+        session.commit()
+
+        if stacked_ensembles:
+            with Connection(get_redis_connection()):
+                rqtasks.evaluate_stacked_ensembles.delay(
+                    path, [stacked_ensemble.id for stacked_ensemble in stacked_ensembles]
+                )
+
+        return jsonify(list(map(lambda x: x.serialize, stacked_ensembles)))
+
+
 @app.route('/ensemble/stacked/<int:id>/', methods=['GET', 'DELETE'])
 def specific_stacked_ensemble(id):
     path = functions.get_path_from_query_string(request)
@@ -626,6 +692,15 @@ def export_stacked_ensemble(id):
                     req_body['name'] += '.py'
                 stacked_ensemble.export_as_file(os.path.join(path, req_body['name']),
                                                 extraction.meta_feature_generation['source'])
+            elif req_body['type'] == 'artifact':
+                if os.path.exists(os.path.join(path, req_body['name'])):
+                    raise exceptions.UserError('{} already exists'.format(
+                        os.path.join(path, req_body['name'])))
+                with Connection(get_redis_connection()):
+                    job = rqtasks.export_fitted_artifact.delay(path, id, req_body['name'])
+                return jsonify(message='Stacked ensemble is being fitted and '
+                                       'exported as {} in {}'.format(req_body['name'], path),
+                               job_id=job.id)
             return jsonify(message='Stacked ensemble successfully '
                                    'exported as {} in {}'.format(
                 req_body['name'], path
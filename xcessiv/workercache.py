@@ -0,0 +1,124 @@
+"""This module contains the cache keeping datasets and cross-validation splits of notebooks
+in memory in an Xcessiv worker across jobs
+
+The cache is disabled unless :func:`enable` is called, which the Xcessiv worker does in its
+main process. The worker fills the cache before forking the process that runs a job, so
+every job inherits the cached arrays copy-on-write. Jobs only read from the cache.
+"""
+from __future__ import absolute_import, print_function, division, unicode_literals
+from collections import OrderedDict
+import os
+import threading
+import numpy as np
+from scipy import sparse
+
+
+def nbytes(value):
+    """Returns the number of bytes held by the arrays in ``value``, which may be an array,
+    a sparse matrix or a tuple or list of these"""
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(item) for item in value)
+    if sparse.issparse(value):
+        return sum(getattr(value, name).nbytes for name in ('data', 'indices', 'indptr')
+                   if hasattr(value, name))
+    return np.asarray(value).nbytes
+
+
+def load_into_memory(value):
+    """Returns a read-only copy of ``value`` in memory, so memory-mapped arrays no longer
+    depend on the files they map
+
+    CSR and CSC matrices are put in canonical format first, since SciPy and scikit-learn
+    sort their indices in place otherwise, which fails on read-only arrays."""
+    if isinstance(value, (tuple, list)):
+        return type(value)(load_into_memory(item) for item in value)
+    if sparse.issparse(value):
+        if value.format not in ('csr', 'csc'):
+            return value.copy()
+        if not value.has_canonical_format:
+            value = value.copy()
+            value.sum_duplicates()
+        return type(value)(tuple(load_into_memory(getattr(value, name))
+                                 for name in ('data', 'indices', 'indptr')),
+                           shape=value.shape, copy=False)
+    array = np.array(value)
+    array.flags.writeable = False
+    return array
+
+
+class ResidentCache(object):
+    """Least recently used cache of arrays with a cap on their total size
+
+    Keys are tuples whose first item is the path of the notebook the value belongs to.
+    Values are only added in the process that created the cache. Forked processes see
+    the values present when they were forked, and their misses are not cached.
+
+    Args:
+        max_bytes (int): Maximum total size of the cached values. Values larger than this
+            are not cached.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.pid = os.getpid()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value cached under ``key`` and marks it as recently used, or None
+        if there is none"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value):
+        """Caches ``value`` under ``key``, evicting the least recently used values until it
+        fits. Does nothing outside of the process that created the cache.
+
+        Returns:
+            cached (bool): True if the value was cached
+        """
+        size = nbytes(value)
+        if os.getpid() != self.pid or size > self.max_bytes:
+            return False
+        with self._lock:
+            self._pop(key)
+            while self._entries and self.nbytes + size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+            self._entries[key] = (value, size)
+            self.nbytes += size
+        return True
+
+    def retain(self, path, keys):
+        """Removes the values of notebook ``path`` whose key is not in ``keys``"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path and key not in keys]:
+                self._pop(key)
+
+    def _pop(self, key):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+
+
+_cache = None
+
+
+def enable(max_bytes):
+    """Enables the cache in this process and returns it"""
+    global _cache
+    _cache = ResidentCache(max_bytes)
+    return _cache
+
+
+def get_cache():
+    """Returns the cache of this process, or None if it is disabled"""
+    return _cache